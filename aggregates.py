@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+aggregates.py
+- Per-month counters behind the summary and spares reports:
+    jobs[jobType][region]   number of works (+ standalone emergencies as "صيانة طارئة")
+    kpi[key][region]        hours, oil liters and filter counts (keys of tpl_cache.SPARES_KPIS)
+    spares[label][region]   spare quantities, already matched to the template labels
+    lines[label][region]    number of spare lines behind each quantity (a label
+                            with only zero quantities is still written)
+    unmatched[name][region] spare lines whose name fell into SPARE_OTHER
+- Aggregates is a store index: the Store calls rebuild() on full loads and
+  update() with the removed/added records of every sync, so reports only
+  write numbers that are already computed.
+- Quantities are kept as integer millionths so adding and removing records
+  never drifts; verify() recomputes everything from the raw records.
+- The counted "hours" are the hoursDiff the client recorded. Given a meter
+  timeline (timeline.MeterTimeline), month() serves its deltas instead.
+"""
+import math
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, List
+
+from catalog import REGIONS, SPARE_OTHER
+from registry import REGISTRY
+from spare_catalog import CATALOG
+from store import month_of
+
+SCALE = 1_000_000
+EMERGENCY_JOB = "صيانة طارئة"
+OTHER_JOB = "أخرى"
+
+def _txt(v: Any) -> str:
+    return v.strip() if isinstance(v, str) else ""
+
+def region_of(rec: Dict[str, Any]) -> str:
+    """Report region of a record (spelling variants resolved); unknown regions count under the first one."""
+    return REGISTRY.region(rec.get("region")) or REGIONS[0]
+
+def spare_label(name: str) -> str:
+    """Template label for a free-text spare name (substring match either way), else SPARE_OTHER."""
+    return CATALOG.label(name)
+
+def _micro(v: Any) -> int:
+    try:
+        f = float(v or 0)
+    except (TypeError, ValueError):
+        return 0
+    return round(f * SCALE) if math.isfinite(f) else 0
+
+def _bump(table: Dict[str, Dict[str, int]], key: str, region: str, n: int):
+    if not n:
+        return
+    row = table.setdefault(key, {})
+    v = row.get(region, 0) + n
+    if v:
+        row[region] = v
+    else:
+        del row[region]
+        if not row:
+            del table[key]
+
+class MonthAggregates:
+    __slots__ = ("jobs", "kpi", "spares", "lines", "unmatched")
+
+    def __init__(self):
+        self.jobs: Dict[str, Dict[str, int]] = {}
+        self.kpi: Dict[str, Dict[str, int]] = {}
+        self.spares: Dict[str, Dict[str, int]] = {}
+        self.lines: Dict[str, Dict[str, int]] = {}
+        self.unmatched: Dict[str, Dict[str, int]] = {}
+
+    def copy(self) -> "MonthAggregates":
+        c = MonthAggregates()
+        for name in self.__slots__:
+            setattr(c, name, {k: dict(v) for k, v in getattr(self, name).items()})
+        return c
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MonthAggregates) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def empty(self) -> bool:
+        return not (self.jobs or self.kpi or self.spares or self.lines or self.unmatched)
+
+    def add(self, kind: str, rec: Dict[str, Any], sign: int = 1):
+        reg = region_of(rec)
+        if kind == "emergencies":
+            _bump(self.jobs, EMERGENCY_JOB, reg, sign)
+            return
+        if kind != "works":
+            return
+        job = rec.get("jobType")
+        _bump(self.jobs, job if isinstance(job, str) and job else OTHER_JOB, reg, sign)
+        _bump(self.kpi, "hours", reg, sign * _micro(rec.get("hoursDiff", 0)))
+        _bump(self.kpi, "oil", reg, sign * _micro(rec.get("oilLiters", 0)))
+        _bump(self.kpi, "f_oil", reg, sign * bool(rec.get("oilFilter")))
+        _bump(self.kpi, "f_diesel", reg, sign * bool(rec.get("dieselFilter")))
+        _bump(self.kpi, "f_air", reg, sign * bool(rec.get("airFilter")))
+        for sp in (rec.get("spares") or []):
+            if not isinstance(sp, Mapping):
+                continue
+            name = _txt(sp.get("name"))
+            if name:
+                label = spare_label(name)
+                _bump(self.spares, label, reg, sign * _micro(sp.get("qty", 0)))
+                _bump(self.lines, label, reg, sign)
+                if label == SPARE_OTHER and name != SPARE_OTHER:
+                    _bump(self.unmatched, name, reg, sign)
+
+    # -------- report tables ----------
+    def jobs_table(self) -> Dict[str, Dict[str, int]]:
+        return self.jobs
+
+    def kpi_table(self) -> Dict[str, Dict[str, float]]:
+        """Hours and oil as numbers, filters as counts."""
+        return {k: (dict(byreg) if k.startswith("f_") else {rn: v / SCALE for rn, v in byreg.items()})
+                for k, byreg in self.kpi.items()}
+
+    def spares_table(self) -> Dict[str, Dict[str, float]]:
+        """Label -> region -> quantity, for every label/region that has spare lines."""
+        return {label: {rn: self.spares.get(label, {}).get(rn, 0) / SCALE for rn in byreg}
+                for label, byreg in self.lines.items()}
+
+def month_aggregates(works: Iterable[Dict[str, Any]], emerg: Iterable[Dict[str, Any]]) -> MonthAggregates:
+    """Counters of one month computed from its raw records."""
+    agg = MonthAggregates()
+    for w in works:
+        agg.add("works", w)
+    for e in emerg:
+        agg.add("emergencies", e)
+    return agg
+
+def _by_month(recs: Dict[str, Iterable[Dict[str, Any]]]) -> Dict[str, MonthAggregates]:
+    months: Dict[str, MonthAggregates] = {}
+    for kind in ("works", "emergencies"):
+        for rec in recs.get(kind) or ():
+            m = month_of(rec)
+            agg = months.get(m)
+            if agg is None:
+                agg = months[m] = MonthAggregates()
+            agg.add(kind, rec)
+    return {m: a for m, a in months.items() if not a.empty()}
+
+class Aggregates:
+    """Store index of MonthAggregates; each month object is replaced, never changed, once published."""
+    name = "aggregates"
+
+    def __init__(self, timeline=None):
+        self._months: Dict[str, MonthAggregates] = {}
+        self.timeline = timeline
+
+    def month(self, m: str) -> MonthAggregates:
+        agg = self._months.get(m) or MonthAggregates()
+        if self.timeline is None:
+            return agg
+        # shallow: the other tables are shared, and never changed once published
+        out = MonthAggregates()
+        for name in agg.__slots__:
+            setattr(out, name, getattr(agg, name))
+        out.kpi = {**agg.kpi, "hours": dict(self.timeline.hours(m))}
+        if not out.kpi["hours"]:
+            del out.kpi["hours"]
+        return out
+
+    def months(self) -> List[str]:
+        return sorted(self._months)
+
+    def rebuild(self, recs: Dict[str, Iterable[Dict[str, Any]]]):
+        self._months = _by_month(recs)
+
+    def state(self) -> Dict[str, MonthAggregates]:
+        return dict(self._months)
+
+    def restore(self, state: Dict[str, MonthAggregates]):
+        self._months = state
+
+    def update(self, kind: str, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]):
+        staged: Dict[str, MonthAggregates] = {}
+        for sign, recs in ((-1, removed), (1, added)):
+            for rec in recs:
+                m = month_of(rec)
+                agg = staged.get(m)
+                if agg is None:
+                    cur = self._months.get(m)
+                    agg = staged[m] = cur.copy() if cur is not None else MonthAggregates()
+                agg.add(kind, rec, sign)
+        for m, agg in staged.items():
+            if agg.empty():
+                self._months.pop(m, None)
+            else:
+                self._months[m] = agg
+
+    def verify(self, recs: Dict[str, Iterable[Dict[str, Any]]], repair: bool = False) -> List[str]:
+        """Months whose counters differ from the raw records; rebuilt when `repair`."""
+        fresh = _by_month(recs)
+        bad = sorted(m for m in set(fresh) | set(self._months) if fresh.get(m) != self._months.get(m))
+        if repair and bad:
+            self._months = fresh
+        return bad
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+bench
+- Reproducible benchmarks of the API, run in-process and offline:
+    python -m bench.run --sizes 1000,10000
+    python -m bench.run --sizes 100000 --backend sqlite --out results.json
+    python -m bench.run --baseline bench/baseline.json      (exit 1 on regressions)
+    python -m bench.memory --works 100000                   (records: dicts vs compact)
+- datagen.py builds seeded synthetic data from the real catalog (sites,
+  regions, job types, spare items); run.py times /import and every /export/*
+  and records wall time and peak Python memory (tracemalloc).
+"""
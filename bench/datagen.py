@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+bench/datagen.py
+- Seeded synthetic works / emergencies / grid readings shaped like the records
+  index.html posts, from the real catalog (SITES, REGIONS, JOB_TYPES, SPARE_ITEMS).
+- Ratios follow the production data: ~60% of works carry 1-3 spare lines
+  (some with free-text names or spelling variants), ~25% a grid reading,
+  one standalone emergency per ten works, and site names typed in a few
+  variants ("مذبح-5" / "مذبح - ٥").
+- Records are generated lazily, so 1M works can be streamed as NDJSON
+  without holding the payload in memory. The same seed gives the same bytes.
+"""
+import json, random
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from catalog import JOB_TYPES, REGIONS, SITES, SPARE_ITEMS, SPARE_OTHER
+
+SPARE_RATIO = 0.6
+GRID_RATIO = 0.25
+EMERGENCY_RATIO = 0.1
+EMERGENCY_JOB = "صيانة طارئة"
+WEEKDAYS = ["السبت", "الأحد", "الاثنين", "الثلاثاء", "الأربعاء", "الخميس", "الجمعة"]
+FREE_SPARES = ["فلتر زيت", "سير مروحة", "بطارية مولد", "كيبل", "فيوز 32A", "شيء آخر"]
+PEOPLE = ["أحمد", "سامي", "محمد", "علي", "خالد"]
+ALARMS = ["Mains Failure", "Low Fuel", "High Temp", "Door Open"]
+
+_DIGITS = str.maketrans("0123456789", "٠١٢٣٤٥٦٧٨٩")
+
+def months_back(last: str, n: int) -> List[str]:
+    """The `n` calendar months ending at `last` ("YYYY-MM"), oldest first."""
+    y, m = int(last[:4]), int(last[5:7])
+    out = []
+    for _ in range(n):
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y - 1, 12) if m == 1 else (y, m - 1)
+    return out[::-1]
+
+class Generator:
+    def __init__(self, works: int, seed: int = 1, months: int = 12, last_month: str = "2025-09"):
+        self.n = works
+        self.seed = seed
+        self.months = months_back(last_month, months)
+        # every site belongs to one region, as in the field
+        rnd = random.Random(seed)
+        self.site_region = {s: rnd.choice(REGIONS) for s in SITES}
+
+    def _variant(self, rnd: random.Random, site: str) -> str:
+        r = rnd.random()
+        if r < 0.05:
+            return site.replace("-", " - ")
+        if r < 0.08:
+            return site.translate(_DIGITS)
+        return site
+
+    def _spares(self, rnd: random.Random) -> List[Dict[str, Any]]:
+        out = []
+        for _ in range(rnd.randint(1, 3)):
+            name = rnd.choice(FREE_SPARES) if rnd.random() < 0.15 else rnd.choice(SPARE_ITEMS[:-1])
+            out.append({"name": name, "qty": rnd.randint(1, 4)})
+        return out
+
+    def works(self) -> Iterator[Dict[str, Any]]:
+        """Works in date order; generator hours grow per site."""
+        rnd = random.Random(self.seed * 7919 + 1)
+        hours: Dict[str, int] = {}
+        kwh: Dict[str, int] = {}
+        per_month = max(1, self.n // len(self.months))
+        for i in range(self.n):
+            month = self.months[min(i // per_month, len(self.months) - 1)]
+            day = 1 + (i % per_month) * 28 // per_month
+            date = f"{month}-{day:02d}"
+            site = rnd.choice(SITES)
+            job = EMERGENCY_JOB if rnd.random() < 0.08 else rnd.choice(JOB_TYPES)
+            h = hours.get(site, rnd.randint(100, 5000))
+            h_now = h + rnd.randint(5, 120) if rnd.random() < 0.7 else 0
+            if h_now:
+                hours[site] = h_now
+            w = {
+                "id": f"w{self.seed}-{i}", "date": date, "weekday": WEEKDAYS[day % 7],
+                "region": self.site_region[site], "site": self._variant(rnd, site), "siteOwner": "يمن موبايل",
+                "jobType": job, "summary": f"عمل {i}",
+                "oilLiters": rnd.choice([0, 0, 4, 8, 12]), "oilFilter": rnd.random() < 0.3,
+                "dieselFilter": rnd.random() < 0.2, "airFilter": rnd.random() < 0.1,
+                "hoursNow": h_now, "hoursDiff": h_now - h if h_now else 0,
+                "l1": rnd.randint(0, 60), "l2": rnd.randint(0, 60), "l3": rnd.randint(0, 60),
+                "kwhNow": rnd.randint(0, 9000),
+                "spares": self._spares(rnd) if rnd.random() < SPARE_RATIO else [],
+                "grid": None, "cleaning": None, "emergency": None,
+                "executor": rnd.choice(PEOPLE), "driver": rnd.choice(PEOPLE), "notes": "",
+                "savedAt": f"{date}T{rnd.randint(6, 20):02d}:{rnd.randint(0, 59):02d}:00.000Z",
+            }
+            if job == EMERGENCY_JOB:
+                w["emergency"] = {"alarm": rnd.choice(ALARMS), "source": "NOC", "category": "كهرباء", "notes": ""}
+            if rnd.random() < GRID_RATIO:
+                k = kwh.get(site, rnd.randint(1000, 50000))
+                k_now = k + rnd.randint(10, 900)
+                kwh[site] = k_now
+                w["grid"] = {"site": w["site"], "etype": "عمومي", "kwhPrev": k, "kwhNow": k_now,
+                             "kwhr": 0, "hours": rnd.randint(0, 24), "kwhDiff": k_now - k}
+            yield w
+
+    def records(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """(kind, record) for every work, its grid reading and the standalone emergencies."""
+        rnd = random.Random(self.seed * 104729 + 2)
+        for i, w in enumerate(self.works()):
+            yield "works", w
+            g = w.get("grid")
+            if g:
+                yield "grid", {**g, "id": f"g{self.seed}-{i}", "date": w["date"], "region": w["region"],
+                               "siteOwner": w["siteOwner"], "savedAt": w["savedAt"].replace(":00.000Z", ":30.000Z")}
+            if rnd.random() < EMERGENCY_RATIO:
+                same = rnd.random() < 0.5          # half of them land on a visit of the same day
+                site = w["site"] if same else rnd.choice(SITES)
+                yield "emergencies", {
+                    "id": f"e{self.seed}-{i}", "date": w["date"], "region": w["region"] if same else self.site_region[site],
+                    "site": site, "etype": "عمومي", "alarm": rnd.choice(ALARMS), "source": "NOC",
+                    "category": rnd.choice(["كهرباء", "مولد", SPARE_OTHER]), "notes": "", "remarks": "",
+                    "savedAt": w["date"] + "T10:00:00",
+                }
+
+    def payload(self) -> Dict[str, List[Dict[str, Any]]]:
+        """The whole data set as one /import body (small sizes only)."""
+        out: Dict[str, List[Dict[str, Any]]] = {"works": [], "emergencies": [], "grid": []}
+        for kind, rec in self.records():
+            out[kind].append(rec)
+        return out
+
+    def ndjson(self, batch: int = 1000) -> Iterator[bytes]:
+        """The data set as NDJSON chunks of `batch` lines ({"kind": ..., "record": ...})."""
+        lines: List[str] = []
+        for kind, rec in self.records():
+            lines.append(json.dumps({"kind": kind, "record": rec}, ensure_ascii=False))
+            if len(lines) >= batch:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+    def busiest_month(self) -> str:
+        """The month with the most works (the last one takes the remainder)."""
+        return self.months[max(0, min(self.n, len(self.months)) - 1)]
+
+def generate(works: int, seed: int = 1, months: int = 12, last_month: Optional[str] = None) -> Generator:
+    return Generator(works, seed, months, last_month or "2025-09")
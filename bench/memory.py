@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+bench/memory.py
+- Memory the store's records take as parsed JSON dicts (the old form) and as
+  compact records (compact.py), for the same seeded data set.
+- Records are decoded one line at a time, as /import does, so the dicts do not
+  share strings that a single json.loads of the whole document would share.
+- Traced with tracemalloc: only the record objects are counted, not the
+  partitions and indexes around them.
+    python -m bench.memory --works 100000
+"""
+import argparse, gc, json, os, sys, tracemalloc
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.datagen import generate
+from compact import compact
+
+def _traced(build: Callable[[], Any]) -> int:
+    """Bytes still allocated by what `build` returns, once it has returned."""
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    held = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del held
+    return size
+
+def measure(works: int, seed: int = 1, months: int = 12) -> Dict[str, Any]:
+    lines: List[bytes] = []
+    for chunk in generate(works, seed=seed, months=months).ndjson():
+        lines += chunk.splitlines()
+    n = len(lines)
+    as_dicts = _traced(lambda: [json.loads(line)["record"] for line in lines])
+    as_compact = _traced(lambda: [compact(json.loads(line)["record"]) for line in lines])
+    return {
+        "works": works, "records": n,
+        "dict_mb": round(as_dicts / 2**20, 1), "compact_mb": round(as_compact / 2**20, 1),
+        "dict_bytes_per_record": as_dicts // n, "compact_bytes_per_record": as_compact // n,
+        "saving": round(1 - as_compact / as_dicts, 3),
+    }
+
+def main_(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.memory", description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--works", type=int, default=100000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--months", type=int, default=12)
+    args = ap.parse_args(argv)
+    res = measure(args.works, args.seed, args.months)
+    print(json.dumps(res))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_())
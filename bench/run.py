@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+bench/run.py
+- For each size: generate the data set (seeded, written to a temp NDJSON file
+  first so generation is not timed), POST it to /import, then export the
+  busiest month as detail, summary, spares and bundle with the export cache
+  cleared before each, all in-process through the ASGI test client.
+  --gzip sends the file gzipped (compressed before the clock starts), as the
+  app does: the import stage then includes the decompression.
+- Every stage records wall seconds and the peak of traced memory it added (MB,
+  tracemalloc; the data already held by the store is not counted). Results are
+  written as JSON; with --baseline they are compared stage by stage and the
+  exit status is 1 when a stage is slower / bigger than the allowed ratio.
+- The store runs in memory unless --backend sqlite (a temp database file);
+  data.db is never touched.
+"""
+import argparse, gzip, json, os, platform, sys, tempfile, time, tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.datagen import generate
+
+EXPORTS = ("detail", "summary", "spares", "bundle")
+CHUNK = 1 << 20
+
+def _measure(fn: Callable[[], Any]) -> Tuple[Any, Dict[str, float]]:
+    """Run `fn`; wall seconds and peak traced memory above what was allocated before it."""
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+    t0 = time.perf_counter()
+    out = fn()
+    seconds = time.perf_counter() - t0
+    if not tracing:
+        return out, {"seconds": round(seconds, 4)}
+    _, peak = tracemalloc.get_traced_memory()
+    return out, {"seconds": round(seconds, 4), "peak_mb": round((peak - start) / 2**20, 2)}
+
+def _file_chunks(path: str):
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(CHUNK)
+            if not b:
+                return
+            yield b
+
+def run_size(client, main, works: int, seed: int, months: int, compress: bool = False) -> Dict[str, Any]:
+    gen = generate(works, seed=seed, months=months)
+    headers = {"content-type": "application/x-ndjson"}
+    with tempfile.NamedTemporaryFile("wb", suffix=".ndjson", delete=False) as f:
+        out_f = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) if compress else f
+        for chunk in gen.ndjson():
+            out_f.write(chunk)
+        if compress:
+            out_f.close()
+            headers["content-encoding"] = "gzip"
+        path = f.name
+    try:
+        size = os.path.getsize(path)
+        r, stage = _measure(lambda: client.post("/import", content=_file_chunks(path), headers=headers))
+    finally:
+        os.unlink(path)
+    if r.status_code != 200:
+        raise RuntimeError(f"/import {r.status_code}: {r.text[:300]}")
+    counts, stats = r.json()["counts"], r.json()["ingest"]
+    out: Dict[str, Any] = {"works": works, "counts": counts, "month": gen.busiest_month(),
+                           "stages": {"import": {**stage, "mb": round(stats["bytes"] / 2**20, 2),
+                                                 "wire_mb": round(size / 2**20, 2),
+                                                 "records": sum(counts.values())}}}
+    for kind in EXPORTS:
+        main.EXPORT_CACHE.clear()
+        r, stage = _measure(lambda: client.get(f"/export/{kind}", params={"month": out["month"]}))
+        if r.status_code != 200:
+            raise RuntimeError(f"/export/{kind} {r.status_code}: {r.text[:300]}")
+        out["stages"][f"export/{kind}"] = {**stage, "bytes": len(r.content)}
+    return out
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], max_time: float, max_mem: float,
+            min_seconds: float) -> List[str]:
+    """Regressions against `baseline`, as readable lines."""
+    bad = []
+    # traced and untraced runs are not comparable in time
+    timed = results["meta"].get("tracemalloc", True) == baseline.get("meta", {}).get("tracemalloc", True)
+    for size, res in results["sizes"].items():
+        base = baseline.get("sizes", {}).get(size)
+        if not base:
+            continue
+        for name, st in res["stages"].items():
+            b = base["stages"].get(name)
+            if not b:
+                continue
+            if timed and st["seconds"] > min_seconds and st["seconds"] > b["seconds"] * (1 + max_time):
+                bad.append(f"{size} {name}: {st['seconds']:.3f}s vs {b['seconds']:.3f}s")
+            if "peak_mb" in st and "peak_mb" in b and st["peak_mb"] > 1 and st["peak_mb"] > b["peak_mb"] * (1 + max_mem):
+                bad.append(f"{size} {name}: {st['peak_mb']:.1f} MB vs {b['peak_mb']:.1f} MB")
+    return bad
+
+def main_(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="1000,10000", help="works per run, comma separated (e.g. 1000,100000,1000000)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--months", type=int, default=12, help="months the works are spread over")
+    ap.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    ap.add_argument("--out", default="bench-results.json")
+    ap.add_argument("--baseline", help="results file to compare against")
+    ap.add_argument("--max-slowdown", type=float, default=0.25, help="allowed extra time, as a fraction")
+    ap.add_argument("--max-memory", type=float, default=0.25, help="allowed extra peak memory, as a fraction")
+    ap.add_argument("--min-seconds", type=float, default=0.05, help="stages faster than this never regress")
+    ap.add_argument("--no-memory", action="store_true",
+                    help="do not trace memory (tracemalloc slows allocation-heavy stages several times)")
+    ap.add_argument("--gzip", action="store_true", help="send the import gzipped (Content-Encoding: gzip)")
+    args = ap.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    tmpdir = tempfile.mkdtemp(prefix="locations-bench-")
+    os.environ["STORE_BACKEND"] = args.backend
+    os.environ["LOCATIONS_DB"] = os.path.join(tmpdir, "bench.db")
+    os.chdir(ROOT)
+    import main                                  # after the environment is set
+    from fastapi.testclient import TestClient
+
+    results: Dict[str, Any] = {
+        "meta": {"when": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "backend": args.backend, "seed": args.seed, "months": args.months,
+                 "tracemalloc": not args.no_memory, "gzip": args.gzip},
+        "sizes": {},
+    }
+    if not args.no_memory:
+        tracemalloc.start()
+    with TestClient(main.app) as client:
+        run_size(client, main, 200, args.seed, args.months)     # warm-up: templates, caches, imports
+        for n in sizes:
+            res = run_size(client, main, n, args.seed, args.months, args.gzip)
+            results["sizes"][str(n)] = res
+            print(f"{n:>9} works  " + "  ".join(f"{k} {v['seconds']:.2f}s" + (f"/{v['peak_mb']:.0f}MB" if "peak_mb" in v else "")
+                                                  for k, v in res["stages"].items()), flush=True)
+    tracemalloc.stop()
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+    print(f"results: {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        bad = compare(results, baseline, args.max_slowdown, args.max_memory, args.min_seconds)
+        for line in bad:
+            print("REGRESSION", line)
+        if bad:
+            return 1
+        print("no regressions against", args.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+browse.py
+- Read API behind GET /works and GET /emergencies: stored records filtered by
+  month / date range, region, site, job type and executor, a page at a time,
+  newest first (or oldest first).
+- RecordIndex is a store index of posting lists: for every kind, field and
+  value, the matching records of each month sorted by (date, savedAt), the
+  keys the store partitions use. A query walks one list, the first field of
+  FIELDS it filters on (the most selective), and checks the other filters on
+  the records it meets: a page costs its own size plus the non-matches it
+  skips, never a scan of the store.
+- Region and site match as the registry resolves them (spelling variants are
+  one value; unknown names match their textnorm.fold()), job type and
+  executor as their fold().
+- Keyset pagination: the cursor holds the (month, date, savedAt) key of the
+  last record returned and how many records with that key were returned, so
+  pages stay in place while writes land between requests.
+"""
+import base64, json
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from registry import REGISTRY
+from store import date_key, month_of, sort_key, ts_key
+from textnorm import fold
+
+ALL = ""                # the field whose one list holds every record of the kind
+FIELDS: Dict[str, Tuple[str, ...]] = {
+    "works": ("site", "executor", "jobType", "region"),
+    "emergencies": ("site", "region"),
+}
+
+def _site(v: Any) -> str:
+    return (REGISTRY.site(v) or fold(v)) if isinstance(v, str) else ""
+
+def _region(v: Any) -> str:
+    return (REGISTRY.region(v) or fold(v)) if isinstance(v, str) else ""
+
+def _text(v: Any) -> str:
+    return fold(v) if isinstance(v, str) else ""
+
+KEYS: Dict[str, Callable[[Any], str]] = {"site": _site, "region": _region, "jobType": _text, "executor": _text}
+
+class BadCursor(ValueError):
+    pass
+
+class _Postings:
+    """Records of one month with one field value, sorted by (date, savedAt). Replaced, never changed, once published."""
+    __slots__ = ("keys", "recs")
+
+    def __init__(self, keys: Optional[List[Tuple[int, int]]] = None, recs: Optional[List[Dict[str, Any]]] = None):
+        self.keys: List[Tuple[int, int]] = keys if keys is not None else []
+        self.recs: List[Dict[str, Any]] = recs if recs is not None else []
+
+    def copy(self) -> "_Postings":
+        return _Postings(list(self.keys), list(self.recs))
+
+    def insert(self, key: Tuple[int, int], rec: Dict[str, Any]):
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.recs.insert(i, rec)
+
+    def remove(self, key: Tuple[int, int], rec: Dict[str, Any]):
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.recs[i] is rec:
+                del self.keys[i]
+                del self.recs[i]
+                return
+            i += 1
+
+    def entries(self) -> List[Tuple[Tuple[int, int], int]]:
+        """(key, record identity) in a canonical order, for verify()."""
+        return sorted(zip(self.keys, map(id, self.recs)))
+
+Lists = Dict[str, Dict[str, Dict[str, Dict[str, _Postings]]]]     # kind -> field -> value -> month -> postings
+
+def _values(kind: str, rec: Dict[str, Any]) -> Iterable[Tuple[str, str]]:
+    yield ALL, ""
+    for f in FIELDS[kind]:
+        v = KEYS[f](rec.get(f))
+        if v:
+            yield f, v
+
+def _build(recs: Dict[str, Iterable[Dict[str, Any]]]) -> Lists:
+    out: Lists = {}
+    for kind in FIELDS:
+        fields = [(f, KEYS[f], {}) for f in FIELDS[kind]]     # with a memo: the same few hundred values repeat
+        days: Dict[Any, Tuple[str, int]] = {}
+        rows: Dict[Tuple[str, str, str], List[Tuple[Tuple[int, int], Dict[str, Any]]]] = {}
+        for rec in recs.get(kind) or ():
+            d = rec.get("date")
+            try:
+                m, dk = days[d]
+            except (KeyError, TypeError):
+                m, dk = month_of(rec), date_key(d)
+                if isinstance(d, str):
+                    days[d] = m, dk
+            item = ((dk, ts_key(rec.get("savedAt"))), rec)      # sort_key(rec)
+            rows.setdefault((ALL, "", m), []).append(item)
+            for f, key_of, memo in fields:
+                raw = rec.get(f)
+                try:
+                    v = memo[raw]
+                except (KeyError, TypeError):
+                    v = key_of(raw)
+                    if isinstance(raw, str):
+                        memo[raw] = v
+                if v:
+                    rows.setdefault((f, v, m), []).append(item)
+        lists: Dict[str, Dict[str, Dict[str, _Postings]]] = {}
+        for (f, v, m), items in rows.items():
+            items.sort(key=itemgetter(0))
+            lists.setdefault(f, {}).setdefault(v, {})[m] = _Postings([k for k, _ in items], [r for _, r in items])
+        out[kind] = lists
+    return out
+
+def encode_cursor(m: str, key: Tuple[int, int], seen: int) -> str:
+    raw = json.dumps([m, key[0], key[1], seen], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, Tuple[int, int], int]:
+    try:
+        m, d, ts, seen = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(m, str) and all(type(x) is int for x in (d, ts, seen)) and seen > 0:
+            return m, (d, ts), seen
+    except (ValueError, TypeError):
+        pass
+    raise BadCursor("invalid cursor")
+
+class RecordIndex:
+    """Store index of the posting lists the read API pages through."""
+    name = "browse"
+
+    def __init__(self):
+        self._lists: Lists = {k: {} for k in FIELDS}
+
+    def rebuild(self, recs: Dict[str, Iterable[Dict[str, Any]]]):
+        self._lists = _build(recs)
+
+    def state(self) -> Lists:
+        return {k: {f: {v: dict(ms) for v, ms in byval.items()} for f, byval in lists.items()}
+                for k, lists in self._lists.items()}
+
+    def restore(self, state: Lists):
+        self._lists = state
+
+    def update(self, kind: str, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]):
+        if kind not in FIELDS:
+            return
+        lists = self._lists[kind]
+        staged: Dict[Tuple[str, str, str], _Postings] = {}
+
+        def postings(f: str, v: str, m: str) -> _Postings:
+            p = staged.get((f, v, m))
+            if p is None:
+                cur = lists.get(f, {}).get(v, {}).get(m)
+                p = staged[(f, v, m)] = cur.copy() if cur is not None else _Postings()
+            return p
+
+        for rec in removed:
+            m, key = month_of(rec), sort_key(rec)
+            for f, v in _values(kind, rec):
+                postings(f, v, m).remove(key, rec)
+        for rec in added:
+            m, key = month_of(rec), sort_key(rec)
+            for f, v in _values(kind, rec):
+                postings(f, v, m).insert(key, rec)
+        for (f, v, m), p in staged.items():
+            byval = lists.setdefault(f, {})
+            if p.keys:
+                byval.setdefault(v, {})[m] = p
+            elif v in byval:
+                byval[v].pop(m, None)
+                if not byval[v]:
+                    del byval[v]
+
+    def verify(self, recs: Dict[str, Iterable[Dict[str, Any]]], repair: bool = False) -> List[str]:
+        """Lists (as kind/field/value) that differ from the raw records; rebuilt when `repair`."""
+        fresh = _build(recs)
+        bad = []
+        for kind in FIELDS:
+            a, b = self._lists.get(kind, {}), fresh[kind]
+            for f in sorted(set(a) | set(b)):
+                fa, fb = a.get(f, {}), b.get(f, {})
+                for v in sorted(set(fa) | set(fb)):
+                    ma, mb = fa.get(v, {}), fb.get(v, {})
+                    if set(ma) != set(mb) or any(ma[m].entries() != mb[m].entries() for m in ma):
+                        bad.append(f"{kind}/{f}/{v}")
+        if repair and bad:
+            self._lists = fresh
+        return bad
+
+    # -------- reads ----------
+    def page(self, kind: str, filters: Dict[str, str], months: Optional[Sequence[str]] = None,
+             dates: Tuple[int, int] = (0, 0), newest_first: bool = True, limit: int = 50,
+             cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Up to `limit` records of `kind` matching `filters` ({field: value}, fields of
+        FIELDS[kind]), within `months` and the date keys `dates` (inclusive; 0 is open),
+        and the cursor of the next page: None once the records ran out (a full page
+        may still be followed by an empty one).
+        """
+        want = {f: KEYS[f](v) for f, v in filters.items() if v}
+        lead = next((f for f in FIELDS[kind] if want.get(f)), ALL)
+        lead_value = want.pop(lead, "")
+        rest = [(KEYS[f], f, v) for f, v in want.items()]
+        by_month = self._lists[kind].get(lead, {}).get(lead_value, {})
+        ms = sorted(by_month if months is None else set(months) & set(by_month), reverse=newest_first)
+        after = decode_cursor(cursor) if cursor else None
+        lo, hi = dates
+        out: List[Dict[str, Any]] = []
+        for m in ms:
+            if after is not None and (m > after[0] if newest_first else m < after[0]):
+                continue        # pages already served
+            p = by_month.get(m)
+            if p is None:
+                continue
+            keys, recs = p.keys, p.recs
+            start = bisect_left(keys, (lo,)) if lo else 0
+            end = bisect_left(keys, (hi + 1,)) if hi else len(keys)
+            if after is not None and m == after[0]:
+                if newest_first:
+                    end = min(end, bisect_right(keys, after[1]) - after[2])
+                else:
+                    start = max(start, bisect_left(keys, after[1]) + after[2])
+            for i in (range(end - 1, start - 1, -1) if newest_first else range(start, end)):
+                rec = recs[i]
+                if rest and not all(key(rec.get(f)) == v for key, f, v in rest):
+                    continue
+                out.append(rec)
+                if len(out) == limit:
+                    k = keys[i]
+                    seen = bisect_right(keys, k) - i if newest_first else i - bisect_left(keys, k) + 1
+                    return out, encode_cursor(m, k, seen)
+        return out, None
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+compact.py
+- Compact in-memory form of the stored records. As plain dicts every work
+  carries its own hash table of ~25 keys, nested dicts for spares / grid /
+  emergency, and its own copies of strings that repeat in every record
+  (region, site, job type, people, dates).
+- CompactRecord keeps the values in one tuple and points to a shape: the
+  key -> position table shared by every record posted with the same keys
+  (the app always posts the same ones). Nested objects become CompactRecords
+  and lists tuples; values of the INTERNED keys are interned, so each
+  distinct name or date exists once however many records use it.
+- Records are read-only Mappings, so the store, its indexes and the reports
+  read them with .get() as before; plain() gives back the posted JSON.
+- python -m bench.memory measures the saving against the dict form.
+"""
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Tuple
+
+# keys whose values repeat across records: catalog names, people, dates
+INTERNED = frozenset((
+    "date", "weekday", "region", "site", "siteOwner", "jobType", "executor", "driver",
+    "etype", "name", "alarm", "source", "category",
+))
+MAX_SHAPES = 1024       # past this, unusual key sets get a layout of their own instead of a shared one
+
+_intern = sys.intern
+_SHAPES: Dict[Tuple[str, ...], Dict[str, int]] = {}
+
+def shape(keys: Tuple[str, ...]) -> Dict[str, int]:
+    """Shared key -> position table of the records posted with these keys, in this order."""
+    s = _SHAPES.get(keys)
+    if s is None:
+        s = {_intern(k): i for i, k in enumerate(keys)}
+        if len(_SHAPES) < MAX_SHAPES:
+            s = _SHAPES.setdefault(keys, s)
+    return s
+
+class CompactRecord(Mapping):
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index: Dict[str, int], values: Tuple[Any, ...]):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key: str) -> Any:
+        return self._values[self._index[key]]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __reduce__(self):
+        # pickled for export workers and snapshots: the key table is memoized, written once per pickle
+        return CompactRecord, (self._index, self._values)
+
+    def __repr__(self) -> str:
+        return f"CompactRecord({plain(self)!r})"
+
+def _list(key: str, items: List[Any]) -> Tuple[Any, ...]:
+    return tuple([compact(x) if type(x) is dict else (_intern(x) if type(x) is str and key in INTERNED else x)
+                  for x in items])
+
+def compact(rec: Any) -> Any:
+    """Compact form of a posted record (dict); anything else is returned as is."""
+    if type(rec) is not dict:
+        return rec
+    values = []
+    for k, v in rec.items():
+        t = type(v)         # json gives exact types; subclasses are kept as they are
+        if t is str:
+            if k in INTERNED:
+                v = _intern(v)
+        elif t is dict:
+            v = compact(v)
+        elif t is list:
+            v = _list(k, v)
+        values.append(v)
+    return CompactRecord(shape(tuple(rec)), tuple(values))
+
+def plain(v: Any) -> Any:
+    """The posted JSON value of a compact record (dicts and lists again)."""
+    if isinstance(v, CompactRecord):
+        return {k: plain(x) for k, x in zip(v._index, v._values)}
+    if isinstance(v, tuple):
+        return [plain(x) for x in v]
+    return v
+
+def json_default(v: Any) -> Any:
+    """json.dumps(default=...) for structures holding compact records (tuples already serialize as lists)."""
+    return dict(zip(v._index, v._values)) if isinstance(v, CompactRecord) else str(v)
@@ -9,17 +9,35 @@ db.py
   python db.py --init        -> ????? ???????
   python db.py --seed-sites  -> ????? ????? ???????
   python db.py --stats       -> ??????? ?????
+  python db.py --load FILE [--replace]
+                             -> stream an /import body (JSON, NDJSON, .gz) into the
+                                tables in one transaction; prints rows per second
 """
 
-import sys, os, datetime as dt
-from typing import Optional
+import sys, os, gzip, time, uuid, datetime as dt
+from typing import Any, Dict, Iterable, Optional
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Date, Float, Boolean, Text, ForeignKey, DateTime
+    create_engine, event, insert, text, Column, Integer, String, Date, Float, Boolean, Text, ForeignKey, DateTime, Index
 )
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "data.db")
-ENGINE = create_engine(f"sqlite:///{DB_PATH}", echo=False, future=True)
+DB_PATH = os.environ.get("LOCATIONS_DB") or os.path.join(os.path.dirname(__file__), "data.db")
+# QueuePool of thread-shareable connections so exports and imports do not queue on one handle
+ENGINE = create_engine(
+    f"sqlite:///{DB_PATH}", echo=False, future=True,
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "5")), max_overflow=10, pool_pre_ping=False,
+)
+
+@event.listens_for(ENGINE, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL: readers never block the writer and vice versa
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=30000")
+    cur.close()
+
 SessionLocal = sessionmaker(bind=ENGINE, autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 
@@ -66,8 +84,16 @@ class Work(Base):
     driver   = Column(String(120))
     notes    = Column(Text)
 
+    uid     = Column(String(64), unique=True, index=True)   # record id used by the API
+    payload = Column(Text)                                  # record as posted by the app (JSON)
+
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_works_date", "date"),
+        Index("ix_works_region_site", "region", "site_id"),
+    )
+
     grid_reading = relationship("GridReading", back_populates="work", uselist=False)
     spares       = relationship("Spare", back_populates="work")
     emergencies  = relationship("Emergency", back_populates="linked_work")
@@ -85,6 +111,9 @@ class GridReading(Base):
     kwhr      = Column(Float, default=0.0)
     hours     = Column(Float, default=0.0)
 
+    uid       = Column(String(64), unique=True, index=True)
+    payload   = Column(Text)
+
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
 class Spare(Base):
@@ -115,8 +144,15 @@ class Emergency(Base):
     linked_work_id = Column(Integer, ForeignKey("works.id"), nullable=True) # ??? ?????+???????+??????
     linked_work    = relationship("Work", back_populates="emergencies")
 
+    uid      = Column(String(64), unique=True, index=True)
+    payload  = Column(Text)
+
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_emergencies_date", "date"),
+    )
+
 class UserAction(Base):
     __tablename__ = "user_actions"
     id        = Column(Integer, primary_key=True)
@@ -125,10 +161,64 @@ class UserAction(Base):
     payload   = Column(Text)                        # JSON/?? ?????
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
+class StoreMeta(Base):
+    """API store state shared by the worker processes: epoch, generation, floor (sqlstore.py)."""
+    __tablename__ = "store_meta"
+    key   = Column(String(40), primary_key=True)
+    value = Column(Text, nullable=False)
+
+class StoreChange(Base):
+    """Record ids written by each generation, so other workers can replay them."""
+    __tablename__ = "store_changes"
+    id   = Column(Integer, primary_key=True)
+    gen  = Column(Integer, nullable=False, index=True)
+    kind = Column(String(20), nullable=False)      # works/emergencies/grid
+    uid  = Column(String(64), nullable=False)
+    op   = Column(String(10), nullable=False)      # upsert/delete
+
 # ---------------------- Utilities ----------------------
 
 def init_db():
-    Base.metadata.create_all(ENGINE)
+    # several workers may start on a new data.db together: the first takes the
+    # write lock and creates/migrates, the others wait and find it done
+    with ENGINE.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        Base.metadata.create_all(conn)
+        _migrate(conn)
+        conn.commit()
+
+# columns/indexes added after data.db was first created (create_all does not alter tables)
+_ADDED_COLUMNS = {
+    "works":         [("uid", "VARCHAR(64)"), ("payload", "TEXT")],
+    "grid_readings": [("uid", "VARCHAR(64)"), ("payload", "TEXT")],
+    "emergencies":   [("uid", "VARCHAR(64)"), ("payload", "TEXT")],
+}
+_ADDED_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_works_uid ON works (uid)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_grid_readings_uid ON grid_readings (uid)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_emergencies_uid ON emergencies (uid)",
+    "CREATE INDEX IF NOT EXISTS ix_works_date ON works (date)",
+    "CREATE INDEX IF NOT EXISTS ix_works_region_site ON works (region, site_id)",
+    "CREATE INDEX IF NOT EXISTS ix_emergencies_date ON emergencies (date)",
+]
+
+def _migrate(conn):
+    for table, cols in _ADDED_COLUMNS.items():
+        have = {r[1] for r in conn.execute(text(f"PRAGMA table_info({table})"))}
+        for name, typ in cols:
+            if name not in have:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {typ}"))
+    for ddl in _ADDED_INDEXES:
+        conn.execute(text(ddl))
+    # rows written before ids existed get a stable one
+    for table in _ADDED_COLUMNS:
+        conn.execute(text(f"UPDATE {table} SET uid = 'db-' || id WHERE uid IS NULL"))
+    conn.execute(text("INSERT OR IGNORE INTO store_meta (key, value) VALUES "
+                      "('epoch', :epoch), ('generation', '0'), ('floor', '0')"),
+                 {"epoch": uuid.uuid4().hex[:8]})
+    # generation of the last full replacement; databases from before it take the floor (at or after it)
+    conn.execute(text("INSERT OR IGNORE INTO store_meta (key, value) "
+                      "SELECT 'replaced', value FROM store_meta WHERE key = 'floor'"))
 
 def seed_sites(default_region: str = "???????"):
     sites_list = [
@@ -147,12 +237,95 @@ def seed_sites(default_region: str = "???????"):
         "???? ????","?????? ????","????-2","????-3","????-4","????-5","????-6","????? ????","??? ????","??? ?????",
         "????? ??????","?????","??? ?????","??? ??????","??? ??????","??? ?????","???????","??? ????","??? ???","???","??? ?????"
     ]
-    with SessionLocal() as s:
-        for name in sites_list:
-            exists = s.query(Site).filter(Site.name == name).first()
-            if not exists:
-                s.add(Site(name=name, region=default_region))
-        s.commit()
+    return insert_sites(sites_list, default_region)
+
+def insert_sites(names: Iterable[str], region: str) -> int:
+    """Add the sites not stored yet in one INSERT OR IGNORE statement; returns how many were new."""
+    now = dt.datetime.utcnow()
+    rows = [{"name": n, "region": region, "created_at": now} for n in dict.fromkeys(names)]
+    if not rows:
+        return 0
+    with ENGINE.begin() as conn:
+        return conn.execute(insert(Site.__table__).prefix_with("OR IGNORE").values(rows)).rowcount
+
+# ---------------------- Bulk load ----------------------
+
+LOAD_BATCH = 5000           # records per round of batched inserts
+LOAD_CHUNK = 1 << 20        # bytes read from the file at a time
+# for the load connection only: a 256 MB page cache keeps the uid indexes of years
+# of history in memory, temp b-trees stay in RAM; the load is one transaction
+LOAD_PRAGMAS = ("PRAGMA cache_size=-262144", "PRAGMA temp_store=MEMORY")
+
+def load_file(path: str, replace: bool = False, progress_every: int = 50000) -> Dict[str, Any]:
+    """
+    Stream an /import body into the tables, as the API stores it (sqlstore), in one
+    transaction: a JSON document, or NDJSON when the name ends in .ndjson / .jsonl
+    (.gz files are read compressed). Records are upserted by id; `replace` empties the
+    tables first, as /import does. Running API workers reload everything afterwards.
+    """
+    # imported here: they import the store, and sqlstore imports this module
+    from ingest import JsonParser, NdjsonParser
+    from sqlstore import SqlBackend
+    from store import KINDS, client_id, record_id
+
+    name = path[:-3] if path.endswith(".gz") else path
+    parser = NdjsonParser() if name.endswith((".ndjson", ".jsonl")) else JsonParser()
+    bulk = SqlBackend().bulk(replace=replace, pragmas=LOAD_PRAGMAS)
+    t0 = time.perf_counter()
+    seen: Dict[str, set] = {k: set() for k in KINDS}
+    pending: Dict[str, Dict[str, Any]] = {k: {} for k in KINDS}
+    replaced: Dict[str, list] = {k: [] for k in KINDS}
+    counts = {k: 0 for k in KINDS}
+    size = total = 0
+
+    def flush():
+        nonlocal size
+        for kind in KINDS:
+            if pending[kind] or replaced[kind]:
+                bulk.add(kind, list(pending[kind].items()), replaced[kind])
+                pending[kind], replaced[kind] = {}, []
+        size = 0
+
+    try:
+        with (gzip.open if path.endswith(".gz") else open)(path, "rb") as f:
+            while True:
+                chunk = f.read(LOAD_CHUNK)
+                for kind, rec in (parser.feed(chunk) if chunk else parser.close()):
+                    if not isinstance(rec, dict):
+                        parser.rejected += 1
+                        continue
+                    # ids as the API's store.Loader gives them
+                    rid = record_id(rec)
+                    if rid in seen[kind] and client_id(rec) is None:
+                        n = 2
+                        while f"{rid}-{n}" in seen[kind]:
+                            n += 1
+                        rid = f"{rid}-{n}"
+                    if rid in seen[kind] and pending[kind].pop(rid, None) is None:
+                        replaced[kind].append(rid)      # a repeated id: the last copy wins
+                    seen[kind].add(rid)
+                    pending[kind][rid] = rec
+                    counts[kind] += 1
+                    size += 1
+                    total += 1
+                    if progress_every and total % progress_every == 0:
+                        secs = time.perf_counter() - t0
+                        print(f"  {total} records, {total / secs:.0f}/s", file=sys.stderr, flush=True)
+                if size >= LOAD_BATCH:
+                    flush()
+                if not chunk:
+                    break
+        flush()
+    except BaseException:
+        bulk.rollback()
+        raise
+    gen = bulk.commit()
+    secs = max(time.perf_counter() - t0, 1e-9)
+    with ENGINE.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")    # fold the load back into data.db
+    return {"records": counts, "rejected": parser.rejected, "rows": bulk.rows, "seconds": round(secs, 2),
+            "records_per_s": round(total / secs), "rows_per_s": round(bulk.rows / secs),
+            "generation": gen}
 
 def stats():
     with SessionLocal() as s:
@@ -172,12 +345,17 @@ if __name__ == "__main__":
         print("OK: tables created in data.db")
     elif cmd == "--seed-sites":
         init_db()
-        seed_sites(default_region="???????")
-        print("OK: sites seeded")
+        n = seed_sites(default_region="???????")
+        print(f"OK: sites seeded ({n} new)")
     elif cmd == "--stats":
         stats()
+    elif cmd == "--load" and len(sys.argv) > 2:
+        res = load_file(sys.argv[2], replace="--replace" in sys.argv[3:])
+        print(f"OK: {res['records']} records ({res['rejected']} rejected), {res['rows']} rows "
+              f"in {res['seconds']}s: {res['rows_per_s']} rows/s, {res['records_per_s']} records/s")
     else:
         print("Usage:")
         print("  python db.py --init")
         print("  python db.py --seed-sites")
-        print("  python db.py --stats")
\ No newline at end of file
+        print("  python db.py --stats")
+        print("  python db.py --load FILE [--replace]")
\ No newline at end of file
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+export_cache.py
+- LRU cache of generated export files (xlsx bytes).
+- One entry per (kind, month); it is valid for one "version" string built from
+  the month's data version and the template digest, so a write to another month
+  never evicts it and a write to this month makes it stale at once.
+- Size-capped in bytes; the least recently served entry goes first.
+- Concurrent requests for the same missing entry render it once.
+"""
+import hashlib, threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+class ExportCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[str, bytes]]" = OrderedDict()
+        self._building: Dict[Hashable, List] = {}       # key -> [lock, requests holding or waiting on it]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def etag(key: Hashable, version: str) -> str:
+        return '"' + hashlib.sha1(repr((key, version)).encode("utf-8")).hexdigest()[:24] + '"'
+
+    def get(self, key: Hashable, version: str) -> Optional[bytes]:
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None or hit[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return hit[1]
+
+    def put(self, key: Hashable, version: str, data: bytes):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (version, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+                self.evictions += 1
+
+    def get_or_build(self, key: Hashable, version: str, build: Callable[[], bytes]) -> bytes:
+        data = self.get(key, version)
+        if data is not None:
+            return data
+        with self._lock:
+            gate = self._building.setdefault(key, [threading.Lock(), 0])
+            gate[1] += 1
+        try:
+            with gate[0]:
+                data = self.get(key, version)      # built by the request we waited for
+                if data is not None:
+                    return data
+                with self._lock:
+                    self.misses += 1
+                data = build()
+                self.put(key, version, data)
+                return data
+        finally:
+            with self._lock:
+                gate[1] -= 1
+                if not gate[1]:             # the last one out: keys (month ranges) are unbounded
+                    del self._building[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+export_jobs.py
+- Background export jobs: reports are rendered in a ProcessPoolExecutor, so
+  openpyxl work uses every core and never holds the API process's GIL.
+- A job gets the month's records (compact.CompactRecord lists, pickled) or
+  its maintained counters (summary, spares) and a template path;
+  workers report progress through a small shared dict (multiprocessing.Manager).
+- Finished files stay in memory until they expire (EXPORT_JOB_TTL seconds, at
+  most EXPORT_JOB_KEEP jobs).
+"""
+import multiprocessing as mp
+import os, threading, time, uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import reports
+
+@dataclass
+class ExportJob:
+    id: str
+    kind: str
+    month: str
+    version: str
+    status: str = "queued"              # queued -> running -> done | failed
+    progress: float = 0.0
+    error: str = ""
+    data: Optional[bytes] = None
+    created: float = field(default_factory=time.time)
+    finished: float = 0.0
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "kind": self.kind, "month": self.month,
+            "status": self.status, "progress": round(self.progress, 3), "error": self.error,
+            "seconds": round((self.finished or time.time()) - self.created, 3),
+            "bytes": len(self.data) if self.data is not None else 0,
+        }
+
+def _run(job_id: str, kind: str, tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+         agg, shared) -> bytes:
+    """Worker side: render one report, publishing progress in `shared[job_id]` for jobs."""
+    if not job_id:
+        return reports.render(kind, tpath, works, emerg, agg=agg)
+    shared[job_id] = 0.0
+    data = reports.render(kind, tpath, works, emerg, lambda f: shared.__setitem__(job_id, min(f, 0.99)), agg)
+    shared[job_id] = 1.0
+    return data
+
+class ExportJobs:
+    def __init__(self, workers: int, keep: int = 200, ttl: float = 3600.0):
+        self.workers = workers
+        self.keep = keep
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ExportJob] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._shared = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        # started on first use: spawn (not fork) because the API process runs threads
+        if self._pool is None:
+            ctx = mp.get_context("spawn")
+            self._manager = ctx.Manager()
+            self._shared = self._manager.dict()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        return self._pool
+
+    def submit(self, kind: str, month: str, version: str, tpath: str,
+               works: List[Dict[str, Any]], emerg: List[Dict[str, Any]], agg=None,
+               cached: Optional[bytes] = None,
+               on_done: Optional[Callable[[ExportJob], None]] = None) -> ExportJob:
+        """Queue a report; `cached` bytes (same version) finish the job at once."""
+        job = ExportJob(id=uuid.uuid4().hex, kind=kind, month=month, version=version)
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        if cached is not None:
+            self._finish(job, cached, None)
+            return job
+        fut = self.render(kind, tpath, works, emerg, agg, job.id)
+        fut.add_done_callback(lambda f: self._done(job, f, on_done))
+        return job
+
+    def render(self, kind: str, tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+               agg=None, job_id: str = "") -> Future:
+        """Render one report in a worker process; the future's result is the xlsx bytes."""
+        with self._lock:
+            pool = self._executor()
+            return pool.submit(_run, job_id, kind, os.path.abspath(tpath), works, emerg, agg, self._shared)
+
+    def _done(self, job: ExportJob, fut: Future, on_done):
+        try:
+            data = fut.result()
+        except Exception as e:
+            job.status, job.error, job.finished = "failed", f"{type(e).__name__}: {e}", time.time()
+            self._forget(job.id)
+            return
+        self._finish(job, data, on_done)
+
+    def _finish(self, job: ExportJob, data: bytes, on_done):
+        job.data, job.progress, job.finished = data, 1.0, time.time()
+        job.status = "done"
+        self._forget(job.id)
+        if on_done is not None:
+            on_done(job)
+
+    def _forget(self, job_id: str):
+        try:
+            if self._shared is not None:
+                self._shared.pop(job_id, None)
+        except Exception:
+            pass        # manager already shut down
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        job = self._jobs.get(job_id)
+        if job is not None and job.status in ("queued", "running") and self._shared is not None:
+            try:
+                p = self._shared.get(job_id)
+            except Exception:
+                p = None
+            if p is not None:
+                job.status, job.progress = "running", max(job.progress, p)
+        return job
+
+    def _expire(self):
+        now = time.time()
+        for jid, job in list(self._jobs.items()):
+            if job.finished and now - job.finished > self.ttl:
+                del self._jobs[jid]
+        if len(self._jobs) > self.keep:
+            done = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished)
+            for job in done[:len(self._jobs) - self.keep]:
+                del self._jobs[job.id]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._manager.shutdown()
+            self._pool = self._manager = self._shared = None
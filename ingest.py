@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+ingest.py
+- Streaming parsers for /import, so an upload is never held as raw bytes plus a
+  complete object graph at the same time.
+- NdjsonParser: one JSON object per line, {"kind": "works", "record": {...}}
+  (or bare records when the kind is given for the whole stream).
+- JsonParser: the usual {"works": [...], "emergencies": [...], "grid": [...]}
+  document, read element by element as the chunks arrive.
+- Both return (kind, record) pairs from feed(chunk); ingest() batches them into
+  a store Loader.
+- Bodies may be sent with Content-Encoding gzip or deflate (zstd when the
+  zstandard package is installed); Inflater undoes it chunk by chunk, in
+  pieces of at most PIECE bytes, so a small upload cannot expand into memory.
+- NDJSON lines are decoded with orjson when it is installed (json otherwise).
+  The JSON document parser needs the stdlib's incremental raw_decode.
+"""
+import codecs, json, re, time, zlib
+from typing import Any, AsyncIterable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import BYTES, RECORDS, count, observe
+from store import KINDS
+
+try:
+    import orjson
+    _loads = orjson.loads
+    DECODER = "orjson"
+except ImportError:
+    _loads = json.loads
+    DECODER = "json"
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BATCH = 1000                    # records handed to the loader at a time
+MAX_VALUE = 16 * 1024 * 1024    # largest single record we wait for
+PIECE = 1 << 20                 # most bytes one compressed chunk is expanded to at a time
+
+_WS = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+class IngestError(ValueError):
+    """Malformed upload; the message says where."""
+
+class UnsupportedEncoding(IngestError):
+    """Content-Encoding we cannot undo."""
+
+class _Zlib:
+    """gzip (wbits 31) or deflate (zlib stream, wbits 15), expanded PIECE bytes at a time."""
+    def __init__(self, wbits: int):
+        self.wbits = wbits
+        self.obj = zlib.decompressobj(wbits)
+
+    def run(self, data: bytes) -> Iterator[bytes]:
+        while data:
+            if self.obj.eof:
+                if not data.strip(b"\0"):
+                    return          # padding after the last member
+                self.obj = zlib.decompressobj(self.wbits)     # concatenated gzip members
+            try:
+                out = self.obj.decompress(data, PIECE)
+            except zlib.error as e:
+                raise IngestError(f"bad compressed body: {e}") from None
+            data = self.obj.unused_data if self.obj.eof else self.obj.unconsumed_tail
+            if out:
+                yield out
+
+    @property
+    def done(self) -> bool:
+        return self.obj.eof
+
+class _Zstd:
+    def __init__(self):
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+        self.done = True        # zstd frames say nothing of the body ending early
+
+    def run(self, data: bytes) -> Iterator[bytes]:
+        try:
+            out = self.obj.decompress(data)
+        except zstandard.ZstdError as e:
+            raise IngestError(f"bad compressed body: {e}") from None
+        if out:
+            yield out
+
+class Inflater:
+    """Undoes a request Content-Encoding ("gzip", "deflate", "zstd", or a list of them)."""
+    def __init__(self, encoding: Optional[str]):
+        names = [e.strip().lower() for e in (encoding or "").split(",")]
+        names = ["gzip" if n == "x-gzip" else n for n in names if n and n != "identity"]
+        self.encoding = ",".join(names)
+        self.seconds = 0.0
+        self._steps: List[Any] = []
+        # encodings are listed in the order they were applied: undo them last first
+        for name in reversed(names):
+            if name == "gzip":
+                self._steps.append(_Zlib(16 + zlib.MAX_WBITS))
+            elif name == "deflate":
+                self._steps.append(_Zlib(zlib.MAX_WBITS))
+            elif name == "zstd" and zstandard is not None:
+                self._steps.append(_Zstd())
+            else:
+                raise UnsupportedEncoding(f"unsupported Content-Encoding: {name}")
+
+    def __bool__(self) -> bool:
+        return bool(self._steps)
+
+    def feed(self, chunk: bytes) -> Iterator[bytes]:
+        """Decoded pieces of `chunk`, produced as they are consumed."""
+        pieces: Iterator[bytes] = iter((chunk,))
+        for step in self._steps:
+            pieces = self._timed(step, pieces)
+        return pieces
+
+    def close(self):
+        if not all(step.done for step in self._steps):
+            raise IngestError(f"truncated {self.encoding} body")
+
+    def _timed(self, step, pieces: Iterator[bytes]) -> Iterator[bytes]:
+        for data in pieces:
+            it = step.run(data)
+            while True:
+                t = time.perf_counter()
+                out = next(it, None)
+                self.seconds += time.perf_counter() - t
+                if out is None:
+                    break
+                yield out
+
+Item = Tuple[str, Any]          # (kind, record)
+
+class NdjsonParser:
+    def __init__(self, kind: Optional[str] = None):
+        if kind is not None and kind not in KINDS:
+            raise IngestError(f"unknown kind: {kind}")
+        self.kind = kind
+        self.line = 0
+        self.rejected = 0
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> List[Item]:
+        lines = (self._tail + chunk).split(b"\n")
+        self._tail = lines.pop()
+        return self._parse(lines)
+
+    def close(self) -> List[Item]:
+        tail, self._tail = self._tail, b""
+        return self._parse([tail])
+
+    def _parse(self, lines: List[bytes]) -> List[Item]:
+        out: List[Item] = []
+        for raw in lines:
+            self.line += 1
+            if not raw.strip():
+                continue
+            try:
+                obj = _loads(raw)
+            except ValueError:
+                try:        # orjson refuses what json takes (NaN, integers past 64 bits)
+                    obj = json.loads(raw)
+                except ValueError as e:
+                    raise IngestError(f"line {self.line}: {e}") from None
+            if self.kind is not None:
+                out.append((self.kind, obj))
+            elif isinstance(obj, dict) and obj.get("kind") in KINDS:
+                out.append((obj["kind"], obj.get("record")))
+            else:
+                self.rejected += 1
+        return out
+
+class JsonParser:
+    """Incremental reader of the /import document; values outside the three lists are skipped."""
+    def __init__(self):
+        self.rejected = 0
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> List[Item]:
+        return self._run(self._text.decode(chunk), eof=False)
+
+    def close(self) -> List[Item]:
+        out = self._run(self._text.decode(b"", final=True), eof=True)
+        if self._state != "end":
+            raise IngestError("unexpected end of JSON document")
+        return out
+
+    def _value(self, eof: bool) -> Tuple[bool, Any]:
+        """Decode one value at the cursor; (False, None) when it is not complete yet."""
+        buf, pos = self._buf, self._pos
+        try:
+            val, end = _decoder.raw_decode(buf, pos)
+        except ValueError as e:
+            if eof or len(buf) - pos > MAX_VALUE:
+                raise IngestError(f"invalid JSON at offset {getattr(e, 'pos', pos)}") from None
+            return False, None
+        if end == len(buf) and not eof and buf[pos] in "-0123456789":
+            return False, None      # a number may continue in the next chunk
+        self._pos = end
+        return True, val
+
+    def _run(self, text: str, eof: bool) -> List[Item]:
+        if self._pos > 65536:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        self._buf += text
+        out: List[Item] = []
+        buf = self._buf
+        while True:
+            self._pos = _WS.match(buf, self._pos).end()
+            if self._pos == len(buf):
+                return out
+            ch, st = buf[self._pos], self._state
+            if st == "start":
+                if ch != "{":
+                    raise IngestError("expected a JSON object")
+                self._pos += 1
+                self._state = "key_first"
+            elif st in ("key", "key_first"):
+                if ch == "}" and st == "key_first":
+                    self._pos += 1
+                    self._state = "end"
+                    continue
+                ok, key = self._value(eof)
+                if not ok:
+                    return out
+                if not isinstance(key, str):
+                    raise IngestError(f"expected a key at offset {self._pos}")
+                self._key = key
+                self._state = "colon"
+            elif st == "colon":
+                if ch != ":":
+                    raise IngestError(f"expected ':' at offset {self._pos}")
+                self._pos += 1
+                self._state = "value"
+            elif st == "value":
+                if ch == "[" and self._key in KINDS:
+                    self._pos += 1
+                    self._state = "item_first"
+                    continue
+                ok, val = self._value(eof)      # another key, or a kind that is not a list
+                if not ok:
+                    return out
+                self._state = "next_key"
+            elif st in ("item", "item_first"):
+                if ch == "]" and st == "item_first":
+                    self._pos += 1
+                    self._state = "next_key"
+                    continue
+                ok, val = self._value(eof)
+                if not ok:
+                    return out
+                out.append((self._key, val))
+                self._state = "next_item"
+            elif st == "next_item":
+                if ch == ",":
+                    self._state = "item"
+                elif ch == "]":
+                    self._state = "next_key"
+                else:
+                    raise IngestError(f"expected ',' or ']' at offset {self._pos}")
+                self._pos += 1
+            elif st == "next_key":
+                if ch == ",":
+                    self._state = "key"
+                elif ch == "}":
+                    self._state = "end"
+                else:
+                    raise IngestError(f"expected ',' or '}}' at offset {self._pos}")
+                self._pos += 1
+            else:
+                raise IngestError(f"unexpected data after the JSON document at offset {self._pos}")
+
+async def ingest(chunks: AsyncIterable[bytes], parser, loader, run: Callable,
+                 inflater: Optional[Inflater] = None) -> Dict[str, Any]:
+    """
+    Feed the request stream through `inflater` (Content-Encoding) and `parser`
+    into `loader` in batches of BATCH.
+    `run(fn, *args)` executes the loader calls off the event loop (run_in_threadpool).
+    Returns ingest stats; the caller commits or aborts the loader.
+    """
+    t0 = time.perf_counter()
+    n_wire = n_bytes = n_recs = 0
+    pending: Dict[str, List[Any]] = {k: [] for k in KINDS}
+    size = 0
+    t_parse = t_load = 0.0
+
+    async def flush():
+        nonlocal size, t_load
+        t = time.perf_counter()
+        for kind in KINDS:
+            if pending[kind]:
+                await run(loader.add, kind, pending[kind])
+                pending[kind] = []
+        size = 0
+        t_load += time.perf_counter() - t
+
+    async for chunk in chunks:
+        n_wire += len(chunk)
+        for piece in (inflater.feed(chunk) if inflater else (chunk,)):
+            n_bytes += len(piece)
+            t = time.perf_counter()
+            for kind, rec in parser.feed(piece):
+                pending[kind].append(rec)
+                size += 1
+                n_recs += 1
+            t_parse += time.perf_counter() - t
+            if size >= BATCH:
+                await flush()
+    if inflater:
+        inflater.close()
+    for kind, rec in parser.close():
+        pending[kind].append(rec)
+        n_recs += 1
+    await flush()
+
+    secs = max(time.perf_counter() - t0, 1e-9)
+    t_inflate = inflater.seconds if inflater else 0.0
+    encoding = inflater.encoding if inflater else ""
+    if inflater:
+        observe("decompress", "import", t_inflate)
+    observe("parse", "import", t_parse)
+    observe("load", "import", t_load)
+    count(RECORDS, n_recs, "import", "")
+    count(BYTES, n_bytes, "import", "")
+    count(BYTES, n_wire, "upload", encoding or "identity")
+    return {
+        "records": n_recs,
+        "rejected": parser.rejected + loader.rejected,
+        "bytes": n_bytes,
+        "wire_bytes": n_wire,
+        "encoding": encoding or "identity",
+        "compression_ratio": round(n_bytes / n_wire, 2) if n_wire else 1.0,
+        "decoder": DECODER if isinstance(parser, NdjsonParser) else "json",
+        "decompress_seconds": round(t_inflate, 3),
+        "parse_seconds": round(t_parse, 3),
+        "seconds": round(secs, 3),
+        "records_per_s": round(n_recs / secs),
+        "mb_per_s": round(n_bytes / secs / 1e6, 2),
+    }
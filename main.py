@@ -1,20 +1,44 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, Response, HTTPException, Request
+from fastapi import FastAPI, Response, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from typing import Dict, Any, List, Tuple
-from datetime import datetime
-import io, os, re
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import asyncio, json, os, re, time, zipfile
+
+from aggregates import Aggregates
+from browse import BadCursor, RecordIndex
+from catalog import SITES, SPARE_OTHER
+from compact import json_default
+from export_cache import ExportCache
+from export_jobs import ExportJobs
+from ingest import IngestError, Inflater, JsonParser, NdjsonParser, UnsupportedEncoding, ingest
+import metrics
+from registry import REGISTRY, Unresolved
+from snapshot import Snapshotter
+from spare_catalog import CATALOG as SPARE_CATALOG
+import reports
+from store import KINDS, Store, date_key
+from timeline import MeterTimeline
+from tpl_cache import TemplateLayout, LayoutError, get_layout, POOL as TEMPLATE_POOL
 
 # -------- Excel backend ----------
 try:
-    from openpyxl import load_workbook
-    from openpyxl.cell.cell import MergedCell
+    import openpyxl  # noqa: F401
     USE_OPENPYXL = True
 except Exception:
     USE_OPENPYXL = False
 
+# -------- Database backend ----------
+# STORE_BACKEND=memory keeps everything in RAM only (the old behaviour)
+try:
+    from sqlstore import SqlBackend
+    USE_SQLITE = os.environ.get("STORE_BACKEND", "sqlite").lower() == "sqlite"
+except Exception:
+    USE_SQLITE = False
+
 # -------- App ----------
 app = FastAPI(title="Locations App API")
 app.add_middleware(
@@ -31,39 +55,84 @@ def home():
 
 app.mount("/static", StaticFiles(directory="."), name="static")
 
+@app.on_event("startup")
+def _warm_templates():
+    # parse the report templates once so the first export does not pay for it
+    if not USE_OPENPYXL:
+        return
+    for kind in ("detail", "summary", "spares"):
+        tpath = os.path.join("templates", f"{kind}.xlsx")
+        if os.path.exists(tpath):
+            TEMPLATE_POOL.warm(kind, tpath)
+            try:
+                get_layout(kind, tpath)
+            except LayoutError:
+                pass    # reported by the export itself
+
 # -------- Memory store ----------
-DATA: Dict[str, Any] = {"works": [], "emergencies": [], "grid": []}
-REGIONS = ["الأمانة", "صنعاء", "عمران", "مأرب"]
-
-SITES = [
-    "مبنى الزبيري - مولد","مخازن الزبيري","السعدي عصر","كهرباء عصر","عصر-2","عصر-3","سوق عصر",
-    "الخمسين-1","الخمسين-2","نوارة الستين",
-    "السنينة-1","السنينة-2","السنينة-3","السنينة-4","السنينة-5","السنينة-6","السنينة-7",
-    "جامعة العلوم والتكنولوجيا","كلية الهندسة جامعة العلوم",
-    "حي الأندلس","فندف الفاف","الستين","الأكوع شارع الستين",
-    "سوق الأمانة-1","سوق الأمانة-3",
-    "سوق مذبح","مذبح-2","مذبح-3","مذبح-4","مذبح-5","مذبح-6","مذبح-7","مذبح-8",
-    "الثلاثين-1","الثلاثين-2","الثلاثين-3","الثلاثين-4",
-    "جولة المنعي",
-    "شملان الضرائب-1","شملان الضرائب-2","شملان الضرائب-3",
-    "شملان-1","شملان-2","شملان-3","شملان-4","شملان-5","شملان-6","شملان-7","شملان-8",
-    "جولة شملان","مصنع شملان",
-    "حي الطيارين",
-    "الجوية-1","الجوية-2","الجوية-3","الجوية-5",
-    "حي الأعناب","صوفان","الملعب-2",
-    "السعودي الألماني-1","السعودي الألماني-2","فندق جي ستار",
-    "دارس-1","دارس-2","دارس-3","دارس-5","دارس-6",
-    "وادي أحمد-1","وادي أحمد-2",
-    "جولة عمران","حي سنان",
-    "الأدلة الجنائية-1","الأدلة الجنائية-2",
-    "ذهبان-1","ذهبان-2","ذهبان-3","ذهبان-4","ذهبان-5","ذهبان-6",
-    "جدر-1","جدر-2","جدر-3","جدر-4","جدر-5","جدر-6","جدر-7","سوق جدر","حي الحظن",
-    "العميري-1","العميري-2","العميري-3","العميري-4","العميري-5",
-    "قرية القابل","العره همدان","غيل همدان",
-    "قرية ضلاع","سنترال ضلاع","ضلاع-2","ضلاع-3","ضلاع-4","ضلاع-5","ضلاع-6",
-    "شاهرة ضلاع","بيت أنعم","بيت عذران","الجبل الأسود","قيفان","بني منصور","بيت الشيبة",
-    "جبل الصعود","جبل العوي","العرشان","جبل ريام","جبل ظين","ثلا","جبل الطرف"
-]
+# exports read from memory; with the database backend every write goes to
+# data.db first and the store is refilled from it on startup
+# summary/spares counters are kept up to date on every write (aggregates.py)
+# several workers (gunicorn -w N) share data.db: each request first replays the
+# writes other workers committed, so every worker answers with the same data
+TIMELINE = MeterTimeline()
+AGGREGATES = Aggregates(TIMELINE)
+UNRESOLVED = Unresolved()
+BROWSE = RecordIndex()          # posting lists behind GET /works and /emergencies (browse.py)
+STORE = Store(indexes=[TIMELINE, AGGREGATES, UNRESOLVED, BROWSE])
+
+# binary snapshot of the store and its indexes (snapshot.py), read back on startup
+_DB_ENV = os.environ.get("LOCATIONS_DB")
+SNAPSHOTS = Snapshotter(STORE, os.environ.get(
+    "LOCATIONS_SNAPSHOT",
+    os.path.splitext(_DB_ENV)[0] + ".snap" if _DB_ENV else os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.snap"),
+), interval=float(os.environ.get("SNAPSHOT_INTERVAL", "30")))
+
+@app.middleware("http")
+async def _refresh_store(request: Request, call_next):
+    if STORE.backend is not None:
+        await run_in_threadpool(STORE.refresh)
+    return await call_next(request)
+
+# -------- Metrics ----------
+if metrics.ENABLED:
+    @app.middleware("http")
+    async def _time_requests(request: Request, call_next):
+        t0 = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.HTTP_SECONDS.observe(time.perf_counter() - t0, request.method, _route(request), str(status))
+
+def _route(request: Request) -> str:
+    """Path template of the matched route (bounded label values), e.g. /export/jobs/{job_id}."""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "other")
+    return "other"
+
+@app.get("/metrics")
+def metrics_text():
+    """Prometheus text format: request and stage histograms, records and bytes counters."""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.on_event("startup")
+def _load_store():
+    if USE_SQLITE and STORE.backend is None:
+        STORE.backend = SqlBackend()
+    if SNAPSHOTS.restore():
+        STORE.refresh()         # writes committed after the snapshot was taken
+    elif STORE.backend is not None:
+        STORE.hydrate()
+    SNAPSHOTS.start()
+
+@app.on_event("shutdown")
+def _save_store():
+    SNAPSHOTS.write()
 
 # -------- APIs ----------
 @app.get("/ping")
@@ -74,498 +143,377 @@ def ping():
 def sites():
     return {"sites": SITES}
 
+@app.get("/sites/unresolved")
+def sites_unresolved():
+    """Site and region strings in the data that match no catalog entry (unknown regions are reported under the first region)."""
+    return {**UNRESOLVED.table(), "registry": REGISTRY.stats()}
+
+@app.get("/meters/last")
+def meters_last(region: str, site: str, etype: str = ""):
+    """Latest generator hours / grid kWh reading the server has for a site (prefills the mission form)."""
+    return TIMELINE.last(region, site, etype or None)
+
+@app.get("/templates/pool")
+def templates_pool():
+    return TEMPLATE_POOL.stats()
+
+@app.get("/export/cache")
+def export_cache_stats():
+    return EXPORT_CACHE.stats()
+
+@app.get("/aggregates/check")
+def aggregates_check(repair: bool = False):
+    """Recompute the report counters from the raw records; repair=true replaces them when they differ."""
+    bad = STORE.verify_indexes(repair=repair)
+    return {"ok": not any(bad.values()), "mismatched": bad, "repaired": repair and any(bad.values())}
+
 @app.post("/import")
 async def import_data(req: Request):
     if not USE_OPENPYXL:
         raise HTTPException(500, "openpyxl غير مثبت. pip install openpyxl")
-    payload = await req.json()
-    DATA["works"]       = payload.get("works") or []
-    DATA["emergencies"] = payload.get("emergencies") or []
-    DATA["grid"]        = payload.get("grid") or []
-    return {"ok": True, "counts": {k: len(v) for k, v in DATA.items()}}
+    # the body is parsed as it arrives and loaded in batches: memory stays flat
+    # whatever the upload size. application/x-ndjson takes one record per line,
+    # {"kind": "works", "record": {...}}, or bare records with ?kind=works.
+    # Content-Encoding gzip / deflate (zstd if installed) is undone as it streams.
+    ctype = req.headers.get("content-type", "").split(";")[0].strip().lower()
+    try:
+        inflater = Inflater(req.headers.get("content-encoding"))
+    except UnsupportedEncoding as e:
+        raise HTTPException(415, str(e))
+    try:
+        if ctype in ("application/x-ndjson", "application/jsonl"):
+            parser = NdjsonParser(req.query_params.get("kind"))
+        else:
+            parser = JsonParser()
+    except IngestError as e:
+        raise HTTPException(400, str(e))
+    loader = STORE.loader()
+    try:
+        stats = await ingest(req.stream(), parser, loader, run_in_threadpool, inflater)
+    except IngestError as e:
+        await run_in_threadpool(loader.abort)
+        raise HTTPException(400, f"ملف الاستيراد غير صالح: {e}")
+    except BaseException:
+        await run_in_threadpool(loader.abort)
+        raise
+    with metrics.span("commit", "import"):
+        counts = await run_in_threadpool(loader.commit)
+    SNAPSHOTS.schedule(now=True)
+    return {"ok": True, "counts": counts, "token": STORE.token(), "ingest": stats}
+
+@app.post("/sync")
+async def sync_data(req: Request):
+    """
+    Incremental sync: {"token": "...", "works": {"upsert": [...], "delete": [ids]}, "emergencies": {...}, "grid": {...}}.
+    409 means the token is not from this server state; the client must resend everything via /import.
+    """
+    try:
+        body = await req.json()
+    except ValueError as e:
+        raise HTTPException(400, f"طلب المزامنة غير صالح: {e}")
+    for kind in KINDS:
+        ch = body.get(kind) if isinstance(body, dict) else None
+        if ch is not None and not (isinstance(ch, dict) and
+                                   all(isinstance(ch.get(op) or [], list) for op in ("upsert", "delete"))):
+            raise HTTPException(400, f'طلب المزامنة غير صالح: {kind} يجب أن يكون {{"upsert": [...], "delete": [...]}}')
+    if not isinstance(body, dict) or not STORE.token_valid(body.get("token")):
+        raise HTTPException(409, "رمز المزامنة غير صالح — أعد رفع كل البيانات عبر /import.")
+    applied = await run_in_threadpool(STORE.apply, body)     # a database write: may wait on the write lock
+    SNAPSHOTS.schedule()
+    return {"ok": True, "applied": applied, "counts": STORE.counts(), "token": STORE.token()}
 
 @app.post("/clear")
 def clear_all():
-    DATA["works"] = []
-    DATA["emergencies"] = []
-    DATA["grid"] = []
-    return {"ok": True, "message": "تم مسح البيانات من الذاكرة."}
+    STORE.clear()
+    SNAPSHOTS.schedule(now=True)
+    return {"ok": True, "message": "تم مسح البيانات."}
+
+@app.get("/spares/unmatched")
+def spares_unmatched(month: List[str] = Query(None)):
+    """Spare names that matched no template label (counted under SPARE_OTHER), most frequent first."""
+    months = _parse_months(month) if month else AGGREGATES.months()
+    names: Dict[str, Dict[str, Any]] = {}
+    for m in months:
+        for name, byreg in AGGREGATES.month(m).unmatched.items():
+            it = names.setdefault(name, {"name": name, "count": 0, "regions": {}, "months": []})
+            it["count"] += sum(byreg.values())
+            it["months"].append(m)
+            for rn, n in byreg.items():
+                it["regions"][rn] = it["regions"].get(rn, 0) + n
+    items = sorted(names.values(), key=lambda it: (-it["count"], it["name"]))
+    return {"label": SPARE_OTHER, "names": items, "matcher": SPARE_CATALOG.stats()}
+
+@app.get("/stats/{month}")
+def month_stats(month: str, req: Request):
+    """
+    The numbers of the summary and spares exports for `month` as JSON, read from the
+    maintained counters (no workbook is built). The ETag changes only when a write
+    touches the month, so dashboards can poll it with If-None-Match.
+    """
+    _check_month(month)
+    etag = f'"stats-{STORE.month_version(month)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_match(req.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    body = json.dumps({"month": month, **reports.month_stats(AGGREGATES.month(month))}, ensure_ascii=False)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# -------- Read API ----------
+MAX_PAGE = 500
+
+def _browse(kind: str, filters: Dict[str, str], month: List[str], date_from: str, date_to: str,
+            order: str, limit: int, cursor: str) -> Response:
+    dates = []
+    for v in (date_from, date_to):
+        dk = date_key(v) if v else 0
+        if v and not dk:
+            raise HTTPException(400, f"تاريخ غير صالح: {v} (YYYY-MM-DD)")
+        dates.append(dk)
+    if order not in ("desc", "asc"):
+        raise HTTPException(400, "order: desc أو asc")
+    try:
+        items, nxt = BROWSE.page(kind, filters, _parse_months(month) if month else None, (dates[0], dates[1]),
+                                 newest_first=order == "desc", limit=limit, cursor=cursor or None)
+    except BadCursor as e:
+        raise HTTPException(400, str(e))
+    # serialized here: compact records go out as they are, without FastAPI's generic encoder
+    body = json.dumps({"items": items, "next": nxt, "token": STORE.token()}, ensure_ascii=False, default=json_default)
+    return Response(content=body, media_type="application/json")
+
+@app.get("/works")
+def list_works(month: List[str] = Query(None), date_from: str = Query("", alias="from"),
+               date_to: str = Query("", alias="to"), region: str = "", site: str = "", jobType: str = "",
+               executor: str = "", order: str = "desc", limit: int = Query(50, ge=1, le=MAX_PAGE), cursor: str = ""):
+    """
+    Works newest first (order=asc: oldest first), filtered by month (as the exports take it)
+    and/or from/to dates, region, site, jobType and executor; pass `next` back as cursor for
+    the following page, with the same filters.
+    """
+    filters = {"region": region, "site": site, "jobType": jobType, "executor": executor}
+    return _browse("works", filters, month, date_from, date_to, order, limit, cursor)
+
+@app.get("/emergencies")
+def list_emergencies(month: List[str] = Query(None), date_from: str = Query("", alias="from"),
+                     date_to: str = Query("", alias="to"), region: str = "", site: str = "",
+                     order: str = "desc", limit: int = Query(50, ge=1, le=MAX_PAGE), cursor: str = ""):
+    """Emergencies, paged and filtered like /works (by month, from/to, region and site)."""
+    return _browse("emergencies", {"region": region, "site": site}, month, date_from, date_to, order, limit, cursor)
+
+# -------- Export cache ----------
+# generated files per (kind, month), valid until a write touches that month or the template changes
+EXPORT_CACHE = ExportCache(max_bytes=int(os.environ.get("EXPORT_CACHE_MB", "64")) * 1024 * 1024)
+XLSX_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def _etag_match(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def _report_args(kind: str, month: str):
+    """(works, emergencies, counters) a report of `month` needs; summary and spares only read the counters."""
+    with metrics.span("select", kind):
+        if kind == "detail":
+            return TIMELINE.annotate(STORE.month("works", month)), STORE.month("emergencies", month), None
+        return [], [], AGGREGATES.month(month)
+
+def _export_version(kind: str, month: str) -> Tuple[str, str]:
+    """(template path, cache version) of an export; raises 500 when the template is unusable."""
+    tpath, lay = _template(kind)
+    return tpath, f"{STORE.month_version(month)}:{lay.digest}"
+
+def _xlsx_response(filename: str, data: bytes, etag: str) -> Response:
+    return Response(content=data, media_type=XLSX_TYPE, headers={
+        "ETag": etag, "Cache-Control": "no-cache",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+
+def _cached_xlsx(req: Request, key, version: str, filename: str, build) -> Response:
+    etag = EXPORT_CACHE.etag(key, version)
+    if _etag_match(req.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return _xlsx_response(filename, EXPORT_CACHE.get_or_build(key, version, build), etag)
+
+def _render(kind: str, tpath: str, month: str) -> bytes:
+    works, emerg, agg = _report_args(kind, month)
+    return reports.render(kind, tpath, works, emerg, agg=agg)
+
+def _export(kind: str, month: str, req: Request) -> Response:
+    _check_month(month)
+    tpath, version = _export_version(kind, month)
+    return _cached_xlsx(req, (kind, month), version, f"{kind}-{month}.xlsx",
+                        lambda: _render(kind, tpath, month))
+
+def _export_range(kind: str, month: List[str], req: Request) -> Response:
+    """A single month as before; a list or range of months as one workbook with a sheet per month."""
+    if len(month) == 1 and "," not in month[0] and ".." not in month[0]:
+        return _export(kind, month[0], req)
+    months = _parse_months(month)
+    if len(months) == 1:
+        return _export(kind, months[0], req)
+    tpath, lay = _template(kind)
+    version = "|".join(STORE.month_version(m) for m in months) + f":{lay.digest}"
+    return _cached_xlsx(req, (kind, tuple(months)), version, f"{kind}-{months[0]}_{months[-1]}.xlsx",
+                        lambda: reports.render_range(kind, tpath, [(m, *_report_args(kind, m)) for m in months]))
 
 # -------- Helpers ----------
-def _stream_xlsx(wb, filename: str) -> Response:
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return Response(
-        content=bio.read(),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-    )
-
-def _norm(s: Any) -> str:
-    if not isinstance(s, str):
-        return ""
-    s = s.replace("ـ", "")
-    s = re.sub(r"\s+", "", s)
-    return s.translate(str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789"))
-
-def _find_header_cols(ws, header_texts: dict, search_rows: int = 240) -> dict:
-    res = {}
-    top_r = min(search_rows, ws.max_row)
-    top_c = ws.max_column
-    wanted = {k: [_norm(v) for v in vs] for k, vs in header_texts.items()}
-    for r in range(1, top_r + 1):
-        for c in range(1, top_c + 1):
-            v = _norm(ws.cell(r, c).value)
-            if not v:
+_MONTH_RE = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+MAX_MONTHS = int(os.environ.get("EXPORT_MAX_MONTHS", "36"))
+
+def _check_month(month: str) -> str:
+    if not _MONTH_RE.match(month):
+        raise HTTPException(400, f"شهر غير صالح: {month} (YYYY-MM)")
+    return month
+
+def _parse_months(values: List[str]) -> List[str]:
+    """month=2025-07&month=2025-08, month=2025-07,2025-08 or month=2025-01..2025-12 -> sorted unique months."""
+    out = set()
+    for v in values:
+        for part in v.split(","):
+            part = part.strip()
+            if not part:
                 continue
-            for key, variants in wanted.items():
-                if key in res:
-                    continue
-                if any(x and x in v for x in variants):
-                    res[key] = c
-        if len(res) == len(header_texts):
-            break
-    return res
-
-def _find_label_cell_contains(ws, variants: List[str], search_rows: int = 800) -> Tuple[int, int] | Tuple[None, None]:
-    vv = [_norm(x) for x in variants]
-    for r in range(1, min(search_rows, ws.max_row) + 1):
-        for c in range(1, ws.max_column + 1):
-            val = _norm(ws.cell(r, c).value)
-            if any(v and v in val for v in vv):
-                return r, c
-    return None, None
-
-def _first_clear_row(ws, cols: List[int], start_row: int) -> int:
-    r = max(1, start_row)
-    while True:
-        if all(not isinstance(ws.cell(r, c), MergedCell) for c in cols):
-            return r
-        r += 1
-
-def _works_for_month(m): return [w for w in DATA["works"] if (w.get("date", "")[:7] == m)]
-def _emerg_for_month(m): return [e for e in DATA["emergencies"] if (e.get("date", "")[:7] == m)]
-
-def _parse_dt_iso(s: str) -> datetime:
-    s = (s or "").strip()
-    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%fZ"):
-        try:
-            return datetime.strptime(s[:len(fmt)], fmt)
-        except Exception:
-            pass
-    return datetime.min
-
-# safe write for merged cells: always write to the top-left of the merged range
-def _write_cell_safe(ws, r: int, c: int, value):
-    cell = ws.cell(r, c)
-    if isinstance(cell, MergedCell):
-        for rng in ws.merged_cells.ranges:
-            if rng.min_row <= r <= rng.max_row and rng.min_col <= c <= rng.max_col:
-                ws.cell(rng.min_row, rng.min_col).value = value
-                return
-        return
-    else:
-        cell.value = value
-
-# -------- EXPORT: Detail (safe: strict ascending + inline emergency) --------
-@app.get("/export/detail")
-def export_detail(month: str):
-    works = _works_for_month(month)
-    emerg = _emerg_for_month(month)
-
-    tpath = os.path.join("templates", "detail.xlsx")
-    if not (USE_OPENPYXL and os.path.exists(tpath)):
-        raise HTTPException(500, "Template detail.xlsx not found. Put it in /templates.")
-
-    # 1) strict chronological sort: old -> new
-    def _dt(s): return _parse_dt_iso(s or "")
-    works.sort(key=lambda w: (_dt(w.get("date")), _dt(w.get("savedAt"))))
-    emerg.sort(key=lambda e: (_dt(e.get("date")), _dt(e.get("savedAt"))))
-
-    wb = load_workbook(tpath)
-    ws = wb.active
-    try:
-        ws.sheet_view.rightToLeft = True
-    except Exception:
+            lo, _, hi = part.partition("..")
+            hi = hi or lo
+            if not (_MONTH_RE.match(lo) and _MONTH_RE.match(hi)) or lo > hi:
+                raise HTTPException(400, f"شهر غير صالح: {part} (YYYY-MM أو YYYY-MM..YYYY-MM)")
+            y, m = int(lo[:4]), int(lo[5:])
+            while f"{y:04d}-{m:02d}" <= hi:
+                out.add(f"{y:04d}-{m:02d}")
+                if len(out) > MAX_MONTHS:
+                    raise HTTPException(400, f"الحد الأقصى {MAX_MONTHS} شهراً في الطلب الواحد.")
+                y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    if not out:
+        raise HTTPException(400, "month مطلوب.")
+    return sorted(out)
+
+class _ZipSink:
+    """Write-only file object for zipfile; the chunks written so far are taken with take()."""
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
         pass
 
-    # 2) map headers (contains/variants)
-    header_map = {
-        "index":["م"], "day":["اليوم"], "date":["التاريخ","تاريخ"], "region":["المنطقة","المنطقه"],
-        "site":["الموقع"], "owner":["تبعية الموقع","تبعيةالموقع","التبعية"], "job":["نوع العمل","نوعالعمل"],
-        "summary":["العمل المنجز","العملالمنجز(ملخصفقط)","العمل المنجز (ملخص فقط)","ملخص العمل"],
-        "oil":["الزيت (لتر)","الزيت(لتر)","كمية الزيت","كميةالزيت"],
-        "f_oil":["فلتر الزيت","فلترالزيت"], "f_diesel":["فلتر الديزل","فلترالديزل"], "f_air":["فلتر الهواء","فلترالهواء"],
-        "h_now":["عداد الساعات","عدادالساعات","ساعات المولد","ساعاتالمولد"],
-        "h_diff":["فارق القراءة","فارقالقراءة","فارق القراءة (تغيير الزيت)","فارقالقراءة(تغييرالزيت)","فرق الساعات","فرقالساعات"],
-        "l1":["L1","L1(A)"], "l2":["L2","L2(A)"], "l3":["L3","L3(A)"], "kwh":["KWh","KWH","قراءةKWh","KWh(حالي)"],
-        "spare":["اسم القطعة","اسم القطعه","الصنف"], "qty":["الكمية","الكميه"],
-        "exec":["المنفذ للعمل","المنفذ"], "driver":["السائق"], "notes":["ملاحظات","الملاحظات"],
-        # طوارئ
-        "e_alarm":["الإنذار","الانذار"], "e_source":["مصدر البلاغ","مصدرالبلاغ"],
-        "e_cat":["تصنيف المشكلة","تصنيفالمشكلة"], "e_type":["النوع","نوع الطارئ"],
-        # عمومي/تجاري
-        "g_prev":["القراءة السابقة","القراءةالسابقة","KWh السابقة","KWhالسابقة"],
-        "g_now":["الحالية","القراءة الحالية","القراءةالحالية","KWh الحالية","KWhالحالية"],
-        "g_diff":["الاستهلاك (KWh)","الاستهلاكKWh","فرقKWh","فرقالKWh"],
-        "g_kwhr":["kWhr","KWhr","kWhr(اختياري)"], "g_hours":["عداد ساعات الكهرباء","عدادساعاتالكهرباء","ساعات الكهرباء","ساعاتالكهرباء"],
-    }
-    cols = _find_header_cols(ws, header_map, search_rows=400)
-    if "date" not in cols or "site" not in cols:
-        # fallback: guess the header row that contains both labels
-        cand_rows = {}
-        for r in range(1, min(ws.max_row, 60) + 1):
-            row_vals = [_norm(ws.cell(r, c).value) for c in range(1, ws.max_column + 1)]
-            if any(_norm("التاريخ") in v for v in row_vals) and any(_norm("الموقع") in v for v in row_vals):
-                cand_rows[r] = sum(1 for v in row_vals if v)
-        if cand_rows:
-            hdr_row_guess = max(cand_rows, key=cand_rows.get)
-            cols = {}
-            for c in range(1, ws.max_column + 1):
-                v = _norm(ws.cell(hdr_row_guess, c).value)
-                for key, variants in header_map.items():
-                    if key in cols: continue
-                    if any(_norm(x) in v for x in variants if x):
-                        cols[key] = c
-        if "date" not in cols or "site" not in cols:
-            raise HTTPException(500, "تعذر تحديد أعمدة (التاريخ/الموقع) في detail.xlsx — راجع صف العناوين.")
-
-    # 3) find header row (where the date label sits)
-    hdr_row = 1
-    for rr in range(1, min(ws.max_row, 240) + 1):
-        v = ws.cell(rr, cols["date"]).value
-        if _norm(v).find(_norm("التاريخ")) != -1:
-            hdr_row = rr
-            break
-
-    targets = list(set(cols.values()))
-
-    # 4) first fully-unmerged data row
-    r = _first_clear_row(ws, targets, hdr_row + 1)
-
-    idx = 1
-    last_hours_by_rs: Dict[str, float] = {}
-    def key_rs(region: str, site: str) -> str:
-        return f"{_norm(region)}__{_norm(site)}"
-
-    # 5) write works (each spare on its own row), moving to next non-merged row each time
-    for w in works:
-        region = (w.get("region") or "").strip()
-        site   = (w.get("site") or "").strip()
-        krs    = key_rs(region, site)
-
-        hours_now  = float(w.get("hoursNow", 0) or 0)
-        hours_diff = max(0.0, hours_now - float(last_hours_by_rs.get(krs, 0.0)))
-        if hours_now > 0:
-            last_hours_by_rs[krs] = hours_now
-
-        spares = w.get("spares") or [{"name":"", "qty":""}]
-        base = {
-            "index": idx, "day": w.get("weekday",""), "date": w.get("date",""),
-            "region": region, "site": site, "owner": w.get("siteOwner",""),
-            "job": w.get("jobType",""), "summary": w.get("summary",""),
-            "oil": w.get("oilLiters",0),
-            "f_oil": "✓" if w.get("oilFilter") else "", "f_diesel": "✓" if w.get("dieselFilter") else "",
-            "f_air": "✓" if w.get("airFilter") else "",
-            "h_now": hours_now, "h_diff": hours_diff,
-            "l1": w.get("l1",0), "l2": w.get("l2",0), "l3": w.get("l3",0), "kwh": w.get("kwhNow",0),
-            "exec": w.get("executor",""), "driver": w.get("driver",""), "notes": w.get("notes",""),
-        }
-        g = w.get("grid") or {}
-        base.update({
-            "g_prev": g.get("kwhPrev",""), "g_now": g.get("kwhNow",""),
-            "g_diff": g.get("kwhDiff",""), "g_kwhr": g.get("kwhr",""),
-            "g_hours": g.get("hours",""),
-        })
-
-        # ---- NEW: inline Emergency (from mission itself) when jobType == "صيانة طارئة"
-        em = w.get("emergency") or {}
-        if (w.get("jobType") or "").strip() == "صيانة طارئة" and em:
-            base.update({
-                "e_alarm":  em.get("alarm",""),
-                "e_source": em.get("source",""),
-                "e_cat":    em.get("category",""),
-                "e_type":   "",  # لا يوجد حقل نوع منفصل هنا
-            })
-        # ---- NEW END
-
-        for sp in spares:
-            row = base.copy()
-            row["spare"] = sp.get("name","")
-            row["qty"]   = sp.get("qty","")
-            for k, c in cols.items():
-                if k in row:
-                    _write_cell_safe(ws, r, c, row[k])
-            r = _first_clear_row(ws, targets, r + 1)
-        idx += 1
-
-    # 6) map rows to merge emergency records (legacy) by (date,region,site)
-    row_by_key = {}
-    for rr in range(hdr_row + 1, r):
-        dt = _norm(ws.cell(rr, cols.get("date",1)).value)[:10]
-        rg = _norm(ws.cell(rr, cols.get("region",1)).value)
-        st = _norm(ws.cell(rr, cols.get("site",1)).value)
-        if dt or rg or st:
-            row_by_key[(dt, rg, st)] = rr
-
-    # 7) write standalone emergencies (legacy), merging if key matches; else append
-    for e in emerg:
-        dt = (e.get("date","") or "")[:10]
-        rg = (e.get("region") or "").strip()
-        st = (e.get("site") or "").strip()
-        key = (_norm(dt), _norm(rg), _norm(st))
-        payload = {
-            "e_alarm": e.get("alarm",""),
-            "e_source": e.get("source",""),
-            "e_cat":    e.get("category",""),
-            "e_type":   e.get("etype",""),
-        }
-        if key in row_by_key:
-            rr = row_by_key[key]
-            for k, c in cols.items():
-                if k in payload:
-                    _write_cell_safe(ws, rr, c, payload[k])
-        else:
-            base = {
-                "index": idx, "day": "", "date": e.get("date",""),
-                "region": rg, "site": st, "owner": e.get("siteOwner",""),
-                "job": "", "summary": e.get("notes",""),
-                "oil":"", "f_oil":"", "f_diesel":"", "f_air":"",
-                "h_now":"", "h_diff":"", "l1":"", "l2":"", "l3":"", "kwh":"",
-                "exec":"", "driver":"", "notes": e.get("remarks",""),
-                **payload
-            }
-            for k, c in cols.items():
-                if k in base:
-                    _write_cell_safe(ws, r, c, base[k])
-            row_by_key[key] = r
-            r = _first_clear_row(ws, targets, r + 1)
-            idx += 1
-
-    return _stream_xlsx(wb, f"detail-{month}.xlsx")
-
-# -------- EXPORT: Summary --------
-@app.get("/export/summary")
-def export_summary(month: str):
-    works = _works_for_month(month)
-    emerg = _emerg_for_month(month)
-
-    tpath = os.path.join("templates", "summary.xlsx")
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+def _zip_stream(files: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    # xlsx files are already deflated: store them as they are
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in files:
+            zf.writestr(name, data)
+            yield sink.take()
+    yield sink.take()
+
+def _template(kind: str) -> Tuple[str, TemplateLayout]:
+    tpath = os.path.join("templates", f"{kind}.xlsx")
     if not (USE_OPENPYXL and os.path.exists(tpath)):
-        raise HTTPException(500, "Template summary.xlsx not found. Put it in /templates.")
-
-    wb = load_workbook(tpath)
-    ws = wb.active
+        raise HTTPException(500, f"Template {kind}.xlsx not found. Put it in /templates.")
     try:
-        ws.sheet_view.rightToLeft = True
-    except Exception:
-        pass
+        return tpath, get_layout(kind, tpath)
+    except LayoutError as e:
+        raise HTTPException(500, str(e))
 
-    wanted = ["المهام", "الكل", *REGIONS]
-    scores = {}
-    for r in range(1, min(240, ws.max_row) + 1):
-        hits = 0
-        for c in range(1, ws.max_column + 1):
-            if _norm(ws.cell(r, c).value) in [_norm(h) for h in wanted]:
-                hits += 1
-        if hits:
-            scores[r] = hits
-    if not scores:
-        raise HTTPException(500, "تعذر تحديد صف العناوين في summary.xlsx.")
-    hdr_row = max(scores, key=scores.get)
-
-    col_task = None
-    col_all = None
-    region_cols: Dict[str, int] = {}
-    for c in range(1, ws.max_column + 1):
-        hv = _norm(ws.cell(hdr_row, c).value)
-        if hv == _norm("م"):
-            continue
-        if hv == _norm("المهام"):
-            col_task = c
-        if hv == _norm("الكل"):
-            col_all = c
-        for rn in REGIONS:
-            if hv == _norm(rn):
-                region_cols[rn] = c
-
-    if not region_cols:
-        raise HTTPException(500, "تعذر تحديد أعمدة المناطق.")
-    if not col_task:
-        col_task = min(region_cols.values()) - 1
-    if not col_all:
-        col_all = max(region_cols.values()) + 1
-
-    jobTypes = [
-        "صيانة مخططة","صيانة دورية","صيانة طارئة","صيانة تفقدية","استلام طوارئ",
-        "تعطيل","استلام وتشغيل","ترحيل إنذارات","ربط كهرباء","قراءة عدادات",
-        "تكليف عمل","مواد","إصلاحات","أخرى"
-    ]
-    from collections import defaultdict
-    counts = {t: defaultdict(int) for t in jobTypes}
-
-    def _reg(x):
-        r = (x.get("region") or "").strip()
-        return r if r in REGIONS else REGIONS[0]
-
-    for w in works:
-        t = w.get("jobType") or "أخرى"
-        counts.setdefault(t, defaultdict(int))
-        counts[t][_reg(w)] += 1
-
-    for e in emerg:
-        counts["صيانة طارئة"][_reg(e)] += 1
-
-    r = hdr_row + 1
-    for t in jobTypes:
-        if not ws.cell(r, col_task).value:
-            ws.cell(r, col_task).value = t
-        total = sum(counts[t].values())
-        ws.cell(r, col_all).value = total
-        for rn, col in region_cols.items():
-            ws.cell(r, col).value = counts[t].get(rn, 0)
-        r += 1
-
-    return _stream_xlsx(wb, f"summary-{month}.xlsx")
-
-# -------- EXPORT: Spares --------
-@app.get("/export/spares")
-def export_spares(month: str):
-    works = _works_for_month(month)
+# -------- EXPORTS ----------
+@app.get("/export/detail")
+def export_detail(req: Request, month: List[str] = Query(...)):
+    return _export_range("detail", month, req)
 
-    tpath = os.path.join("templates", "spares.xlsx")
-    if not (USE_OPENPYXL and os.path.exists(tpath)):
-        raise HTTPException(500, "Template spares.xlsx not found. Put it in /templates.")
-
-    from collections import defaultdict
-    kpi_hours_by_region = defaultdict(float)
-    kpi_oil_by_region   = defaultdict(float)
-    filt_oil_by_region  = defaultdict(int)
-    filt_dies_by_region = defaultdict(int)
-    filt_air_by_region  = defaultdict(int)
-    spares_by_label_region = defaultdict(lambda: defaultdict(float))
-
-    def _reg(x):
-        r = (x.get("region") or "").strip()
-        return r if r in REGIONS else REGIONS[0]
-
-    for w in works:
-        reg = _reg(w)
-        # KPIs
-        kpi_hours_by_region[reg] += float(w.get("hoursDiff", 0) or 0)
-        kpi_oil_by_region[reg]   += float(w.get("oilLiters", 0) or 0)
-        if w.get("oilFilter"):
-            filt_oil_by_region[reg]  += 1
-        if w.get("dieselFilter"):
-            filt_dies_by_region[reg] += 1
-        if w.get("airFilter"):
-            filt_air_by_region[reg]  += 1
-        # Spares (items)
-        for sp in (w.get("spares") or []):
-            name = (sp.get("name") or "").strip()
-            if not name:
-                continue
-            try:
-                qty = float(sp.get("qty", 0) or 0)
-            except Exception:
-                qty = 0
-            spares_by_label_region[name][reg] += qty
+@app.get("/export/summary")
+def export_summary(req: Request, month: List[str] = Query(...)):
+    return _export_range("summary", month, req)
 
-    wb = load_workbook(tpath)
-    ws = wb.active
+@app.get("/export/spares")
+def export_spares(month: str, req: Request):
+    return _export("spares", month, req)
+
+# -------- EXPORT JOBS (process pool) ----------
+# generation runs in worker processes so big months never block the API
+EXPORT_JOBS = ExportJobs(workers=int(os.environ.get("EXPORT_WORKERS", str(min(4, os.cpu_count() or 1)))),
+                         keep=int(os.environ.get("EXPORT_JOB_KEEP", "200")),
+                         ttl=float(os.environ.get("EXPORT_JOB_TTL", "3600")))
+
+@app.on_event("shutdown")
+def _stop_export_jobs():
+    EXPORT_JOBS.shutdown()
+
+@app.post("/export/jobs", status_code=202)
+async def export_job_create(req: Request):
+    """{"kind": "detail" | "summary" | "spares", "month": "YYYY-MM"} -> job id; poll /export/jobs/{id}."""
     try:
-        ws.sheet_view.rightToLeft = True
-    except Exception:
-        pass
-
-    # detect columns (contains)
-    stmt_col = _find_header_cols(ws, {"stmt": ["البيان", "البند", "الوصف"]}, search_rows=220).get("stmt")
-    if not stmt_col:
-        raise HTTPException(500, "تعذر العثور على عمود 'البيان' في spares.xlsx")
-
-    # header row (where "البيان" appears)
-    hdr_row = None
-    for rr in range(1, 240):
-        if _norm(ws.cell(rr, stmt_col).value) in [_norm("البيان"), _norm("البند"), _norm("الوصف")]:
-            hdr_row = rr
-            break
-    if hdr_row is None:
-        hdr_row = 5
-
-    col_all = None
-    col_unit = None
-    col_by_region: Dict[str, int] = {}
-    for c in range(1, ws.max_column + 1):
-        hv = _norm(ws.cell(hdr_row, c).value)
-        if hv == _norm("م"):
-            continue
-        if hv == _norm("الكل"):
-            col_all = c
-        if hv == _norm("الوحدة"):
-            col_unit = c
-        for rn in REGIONS:
-            if hv == _norm(rn):
-                col_by_region[rn] = c
-
-    if not col_by_region:
-        raise HTTPException(500, "تعذر تحديد أعمدة المناطق في spares.xlsx")
-    if not col_all:
-        if not col_unit:
-            raise HTTPException(500, "لم يُعثر على 'الكل' ولا 'الوحدة' لتحديد عمود الإجمالي.")
-        col_all = col_unit - 1  # إجمالي قبل "الوحدة" عند غياب "الكل"
-
-    def find_row(label_variants):
-        r, _ = _find_label_cell_contains(ws, label_variants, search_rows=800)
-        return r
-
-    def write_kpi(label_variants, totals_by_reg: dict):
-        r = find_row(label_variants)
-        if not r:
-            return
-        total = sum(totals_by_reg.values())
-        _write_cell_safe(ws, r, col_all, total)
-        for rn, c in col_by_region.items():
-            _write_cell_safe(ws, r, c, totals_by_reg.get(rn, 0))
-
-    # KPIs per region with broad synonyms
-    write_kpi(["مجموع ساعات عمل المولدات", "ساعات عمل المولدات", "ساعاتالمولد"], kpi_hours_by_region)
-    write_kpi(["كميات الزيوت المستهلكة", "الزيت المستهلك", "الزيوت المستهلكة"], kpi_oil_by_region)
-    write_kpi(["عدد فلاتر الزيت", "فلاتر الزيت", "اجمالي فلاتر الزيت", "إجمالي فلاتر الزيت"], filt_oil_by_region)
-    write_kpi(["عدد فلاتر الديزل", "فلاتر الديزل", "اجمالي فلاتر الديزل", "إجمالي فلاتر الديزل"], filt_dies_by_region)
-    write_kpi(["عدد فلاتر الهواء", "فلاتر الهواء", "اجمالي فلاتر الهواء", "إجمالي فلاتر الهواء"], filt_air_by_region)
-
-    # Normalize item names to known Arabic labels
-    known_items = [
-        "عد السيور","بطارية مولد متعدد السعات","بطارياة لوجو","دينامو شحن مولد","سلف مولد","سولونايد ديزل","AVR",
-        "كرت تشغيل مولد","كونتاكتور","موديول موحد","موديول طاقة شمسية(DC-DC)","منظم شحن (12/48VDC)",
-        "قاطع كهرباء (3Ph-4p/3p)","قاطع كهرباء (1Ph-2p/1p)","ريلي (12/48VDC)","ريلي (220VAC)",
-        "شاحن كهرباء (220VAC/12VDC)","LOGO-12VDC","SPD","لوحة توزيع (12/18/24)","منظم شحن دينامو",
-        "قطع غيار اخرى متنوعة"
-    ]
-    OTHER = "قطع غيار اخرى متنوعة"
-
-    def match_label(name: str) -> str:
-        n = _norm(name)
-        for k in known_items:
-            if _norm(k) in n or n in _norm(k):
-                return k
-        return OTHER
-
-    from collections import defaultdict as dd
-    normalized = dd(lambda: dd(float))
-    for label, byreg in spares_by_label_region.items():
-        key = match_label(label)
-        for rn, qty in byreg.items():
-            normalized[key][rn] += float(qty or 0)
-
-    for label, byreg in normalized.items():
-        r = find_row([label])
-        if not r:
-            continue
-        total = sum(byreg.values())
-        _write_cell_safe(ws, r, col_all, total)
-        for rn, c in col_by_region.items():
-            _write_cell_safe(ws, r, c, byreg.get(rn, 0))
-
-    return _stream_xlsx(wb, f"spares-{month}.xlsx")
\ No newline at end of file
+        body = await req.json()
+    except ValueError as e:
+        raise HTTPException(400, f"طلب غير صالح: {e}")
+    kind = body.get("kind") if isinstance(body, dict) else None
+    month = body.get("month") if isinstance(body, dict) else None
+    if kind not in reports.RENDERERS or not isinstance(month, str) or not month:
+        raise HTTPException(400, "kind (detail|summary|spares) و month مطلوبة.")
+    _check_month(month)
+
+    def submit():
+        # the template check and the month's records (a timeline pass for detail) stay off the event loop
+        tpath, version = _export_version(kind, month)
+        return EXPORT_JOBS.submit(
+            kind, month, version, tpath, *_report_args(kind, month),
+            cached=EXPORT_CACHE.get((kind, month), version),
+            on_done=lambda j: EXPORT_CACHE.put((j.kind, j.month), j.version, j.data),
+        )
+
+    job = await run_in_threadpool(submit)
+    return {"ok": True, **job.info(),
+            "status_url": f"/export/jobs/{job.id}", "download_url": f"/export/jobs/{job.id}/download"}
+
+def _job(job_id: str):
+    job = EXPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(404, "المهمة غير موجودة أو انتهت صلاحيتها.")
+    return job
+
+@app.get("/export/jobs/{job_id}")
+def export_job_status(job_id: str):
+    return _job(job_id).info()
+
+@app.get("/export/jobs/{job_id}/download")
+def export_job_download(job_id: str):
+    job = _job(job_id)
+    if job.status == "failed":
+        raise HTTPException(500, f"فشل إنشاء الملف: {job.error}")
+    if job.status != "done":
+        raise HTTPException(409, "الملف لم يجهز بعد.")
+    return _xlsx_response(f"{job.kind}-{job.month}.xlsx", job.data, EXPORT_CACHE.etag((job.kind, job.month), job.version))
+
+# -------- EXPORT: Bundle (all reports of one or more months as a zip) --------
+@app.get("/export/bundle")
+async def export_bundle(req: Request, month: List[str] = Query(...)):
+    months = _parse_months(month)
+    # template checks and, below, the months' records are read in the threadpool, off the event loop
+    items = await run_in_threadpool(lambda: [(kind, m, *_export_version(kind, m))
+                                             for m in months for kind in reports.RENDERERS])
+    etag = EXPORT_CACHE.etag(("bundle", tuple(months)), "|".join(v for *_, v in items))
+    if _etag_match(req.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    async def build(kind: str, m: str, tpath: str, version: str) -> bytes:
+        data = EXPORT_CACHE.get((kind, m), version)
+        if data is None:
+            fut = await run_in_threadpool(lambda: EXPORT_JOBS.render(kind, tpath, *_report_args(kind, m)))
+            data = await asyncio.wrap_future(fut)
+            EXPORT_CACHE.put((kind, m), version, data)
+        return data
+
+    # every missing report renders in parallel on the export workers
+    files = await asyncio.gather(*(build(*it) for it in items))
+    single = len(months) == 1
+    names = [f"{kind}-{m}.xlsx" if single else f"{m}/{kind}-{m}.xlsx" for kind, m, *_ in items]
+    fname = f"reports-{months[0]}.zip" if single else f"reports-{months[0]}_{months[-1]}.zip"
+    return StreamingResponse(_zip_stream(zip(names, files)), media_type="application/zip", headers={
+        "ETag": etag, "Cache-Control": "no-cache",
+        "Content-Disposition": f'attachment; filename="{fname}"',
+    })
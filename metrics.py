@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+- Counters and histograms for the hot paths, exposed by GET /metrics in the
+  Prometheus text format (version 0.0.4). No client library needed.
+- span(stage, kind) times a named stage of an export or import:
+      with span("write", "detail"): ...
+  stages: template (workbook checkout), layout (template compile/lookup),
+  select (records of the month, timeline deltas), plan, write, save (xlsx
+  serialization), decompress / parse / load / commit (import), snapshot
+  (kind write / load).
+- METRICS=0 turns everything off: span() returns one shared no-op context
+  manager and count() returns at once, so instrumented code pays a call.
+- Metrics are per process: stages run by export worker processes
+  (export_jobs.py) are not included.
+"""
+import os, threading, time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Dict, List, Sequence, Tuple
+
+ENABLED = os.environ.get("METRICS", "1").strip().lower() not in ("0", "false", "no", "off")
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, n: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        out += [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}   # labels -> [per-bucket counts..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[bisect_left(self.buckets, value)] += 1      # past the last bucket: the +Inf slot
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for k, s in items:
+            acc = 0
+            for b, n in zip(self.buckets, s):
+                acc += n
+                le = 'le="%s"' % _num(b)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            acc += s[len(self.buckets)]
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_num(s[-1])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {acc}")
+        return out
+
+HTTP_SECONDS = Histogram("locations_http_request_seconds", "Time to the response head, per route.",
+                         ("method", "route", "status"))
+STAGE_SECONDS = Histogram("locations_stage_seconds", "Time spent in a named stage of an export or import.",
+                          ("stage", "kind"))
+RECORDS = Counter("locations_records_total", "Records processed.", ("op", "kind"))
+BYTES = Counter("locations_bytes_total", "Bytes read by imports (op upload: as sent, by Content-Encoding), produced by exports and written to snapshots.",
+                ("op", "kind"))
+ALL = (HTTP_SECONDS, STAGE_SECONDS, RECORDS, BYTES)
+
+class _Span:
+    __slots__ = ("labels", "t0")
+
+    def __init__(self, stage: str, kind: str):
+        self.labels = (stage, kind)
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.t0, *self.labels)
+        return False
+
+_NULL = nullcontext()
+
+def span(stage: str, kind: str = ""):
+    return _Span(stage, kind) if ENABLED else _NULL
+
+def observe(stage: str, kind: str, seconds: float):
+    """A stage timed by the caller (e.g. summed over the chunks of a stream)."""
+    if ENABLED:
+        STAGE_SECONDS.observe(seconds, stage, kind)
+
+def count(counter: Counter, n: float, *labels: str):
+    if ENABLED and n:
+        counter.inc(n, *labels)
+
+def render() -> str:
+    lines: List[str] = []
+    for m in ALL:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
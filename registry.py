@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+registry.py
+- Resolves the free-text site / region strings of records against the catalog
+  (catalog.SITES, catalog.REGIONS) through textnorm.fold(), so "مذبح - ٥",
+  "مذبح-5" and "مذبـح 5" are the same site and "الامانه" is "الأمانة".
+- Every distinct string gets a small integer id once (memoized); reports
+  compare ids instead of re-normalizing strings. Names outside the catalog get
+  ids of their own (after the catalog ones), so they still group together.
+- The ids of names outside the catalog depend on the order they were met in;
+  snapshots carry them (state() / adopt()) along with the indexes keyed by them.
+  On every full load (the Unresolved index's rebuild) the names no record
+  carries any more are forgotten, so client junk does not pile up; ids are
+  never reused. resolve() only reads the catalog and never takes an id.
+- Unresolved is a store index counting the site/region strings that did not
+  resolve, so the catalog (or the data) can be fixed.
+"""
+import os, threading
+from functools import lru_cache
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from catalog import REGIONS, SITES
+from textnorm import fold
+
+class _Names:
+    """fold key -> id; ids below len(canonical) are catalog entries."""
+    def __init__(self, canonical: Sequence[str], cache_size: int):
+        self.canonical = list(canonical)
+        self._ids: Dict[str, int] = {}
+        for i, name in enumerate(self.canonical):
+            self._ids.setdefault(fold(name), i)
+        self._catalog = dict(self._ids)
+        self._next = len(self.canonical)
+        self._lock = threading.Lock()
+        self.id = lru_cache(maxsize=cache_size)(self._id)
+        self._find = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _id(self, raw: str) -> int:
+        key = fold(raw)
+        i = self._ids.get(key)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(key)
+                if i is None:
+                    i = self._ids[key] = self._next
+                    self._next += 1
+        return i
+
+    def state(self) -> Tuple[Dict[str, int], int]:
+        with self._lock:
+            return dict(self._ids), self._next
+
+    def adopt(self, state: Tuple[Dict[str, int], int]) -> bool:
+        """Take over the ids of a saved state(); False (nothing changed) when they clash with ours."""
+        ids, nxt = state
+        with self._lock:
+            taken = set(ids.values())
+            for key, i in self._ids.items():
+                if ids.get(key, i) != i or (key not in ids and i in taken):
+                    return False
+            self._ids.update(ids)
+            self._next = max(self._next, nxt)
+        return True
+
+    def retain(self, ids: Iterable[int]):
+        """Forget the names outside the catalog whose id is not in `ids`."""
+        keep = set(ids)
+        n = len(self.canonical)
+        with self._lock:
+            self._ids = {key: i for key, i in self._ids.items() if i < n or i in keep}
+            self.id.cache_clear()
+
+    def _lookup(self, raw: str) -> Optional[str]:
+        i = self._catalog.get(fold(raw))
+        return None if i is None else self.canonical[i]
+
+    def resolve(self, raw: Any) -> Optional[str]:
+        """Canonical catalog name, or None."""
+        if not isinstance(raw, str) or not raw.strip():
+            return None
+        return self._find(raw)
+
+class SiteRegistry:
+    def __init__(self, sites: Sequence[str], regions: Sequence[str], cache_size: int = 8192):
+        self.sites = _Names(sites, cache_size)
+        self.regions = _Names(regions, cache_size)
+
+    # non-text values count as "" (like textnorm.norm)
+    def site_id(self, raw: Any) -> int:
+        return self.sites.id(raw if isinstance(raw, str) else "")
+
+    def region_id(self, raw: Any) -> int:
+        return self.regions.id(raw if isinstance(raw, str) else "")
+
+    def site(self, raw: Any) -> Optional[str]:
+        return self.sites.resolve(raw)
+
+    def region(self, raw: Any) -> Optional[str]:
+        return self.regions.resolve(raw)
+
+    def state(self) -> Dict[str, Any]:
+        return {"sites": self.sites.state(), "regions": self.regions.state()}
+
+    def adopt(self, state: Dict[str, Any]) -> bool:
+        """
+        Take over the ids of a snapshot, so indexes keyed by them (timeline.py) can be
+        restored as saved. All or nothing per table; False when either table clashes.
+        """
+        ok = self.sites.adopt(state["sites"])
+        return self.regions.adopt(state["regions"]) and ok
+
+    def retain(self, recs: Dict[str, Iterable[Any]]):
+        """
+        Keep ids only for the names the records carry (`recs`: the whole store), so names
+        met only in replaced data do not pile up. The kept ids do not change, so indexes
+        keyed by them stay valid.
+        """
+        sites, regions = set(), set()
+        for kind_recs in recs.values():
+            for rec in kind_recs or ():
+                sites.add(self.site_id(rec.get("site")))
+                regions.add(self.region_id(rec.get("region")))
+                g = rec.get("grid")
+                if isinstance(g, Mapping):
+                    sites.add(self.site_id(g.get("site")))
+        self.sites.retain(sites)
+        self.regions.retain(regions)
+
+    def stats(self) -> Dict[str, Any]:
+        out = {}
+        for name, names in (("sites", self.sites), ("regions", self.regions)):
+            info = names.id.cache_info()
+            out[name] = {"catalog": len(names.canonical), "known": len(names._ids),
+                         "hits": info.hits, "misses": info.misses}
+        return out
+
+REGISTRY = SiteRegistry(SITES, REGIONS, cache_size=int(os.environ.get("SITE_CACHE", "8192")))
+
+def _unresolved(recs: Dict[str, Iterable[Dict[str, Any]]]) -> Dict[str, Dict[str, int]]:
+    out: Dict[str, Dict[str, int]] = {"sites": {}, "regions": {}}
+    for kind in ("works", "emergencies"):
+        for rec in recs.get(kind) or ():
+            _count(out, rec, 1)
+    return out
+
+def _count(out: Dict[str, Dict[str, int]], rec: Dict[str, Any], sign: int):
+    for field, key, resolve in (("site", "sites", REGISTRY.site), ("region", "regions", REGISTRY.region)):
+        raw = rec.get(field)
+        if resolve(raw) is not None:
+            continue
+        raw = raw.strip() if isinstance(raw, str) else ""
+        table = out[key]
+        n = table.get(raw, 0) + sign
+        if n:
+            table[raw] = n
+        else:
+            table.pop(raw, None)
+
+class Unresolved:
+    """Store index: how many works/emergencies carry each site/region string outside the catalog."""
+    name = "unresolved"
+
+    def __init__(self):
+        self._counts: Dict[str, Dict[str, int]] = {"sites": {}, "regions": {}}
+
+    def rebuild(self, recs: Dict[str, Iterable[Dict[str, Any]]]):
+        self._counts = _unresolved(recs)
+        REGISTRY.retain(recs)       # a full load: the names the store no longer carries are dropped
+
+    def state(self) -> Dict[str, Dict[str, int]]:
+        return self._counts
+
+    def restore(self, state: Dict[str, Dict[str, int]]):
+        self._counts = state
+
+    def update(self, kind: str, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]):
+        if kind not in ("works", "emergencies"):
+            return
+        counts = {k: dict(v) for k, v in self._counts.items()}
+        for sign, recs in ((-1, removed), (1, added)):
+            for rec in recs:
+                _count(counts, rec, sign)
+        self._counts = counts
+
+    def verify(self, recs: Dict[str, Iterable[Dict[str, Any]]], repair: bool = False) -> List[str]:
+        fresh = _unresolved(recs)
+        bad = [k for k in fresh if fresh[k] != self._counts.get(k)]
+        if repair and bad:
+            self._counts = fresh
+        return bad
+
+    def table(self) -> Dict[str, List[Dict[str, Any]]]:
+        counts = self._counts
+        return {k: [{"name": n, "count": c} for n, c in sorted(v.items(), key=lambda x: (-x[1], x[0]))]
+                for k, v in counts.items()}
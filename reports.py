@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+reports.py
+- The three month reports (detail, summary, spares), rendered from a template
+  path and the month's records into xlsx bytes.
+- Only plain data goes in, so the same functions run in the API process and in
+  export worker processes (export_jobs.py).
+- month_stats() gives the figures of the summary and spares reports as JSON
+  (GET /stats/{month}) without building a workbook.
+"""
+import io
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aggregates import MonthAggregates, month_aggregates
+from catalog import JOB_TYPES, REGIONS
+from registry import REGISTRY
+from textnorm import norm as _norm
+from metrics import BYTES, RECORDS, count, span
+from tpl_cache import MergedIndex, TemplateLayout, SPARES_KPIS, get_layout, POOL
+
+Progress = Callable[[float], None]     # called with 0..1 while a report is written
+
+def _noop():
+    pass
+
+def _ticker(progress: Optional[Progress], total: int, every: int = 200) -> Callable[[], None]:
+    """Call progress(done/total) every `every` records."""
+    if progress is None or total <= 0:
+        return _noop
+    done = 0
+    def tick():
+        nonlocal done
+        done += 1
+        if done % every == 0:
+            progress(done / total)
+    return tick
+
+def _xlsx_bytes(wb, kind: str = "") -> bytes:
+    with span("save", kind):
+        bio = io.BytesIO()
+        wb.save(bio)
+        data = bio.getvalue()
+    count(BYTES, len(data), "export", kind)
+    return data
+
+def _layout(kind: str, tpath: str) -> TemplateLayout:
+    with span("layout", kind):
+        return get_layout(kind, tpath)
+
+def _checkout(kind: str, tpath: str):
+    with span("template", kind):
+        return POOL.checkout(kind, tpath)
+
+# safe write for merged cells: always write to the top-left of the merged range
+def _write_cell_safe(ws, merged: MergedIndex, r: int, c: int, value):
+    anchor = merged.anchor(r, c)
+    if anchor:
+        r, c = anchor
+    ws.cell(r, c).value = value
+
+# -------- EXPORT: Detail (safe: strict ascending + inline emergency) --------
+# Two phases: plan_detail() resolves works, spare rows and emergency merges into a
+# flat list of cell writes (pure Python, no openpyxl); write_plan() emits it.
+Cell = Tuple[int, int, Any]             # (row, column, value)
+
+def render_detail(tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+                  progress: Optional[Progress] = None, agg: Optional[MonthAggregates] = None) -> bytes:
+    lay = _layout("detail", tpath)
+    with span("plan", "detail"):
+        plan = plan_detail(lay, works, emerg)
+    count(RECORDS, len(works) + len(emerg), "export", "detail")
+    wb = _checkout("detail", tpath)
+    with span("write", "detail"):
+        write_plan(wb.active, plan, _ticker(progress, len(plan), every=2000))
+    return _xlsx_bytes(wb, "detail")
+
+def fill_detail(ws, lay: TemplateLayout, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+                tick: Callable[[], None] = _noop):
+    write_plan(ws, plan_detail(lay, works, emerg), tick)
+
+def write_plan(ws, plan: List[Cell], tick: Callable[[], None] = _noop):
+    try:
+        ws.sheet_view.rightToLeft = True
+    except Exception:
+        pass
+    cell = ws.cell
+    for r, c, v in plan:
+        tick()
+        cell(r, c).value = v
+
+def plan_detail(lay: TemplateLayout, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]]) -> List[Cell]:
+    """Cell writes of the detail sheet in row order; later writes to a cell replace earlier ones."""
+    # 1) month partitions are already in strict chronological order: old -> new
+    # 2-4) headers, header row and first fully-unmerged data row come from the compiled layout
+    cols = list(lay.cols.items())
+    hdr_row = lay.header_row
+    mi = lay.merged_index
+    targets = list(set(lay.cols.values()))
+    r = lay.first_row
+    cells: Dict[Tuple[int, int], Any] = {}
+
+    def put(rr: int, row: Dict[str, Any]):
+        for k, c in cols:
+            if k in row:
+                cells[mi.anchor(rr, c) or (rr, c)] = row[k]
+
+    idx = 1
+    # records are keyed by registry ids: spelling variants of a site/region are the same key
+    site_id, region_id = REGISTRY.site_id, REGISTRY.region_id
+
+    # 5) works (each spare on its own row), moving to next non-merged row each time
+    #    hoursDiff / grid deltas are taken as given: the API passes them through the
+    #    meter timeline (timeline.MeterTimeline.annotate), which looks across months
+    for w in works:
+        region = (w.get("region") or "").strip()
+        site   = (w.get("site") or "").strip()
+
+        hours_now  = float(w.get("hoursNow", 0) or 0)
+        hours_diff = max(0.0, float(w.get("hoursDiff", 0) or 0))
+
+        spares = w.get("spares") or [{"name":"", "qty":""}]
+        base = {
+            "index": idx, "day": w.get("weekday",""), "date": w.get("date",""),
+            "region": region, "site": site, "owner": w.get("siteOwner",""),
+            "job": w.get("jobType",""), "summary": w.get("summary",""),
+            "oil": w.get("oilLiters",0),
+            "f_oil": "✓" if w.get("oilFilter") else "", "f_diesel": "✓" if w.get("dieselFilter") else "",
+            "f_air": "✓" if w.get("airFilter") else "",
+            "h_now": hours_now, "h_diff": hours_diff,
+            "l1": w.get("l1",0), "l2": w.get("l2",0), "l3": w.get("l3",0), "kwh": w.get("kwhNow",0),
+            "exec": w.get("executor",""), "driver": w.get("driver",""), "notes": w.get("notes",""),
+        }
+        g = w.get("grid") or {}
+        base.update({
+            "g_prev": g.get("kwhPrev",""), "g_now": g.get("kwhNow",""),
+            "g_diff": g.get("kwhDiff",""), "g_kwhr": g.get("kwhr",""),
+            "g_hours": g.get("hours",""),
+        })
+
+        # ---- NEW: inline Emergency (from mission itself) when jobType == "صيانة طارئة"
+        em = w.get("emergency") or {}
+        if (w.get("jobType") or "").strip() == "صيانة طارئة" and em:
+            base.update({
+                "e_alarm":  em.get("alarm",""),
+                "e_source": em.get("source",""),
+                "e_cat":    em.get("category",""),
+                "e_type":   "",  # لا يوجد حقل نوع منفصل هنا
+            })
+        # ---- NEW END
+
+        for sp in spares:
+            base["spare"] = sp.get("name","")
+            base["qty"]   = sp.get("qty","")
+            put(r, base)
+            r = mi.first_clear_row(targets, r + 1)
+        idx += 1
+
+    # 6) (date, region, site) of every row so far -> row, to merge emergency records (legacy):
+    #    the planned value of each key cell, else the template's own text
+    c_dt, c_rg, c_st = (lay.cols.get(k, 1) for k in ("date", "region", "site"))
+    row_by_key = {}
+    no_rg, no_st = region_id(""), site_id("")
+    blank = ("", "", "")
+    for rr in range(hdr_row + 1, r):
+        tpl = lay.body.get(rr, blank)
+        dt = _norm(cells[(rr, c_dt)])[:10] if (rr, c_dt) in cells else tpl[0]
+        rg = region_id(cells[(rr, c_rg)] if (rr, c_rg) in cells else tpl[1])
+        st = site_id(cells[(rr, c_st)] if (rr, c_st) in cells else tpl[2])
+        if dt or rg != no_rg or st != no_st:
+            row_by_key[(dt, rg, st)] = rr
+
+    # 7) standalone emergencies (legacy), merged into the row of the same key; else appended
+    for e in emerg:
+        dt = (e.get("date","") or "")[:10]
+        rg = (e.get("region") or "").strip()
+        st = (e.get("site") or "").strip()
+        key = (_norm(dt), region_id(rg), site_id(st))
+        payload = {
+            "e_alarm": e.get("alarm",""),
+            "e_source": e.get("source",""),
+            "e_cat":    e.get("category",""),
+            "e_type":   e.get("etype",""),
+        }
+        if key in row_by_key:
+            put(row_by_key[key], payload)
+        else:
+            put(r, {
+                "index": idx, "day": "", "date": e.get("date",""),
+                "region": rg, "site": st, "owner": e.get("siteOwner",""),
+                "job": "", "summary": e.get("notes",""),
+                "oil":"", "f_oil":"", "f_diesel":"", "f_air":"",
+                "h_now":"", "h_diff":"", "l1":"", "l2":"", "l3":"", "kwh":"",
+                "exec":"", "driver":"", "notes": e.get("remarks",""),
+                **payload
+            })
+            row_by_key[key] = r
+            r = mi.first_clear_row(targets, r + 1)
+            idx += 1
+
+    return [(rr, c, v) for (rr, c), v in sorted(cells.items(), key=lambda x: x[0])]
+
+# -------- EXPORT: Summary --------
+def render_summary(tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+                   progress: Optional[Progress] = None, agg: Optional[MonthAggregates] = None) -> bytes:
+    """`agg`: the month's maintained counters; computed from works/emerg when not given."""
+    lay = _layout("summary", tpath)
+    if agg is None:
+        with span("plan", "summary"):
+            agg = month_aggregates(works, emerg)
+    wb = _checkout("summary", tpath)
+    with span("write", "summary"):
+        fill_summary(wb.active, lay, agg.jobs_table())
+    return _xlsx_bytes(wb, "summary")
+
+def fill_summary(ws, lay: TemplateLayout, counts: Dict[str, Dict[str, int]]):
+    try:
+        ws.sheet_view.rightToLeft = True
+    except Exception:
+        pass
+
+    hdr_row = lay.header_row
+    col_task = lay.cols["task"]
+    col_all = lay.cols["all"]
+    region_cols = lay.regions
+
+    r = hdr_row + 1
+    for t in JOB_TYPES:
+        if not ws.cell(r, col_task).value:
+            ws.cell(r, col_task).value = t
+        byreg = counts.get(t, {})
+        total = sum(byreg.values())
+        ws.cell(r, col_all).value = total
+        for rn, col in region_cols.items():
+            ws.cell(r, col).value = byreg.get(rn, 0)
+        r += 1
+
+# -------- EXPORT: Spares --------
+def render_spares(tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+                  progress: Optional[Progress] = None, agg: Optional[MonthAggregates] = None) -> bytes:
+    """`agg`: the month's maintained counters; computed from works when not given."""
+    lay = _layout("spares", tpath)
+    if agg is None:
+        with span("plan", "spares"):
+            agg = month_aggregates(works, ())
+    kpi = agg.kpi_table()
+
+    wb = _checkout("spares", tpath)
+    with span("write", "spares"):
+        fill_spares(wb.active, lay, kpi, agg.spares_table())
+    return _xlsx_bytes(wb, "spares")
+
+def fill_spares(ws, lay: TemplateLayout, kpi: Dict[str, Dict[str, float]], normalized: Dict[str, Dict[str, float]]):
+    try:
+        ws.sheet_view.rightToLeft = True
+    except Exception:
+        pass
+
+    col_all = lay.cols["all"]
+    col_by_region = lay.regions
+    mi = lay.merged_index
+
+    def write_kpi(key, totals_by_reg: dict):
+        r = lay.rows.get(key)
+        if not r:
+            return
+        total = sum(totals_by_reg.values())
+        _write_cell_safe(ws, mi, r, col_all, total)
+        for rn, c in col_by_region.items():
+            _write_cell_safe(ws, mi, r, c, totals_by_reg.get(rn, 0))
+
+    # KPIs per region with broad synonyms
+    for key in SPARES_KPIS:
+        write_kpi(key, kpi.get(key, {}))
+
+    # item names are matched to the template labels when they are counted (aggregates.spare_label)
+    for label, byreg in normalized.items():
+        r = lay.rows.get(label)
+        if not r:
+            continue
+        total = sum(byreg.values())
+        _write_cell_safe(ws, mi, r, col_all, total)
+        for rn, c in col_by_region.items():
+            _write_cell_safe(ws, mi, r, c, byreg.get(rn, 0))
+
+# -------- JSON: the figures of summary and spares --------
+def month_stats(agg: MonthAggregates) -> Dict[str, Any]:
+    """
+    What fill_summary and fill_spares write for a month: rows of [total, *per region
+    in REGIONS order] for every job type, every spares KPI and each spare label that
+    has lines. Totals are summed as the exports sum them, so the numbers are equal.
+    """
+    def row(byreg: Dict[str, Any]) -> List[Any]:
+        return [sum(byreg.values())] + [byreg.get(rn, 0) for rn in REGIONS]
+
+    jobs, kpi = agg.jobs_table(), agg.kpi_table()
+    return {
+        "regions": REGIONS,
+        "jobs": {t: row(jobs.get(t, {})) for t in JOB_TYPES},
+        "kpi": {key: row(kpi.get(key, {})) for key in SPARES_KPIS},
+        "spares": {label: row(byreg) for label, byreg in agg.spares_table().items()},
+    }
+
+# -------- EXPORT: several months in one workbook --------
+# (month, works, emergencies, maintained counters or None)
+MonthData = Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], Optional[MonthAggregates]]
+
+DETAIL_TOTALS_HEADERS = ["الشهر", "عدد الأعمال", "صيانة طارئة", "بلاغات الطوارئ", "الزيت (لتر)",
+                         "فلتر زيت", "فلتر ديزل", "فلتر هواء", "قطع الغيار (كمية)"]
+
+def _detail_totals(works: List[Dict[str, Any]], emerg: List[Dict[str, Any]]) -> List[float]:
+    t = [len(works), 0, len(emerg), 0.0, 0, 0, 0, 0.0]
+    for w in works:
+        if (w.get("jobType") or "").strip() == "صيانة طارئة":
+            t[1] += 1
+        t[3] += float(w.get("oilLiters", 0) or 0)
+        t[4] += 1 if w.get("oilFilter") else 0
+        t[5] += 1 if w.get("dieselFilter") else 0
+        t[6] += 1 if w.get("airFilter") else 0
+        for sp in (w.get("spares") or []):
+            try:
+                t[7] += float(sp.get("qty", 0) or 0)
+            except Exception:
+                pass
+    return t
+
+def render_range(kind: str, tpath: str, months: List[MonthData], progress: Optional[Progress] = None) -> bytes:
+    """
+    One workbook with a sheet per month (copies of the template sheet, filled like
+    the single-month report) plus a totals sheet, in one pass over the months in order.
+    """
+    lay = _layout(kind, tpath)
+    wb = _checkout(kind, tpath)
+    tpl = wb.active
+
+    if kind == "summary":
+        total: Dict[str, Dict[str, int]] = {t: defaultdict(int) for t in JOB_TYPES}
+        for m, works, emerg, agg in months:
+            ws = wb.copy_worksheet(tpl)
+            ws.title = m
+            counts = (agg if agg is not None else month_aggregates(works, emerg)).jobs_table()
+            fill_summary(ws, lay, counts)
+            for t, byreg in counts.items():
+                for rn, n in byreg.items():
+                    total.setdefault(t, defaultdict(int))[rn] += n
+        # the template sheet itself becomes the totals sheet, after the months
+        fill_summary(tpl, lay, total)
+        tpl.title = "الإجمالي"
+        wb.move_sheet(tpl, offset=len(wb.sheetnames) - 1)
+    elif kind == "detail":
+        rows = []
+        with span("plan", "detail"):
+            plans = [plan_detail(lay, works, emerg) for _, works, emerg, _ in months]
+        count(RECORDS, sum(len(w) + len(e) for _, w, e, _ in months), "export", "detail")
+        tick = _ticker(progress, sum(len(p) for p in plans), every=2000)
+        for (m, works, emerg, _), plan in zip(months, plans):
+            ws = wb.copy_worksheet(tpl)
+            ws.title = m
+            with span("write", "detail"):
+                write_plan(ws, plan, tick)
+            rows.append([m] + _detail_totals(works, emerg))
+        wb.remove(tpl)
+        ws = wb.create_sheet("الإجمالي")
+        ws.sheet_view.rightToLeft = True
+        ws.append(DETAIL_TOTALS_HEADERS)
+        for row in rows:
+            ws.append(row)
+        ws.append(["الإجمالي"] + [sum(r[i] for r in rows) for i in range(1, len(DETAIL_TOTALS_HEADERS))])
+    else:
+        raise ValueError(f"no multi-month workbook for {kind}")
+    wb.active = 0
+    return _xlsx_bytes(wb, kind)
+
+RENDERERS = {"detail": render_detail, "summary": render_summary, "spares": render_spares}
+
+def render(kind: str, tpath: str, works: List[Dict[str, Any]], emerg: List[Dict[str, Any]],
+           progress: Optional[Progress] = None, agg: Optional[MonthAggregates] = None) -> bytes:
+    return RENDERERS[kind](tpath, works, emerg, progress, agg)
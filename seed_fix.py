@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
-from db import SessionLocal, Site
-from datetime import datetime
+from db import SessionLocal, Site, insert_sites
 
 SITES = [
     "مبنى الزبيري - مولد","مخازن الزبيري","السعدي عصر","كهرباء عصر","عصر-2","عصر-3","سوق عصر",
@@ -22,21 +21,8 @@ SITES = [
 DEFAULT_REGION = "الأمانة"
 
 def main():
-    seen = set()
-    clean = []
-    for name in SITES:
-        if name not in seen:
-            seen.add(name)
-            clean.append(name)
-
+    inserted = insert_sites(SITES, DEFAULT_REGION)
     with SessionLocal() as s:
-        inserted = 0
-        for name in clean:
-            exists = s.query(Site).filter(Site.name == name).first()
-            if not exists:
-                s.add(Site(name=name, region=DEFAULT_REGION, created_at=datetime.utcnow()))
-                inserted += 1
-        s.commit()
         print(f"Sites inserted: {inserted}")
         print(f"Total in DB: {s.query(Site).count()}")
 
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+snapshot.py
+- Binary snapshot of the memory store and its indexes, so a restart serves
+  exports as soon as the file is read instead of after a full reload from
+  data.db (or, without a database, instead of every client re-posting).
+- File: a fixed header, then one pickle (protocol 5) of Store.state() plus the
+  registry ids the timeline is keyed by:
+      magic "LOCSNAP\\0" | format u16 | pickle protocol u16 | body length u64 | crc32 u32
+  A file of another FORMAT, a short read or a bad checksum is reported and
+  ignored (the store loads the usual way) rather than misread. Bump FORMAT
+  whenever what state() returns changes shape.
+- Snapshotter writes in a background thread, after each import and at most
+  every SNAPSHOT_INTERVAL seconds after syncs: the state is captured under the
+  store lock (shallow copies) and serialized outside it, to a temp file that
+  replaces the old one in one rename.
+- On startup restore() takes the file when it belongs to this database (same
+  epoch, not ahead of it); Store.refresh() then replays what was written after
+  it. LOCATIONS_SNAPSHOT sets the path ("" turns snapshots off).
+"""
+import gc, os, pickle, struct, sys, threading, time, zlib
+from typing import Any, Dict, Optional
+
+from metrics import BYTES, count, observe
+from registry import REGISTRY
+
+MAGIC = b"LOCSNAP\0"
+FORMAT = 2
+_HEADER = struct.Struct("<8sHHQI")
+
+class SnapshotError(ValueError):
+    """The file is not a snapshot this code can read."""
+
+def _log(msg: str):
+    print(f"snapshot: {msg}", file=sys.stderr)
+
+def dump(state: Dict[str, Any], path: str) -> int:
+    """Write `state` to `path` atomically; returns the bytes written."""
+    body = pickle.dumps(state, protocol=5)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT, 5, len(body), zlib.crc32(body)))
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return _HEADER.size + len(body)
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        head = f.read(_HEADER.size)
+        if len(head) < _HEADER.size:
+            raise SnapshotError("truncated header")
+        magic, fmt, _, size, crc = _HEADER.unpack(head)
+        if magic != MAGIC:
+            raise SnapshotError("not a snapshot file")
+        if fmt != FORMAT:
+            raise SnapshotError(f"format {fmt}, this version reads {FORMAT}")
+        body = f.read(size)
+    if len(body) != size or zlib.crc32(body) != crc:
+        raise SnapshotError("truncated or corrupt body")
+    # millions of new objects and no garbage among them: collections would only rescan them (3x slower)
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(body)
+    finally:
+        if enabled:
+            gc.enable()
+
+class Snapshotter:
+    def __init__(self, store, path: str, interval: float = 30.0):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.written = 0                # store version of the last snapshot
+        self._due: Optional[float] = None
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()     # the background thread and the shutdown hook
+        self._thread: Optional[threading.Thread] = None
+
+    # -------- startup ----------
+    def restore(self) -> bool:
+        """Load the snapshot into the store; False (store untouched) when there is none to use."""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        t0 = time.perf_counter()
+        try:
+            snap = load(self.path)
+        except (OSError, SnapshotError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            _log(f"ignoring {self.path}: {e}")
+            return False
+        state = snap["store"]
+        backend = self.store.backend
+        if backend is not None and (state["epoch"] != backend.epoch() or state["version"] > backend.generation()):
+            _log(f"ignoring {self.path}: taken from another database")
+            return False
+        # the timeline is keyed by registry ids: restored only when they can be kept
+        self.store.restore(state, indexes=REGISTRY.adopt(snap["registry"]))
+        self.written = state["version"]
+        observe("snapshot", "load", time.perf_counter() - t0)
+        return True
+
+    # -------- writes ----------
+    def start(self):
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+            self._thread.start()
+
+    def schedule(self, now: bool = False):
+        """Ask for a snapshot: soon after an import (`now`), within `interval` after a sync."""
+        if self._thread is None:
+            return
+        with self._cond:
+            due = time.monotonic() + (0 if now else self.interval)
+            if self._due is None or due < self._due:
+                self._due = due
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._due is None or self._due > time.monotonic():
+                    self._cond.wait(None if self._due is None else self._due - time.monotonic())
+                self._due = None
+            try:
+                self.write()
+            except Exception as e:       # keep the thread: the next write may succeed
+                _log(f"write failed: {e}")
+
+    def write(self) -> bool:
+        """Snapshot the store now, unless nothing changed since the last one."""
+        with self._write_lock:
+            if not self.path or self.store.version == self.written:
+                return False
+            t0 = time.perf_counter()
+            state = self.store.state()
+            n = dump({"store": state, "registry": REGISTRY.state()}, self.path)
+            self.written = state["version"]
+        observe("snapshot", "write", time.perf_counter() - t0)
+        count(BYTES, n, "snapshot", "")
+        return True
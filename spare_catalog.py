@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+spare_catalog.py
+- Maps free-text spare names to the spares template labels (catalog.SPARE_ITEMS).
+- Rule (unchanged): the first label, in catalog order, whose normalized text
+  contains the normalized name or is contained in it; else SPARE_OTHER.
+- Labels are normalized once. "label in name" is one Aho-Corasick pass over the
+  name; "name in label" is a lookup in a table of every label substring.
+- Resolved names are memoized in a bounded LRU that lives as long as the process.
+"""
+import functools, os
+from collections import deque
+from typing import Dict, List, Sequence
+
+from catalog import SPARE_ITEMS, SPARE_OTHER
+from textnorm import norm
+
+class SpareCatalog:
+    def __init__(self, labels: Sequence[str], other: str, cache_size: int = 4096):
+        self.labels = list(labels)
+        self.other = other
+        self._none = len(self.labels)                   # "no label" sorts after every index
+        normed = [norm(k) for k in self.labels]
+
+        # name in label: every substring of every label -> first label containing it
+        self._within: Dict[str, int] = {}
+        for i, nk in enumerate(normed):
+            for a in range(len(nk) + 1):
+                for b in range(a, len(nk) + 1):
+                    self._within.setdefault(nk[a:b], i)
+
+        # label in name: Aho-Corasick automaton; _best[state] = first label ending there
+        self._goto: List[Dict[str, int]] = [{}]
+        self._best: List[int] = [self._none]
+        for i, nk in enumerate(normed):
+            s = 0
+            for ch in nk:
+                nxt = self._goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[s][ch] = nxt
+                    self._goto.append({})
+                    self._best.append(self._none)
+                s = nxt
+            self._best[s] = min(self._best[s], i)
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            s = queue.popleft()
+            self._best[s] = min(self._best[s], self._best[self._fail[s]])
+            for ch, nxt in self._goto[s].items():
+                f = self._fail[s]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0) if s else 0
+                queue.append(nxt)
+
+        self.label = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, name: str) -> str:
+        """Template label for `name` (already stripped), or the "other" label."""
+        n = norm(name)
+        best = self._within.get(n, self._none)
+        s = 0
+        b = self._best[0]
+        goto, fail, bests = self._goto, self._fail, self._best
+        for ch in n:
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            if bests[s] < b:
+                b = bests[s]
+        best = min(best, b)
+        return self.labels[best] if best < self._none else self.other
+
+    def stats(self) -> Dict[str, int]:
+        info = self.label.cache_info()
+        return {"labels": len(self.labels), "hits": info.hits, "misses": info.misses,
+                "cached": info.currsize, "max": info.maxsize}
+
+CATALOG = SpareCatalog(SPARE_ITEMS, SPARE_OTHER, cache_size=int(os.environ.get("SPARE_LABEL_CACHE", "4096")))
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+sqlstore.py
+- SQLite persistence for the API store, on the tables defined in db.py.
+- Each record keeps its posted JSON in `payload` (exact round trip) and is also
+  projected into the typed columns/child tables (spares, grid_readings, linked
+  emergencies) so the data can be queried directly.
+- Writes are batched executemany inserts inside one transaction; reads come back
+  through the date indexes (works(date), emergencies(date)).
+- The database is shared by every worker process. Each write bumps the
+  generation in store_meta within its own transaction and logs the ids it
+  touched in store_changes; changes(since) hands them to the other workers.
+  A full replacement clears the log and raises the floor, below which workers
+  reload everything, and is recorded as `replaced`: client tokens from before
+  it are stale. Only the last CHANGELOG_KEEP generations are kept.
+- A streaming /import (BulkReplace) stages its batches in a temp file and
+  writes them in one transaction at the end, so the write lock is never held
+  across the upload.
+"""
+import datetime as dt
+import json
+import pickle
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, insert, select, text
+
+import db
+from db import Work, Spare, GridReading, Emergency, Site, StoreChange, StoreMeta
+from store import KINDS, Records, date_key
+
+BATCH = 500
+SPOOL_MEMORY = 32 << 20     # staged /import batches spill to disk past this
+CHANGELOG_KEEP = 10000
+
+Batch = Tuple[int, Records, Dict[str, List[str]]]    # (generation, upserts, deletes)
+
+def _chunks(seq: List, n: int = BATCH) -> Iterable[List]:
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def _num(v: Any) -> float:
+    try:
+        return float(v or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _txt(v: Any) -> str:
+    return v.strip() if isinstance(v, str) else ("" if v is None else str(v))
+
+def _as_date(s: Any) -> dt.date:
+    k = date_key(s)
+    try:
+        return dt.date(k // 10000, k // 100 % 100, k % 100)
+    except ValueError:
+        return dt.date(1, 1, 1)      # NOT NULL column; the posted value stays in payload
+
+def _dump(rec: Dict[str, Any]) -> str:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+class SqlBackend:
+    def __init__(self, engine=None):
+        self.engine = engine or db.ENGINE
+        db.init_db()
+        self._sites: Dict[str, int] = {}
+
+    # -------- sites ----------
+    def _site_ids(self, conn, recs: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        if not self._sites:
+            self._sites = {n: i for i, n in conn.execute(select(Site.id, Site.name))}
+        missing: Dict[str, str] = {}
+        for r in recs:
+            name = _txt(r.get("site"))
+            if name not in self._sites and name not in missing:
+                missing[name] = _txt(r.get("region"))
+        if missing:
+            conn.execute(insert(Site.__table__).prefix_with("OR IGNORE"),
+                         [{"name": n, "region": rg, "created_at": dt.datetime.utcnow()} for n, rg in missing.items()])
+            for part in _chunks(list(missing)):
+                self._sites.update({n: i for i, n in conn.execute(select(Site.id, Site.name).where(Site.name.in_(part)))})
+        return self._sites
+
+    # -------- row builders ----------
+    def _work_row(self, rid: str, w: Dict[str, Any], sites: Dict[str, int], now) -> Dict[str, Any]:
+        return {
+            "uid": rid, "payload": _dump(w), "created_at": now,
+            "date": _as_date(w.get("date")), "region": _txt(w.get("region")),
+            "site_id": sites[_txt(w.get("site"))], "owner": _txt(w.get("siteOwner")),
+            "job_type": _txt(w.get("jobType")), "summary": _txt(w.get("summary")),
+            "oil_liters": _num(w.get("oilLiters")), "oil_filter": bool(w.get("oilFilter")),
+            "diesel_filter": bool(w.get("dieselFilter")), "air_filter": bool(w.get("airFilter")),
+            "hours_now": _num(w.get("hoursNow")), "hours_diff": _num(w.get("hoursDiff")),
+            "l1": _num(w.get("l1")), "l2": _num(w.get("l2")), "l3": _num(w.get("l3")),
+            "kwh_now": _num(w.get("kwhNow")),
+            "executor": _txt(w.get("executor")), "driver": _txt(w.get("driver")), "notes": _txt(w.get("notes")),
+        }
+
+    def _emergency_row(self, uid: str, e: Dict[str, Any], sites: Dict[str, int], now,
+                       payload: Optional[str] = None, work_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "uid": uid, "payload": payload, "created_at": now, "linked_work_id": work_id,
+            "date": _as_date(e.get("date")), "region": _txt(e.get("region")),
+            "site_id": sites[_txt(e.get("site"))], "etype": _txt(e.get("etype")),
+            "alarm": _txt(e.get("alarm")), "source": _txt(e.get("source")),
+            "category": _txt(e.get("category")), "notes": _txt(e.get("notes")),
+        }
+
+    def _grid_row(self, uid: str, g: Dict[str, Any], now, payload: Optional[str] = None,
+                  work_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "uid": uid, "payload": payload, "created_at": now, "work_id": work_id,
+            "etype": _txt(g.get("etype")), "kwh_prev": _num(g.get("kwhPrev")), "kwh_now": _num(g.get("kwhNow")),
+            "kwh_diff": _num(g.get("kwhDiff")), "kwhr": _num(g.get("kwhr")), "hours": _num(g.get("hours")),
+        }
+
+    # -------- writes ----------
+    def _insert(self, conn, records: Records) -> int:
+        """Insert the rows of `records`; returns how many rows (spares, grid readings and linked emergencies included)."""
+        now = dt.datetime.utcnow()
+        works = records.get("works") or []
+        emerg = records.get("emergencies") or []
+        grid = records.get("grid") or []
+        sites = self._site_ids(conn, [r for _, r in works] + [r for _, r in emerg])
+        rows = len(works) + len(emerg) + len(grid)
+
+        for part in _chunks(works):
+            conn.execute(insert(Work.__table__), [self._work_row(rid, w, sites, now) for rid, w in part])
+            ids = dict(conn.execute(select(Work.uid, Work.id).where(Work.uid.in_([rid for rid, _ in part]))).all())
+            spares, grids, linked = [], [], []
+            for rid, w in part:
+                wid = ids[rid]
+                for sp in (w.get("spares") or []):
+                    if isinstance(sp, dict):
+                        spares.append({"work_id": wid, "name": _txt(sp.get("name")), "qty": _num(sp.get("qty")), "created_at": now})
+                if isinstance(w.get("grid"), dict):
+                    grids.append(self._grid_row(f"{rid}#grid", w["grid"], now, work_id=wid))
+                if isinstance(w.get("emergency"), dict) and w["emergency"]:
+                    em = {**w["emergency"], "date": w.get("date"), "region": w.get("region"), "site": w.get("site")}
+                    linked.append(self._emergency_row(f"{rid}#emergency", em, sites, now, work_id=wid))
+            if spares:
+                conn.execute(insert(Spare.__table__), spares)
+            if grids:
+                conn.execute(insert(GridReading.__table__), grids)
+            if linked:
+                conn.execute(insert(Emergency.__table__), linked)
+            rows += len(spares) + len(grids) + len(linked)
+
+        for part in _chunks(emerg):
+            conn.execute(insert(Emergency.__table__),
+                         [self._emergency_row(rid, e, sites, now, payload=_dump(e)) for rid, e in part])
+        for part in _chunks(grid):
+            conn.execute(insert(GridReading.__table__),
+                         [self._grid_row(rid, g, now, payload=_dump(g)) for rid, g in part])
+        return rows
+
+    def _delete(self, conn, kind: str, uids: List[str]):
+        for part in _chunks(uids):
+            if kind == "works":
+                wids = [i for (i,) in conn.execute(select(Work.id).where(Work.uid.in_(part)))]
+                if wids:
+                    conn.execute(delete(Spare.__table__).where(Spare.work_id.in_(wids)))
+                    conn.execute(delete(GridReading.__table__)
+                                 .where(GridReading.work_id.in_(wids) & GridReading.payload.is_(None)))
+                conn.execute(delete(Emergency.__table__).where(Emergency.uid.in_([f"{u}#emergency" for u in part])))
+                conn.execute(delete(Work.__table__).where(Work.uid.in_(part)))
+            elif kind == "emergencies":
+                conn.execute(delete(Emergency.__table__).where(Emergency.uid.in_(part)))
+            else:
+                conn.execute(delete(GridReading.__table__).where(GridReading.uid.in_(part)))
+
+    def replace(self, records: Records) -> int:
+        """Full replacement, as /import does in memory; returns the new generation."""
+        bulk = self.bulk()
+        try:
+            for kind in KINDS:
+                bulk.add(kind, records.get(kind) or [])
+        except Exception:
+            bulk.rollback()
+            raise
+        return bulk.commit()
+
+    def bulk(self, replace: bool = True, pragmas: Sequence[str] = ()) -> "BulkReplace":
+        """
+        Start a full replacement that is filled batch by batch (streaming /import);
+        replace=False keeps the stored records and upserts the batches (db.py --load).
+        """
+        return BulkReplace(self, replace, pragmas)
+
+    def apply(self, upserts: Records, deletes: Dict[str, List[str]]) -> int:
+        """
+        Delete `deletes` and the previous versions of `upserts`, then insert `upserts`; one transaction.
+        Returns the generation of this write.
+        """
+        try:
+            with self.engine.begin() as conn:
+                gen = self._bump(conn)      # takes the write lock first: generations follow commit order
+                log = []
+                for kind in KINDS:
+                    uids = list(deletes.get(kind) or []) + [rid for rid, _ in (upserts.get(kind) or [])]
+                    if uids:
+                        self._delete(conn, kind, uids)
+                    log += [{"gen": gen, "kind": kind, "uid": u, "op": "delete"} for u in (deletes.get(kind) or [])]
+                    log += [{"gen": gen, "kind": kind, "uid": u, "op": "upsert"} for u, _ in (upserts.get(kind) or [])]
+                self._insert(conn, upserts)
+                for part in _chunks(log):
+                    conn.execute(insert(StoreChange.__table__), part)
+                if gen > CHANGELOG_KEEP:
+                    floor = gen - CHANGELOG_KEEP
+                    conn.execute(delete(StoreChange.__table__).where(StoreChange.gen <= floor))
+                    self._set(conn, "floor", floor)
+            return gen
+        except Exception:
+            self._sites = {}    # may hold ids of rolled back sites
+            raise
+
+    # -------- generations ----------
+    def _get(self, conn, key: str) -> str:
+        return conn.execute(select(StoreMeta.value).where(StoreMeta.key == key)).scalar_one()
+
+    def _set(self, conn, key: str, value: Any):
+        conn.execute(StoreMeta.__table__.update().where(StoreMeta.key == key).values(value=str(value)))
+
+    def _bump(self, conn) -> int:
+        conn.execute(text("UPDATE store_meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'generation'"))
+        return int(self._get(conn, "generation"))
+
+    def epoch(self) -> str:
+        """Fixed for the life of the database, so client tokens survive restarts and hold across workers."""
+        with self.engine.connect() as conn:
+            return self._get(conn, "epoch")
+
+    def replaced(self) -> int:
+        """Generation of the last full replacement (/import, /clear); the floor also moves when the log is trimmed."""
+        with self.engine.connect() as conn:
+            return int(self._get(conn, "replaced"))
+
+    def generation(self) -> int:
+        """Number of the last committed write (one indexed read; checked before every request)."""
+        with self.engine.connect() as conn:
+            return int(self._get(conn, "generation"))
+
+    def changes(self, since: int) -> Optional[List[Batch]]:
+        """
+        Writes after generation `since`, oldest first, with the records as they are now
+        (an upsert whose record is gone since is dropped: a later delete covers it).
+        None when `since` is older than the log: reload everything.
+        """
+        with self.engine.connect() as conn:
+            if since < int(self._get(conn, "floor")):
+                return None
+            rows = conn.execute(select(StoreChange.gen, StoreChange.kind, StoreChange.uid, StoreChange.op)
+                                .where(StoreChange.gen > since).order_by(StoreChange.id)).all()
+            wanted: Dict[str, List[str]] = {k: [] for k in KINDS}
+            for _, kind, uid, op in rows:
+                if op == "upsert":
+                    wanted[kind].append(uid)
+            current: Dict[str, Dict[str, Dict[str, Any]]] = {k: {} for k in KINDS}
+            for kind, uids in wanted.items():
+                for part in _chunks(sorted(set(uids))):
+                    if kind == "works":
+                        got = self._works(conn, Work.uid.in_(part))
+                    elif kind == "emergencies":
+                        got = self._emergencies(conn, Emergency.uid.in_(part))
+                    else:
+                        got = self._grid(conn, GridReading.uid.in_(part))
+                    current[kind].update(got)
+        out: List[Batch] = []
+        for gen, kind, uid, op in rows:
+            if not out or out[-1][0] != gen:
+                out.append((gen, {k: [] for k in KINDS}, {k: [] for k in KINDS}))
+            _, ups, dels = out[-1]
+            if op == "delete":
+                dels[kind].append(uid)
+            elif uid in current[kind]:
+                ups[kind].append((uid, current[kind][uid]))
+        return out
+
+    # -------- reads ----------
+    def months(self) -> List[str]:
+        with self.engine.connect() as conn:
+            q = text("SELECT DISTINCT substr(date, 1, 7) FROM works UNION SELECT DISTINCT substr(date, 1, 7) FROM emergencies")
+            return sorted(m for (m,) in conn.execute(q) if m)
+
+    def load_month(self, m: str) -> Records:
+        """Works and emergencies dated in month `m` ("YYYY-MM"), read through the date indexes."""
+        lo = _as_date(m + "-01")
+        hi = dt.date(lo.year + lo.month // 12, lo.month % 12 + 1, 1)
+        with self.engine.connect() as conn:
+            return {
+                "works": self._works(conn, (Work.date >= lo) & (Work.date < hi)),
+                "emergencies": self._emergencies(conn, (Emergency.date >= lo) & (Emergency.date < hi)),
+            }
+
+    def load(self) -> Records:
+        with self.engine.connect() as conn:
+            return {
+                "works": self._works(conn, None),
+                "emergencies": self._emergencies(conn, None),
+                "grid": self._grid(conn),
+            }
+
+    def _works(self, conn, where) -> List[Tuple[str, Dict[str, Any]]]:
+        q = select(Work.id, Work.uid, Work.payload).order_by(Work.date, Work.id)
+        if where is not None:
+            q = q.where(where)
+        rows = conn.execute(q).all()
+        legacy = self._legacy_works(conn, [wid for wid, _, payload in rows if payload is None])
+        return [(uid, json.loads(payload) if payload is not None else legacy[wid]) for wid, uid, payload in rows]
+
+    def _legacy_works(self, conn, wids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Rows written before payloads were stored: rebuild the app's record from the columns."""
+        out: Dict[int, Dict[str, Any]] = {}
+        for part in _chunks(wids):
+            q = (select(Work.id, Work.uid, Work.date, Work.region, Site.name, Work.owner, Work.job_type, Work.summary,
+                        Work.oil_liters, Work.oil_filter, Work.diesel_filter, Work.air_filter,
+                        Work.hours_now, Work.hours_diff, Work.l1, Work.l2, Work.l3, Work.kwh_now,
+                        Work.executor, Work.driver, Work.notes)
+                 .join(Site, Site.id == Work.site_id, isouter=True).where(Work.id.in_(part)))
+            for w in conn.execute(q):
+                out[w.id] = {
+                    "id": w.uid, "date": w.date.isoformat() if w.date else "", "region": w.region or "",
+                    "site": w.name or "", "siteOwner": w.owner or "", "jobType": w.job_type or "",
+                    "summary": w.summary or "", "oilLiters": w.oil_liters or 0,
+                    "oilFilter": bool(w.oil_filter), "dieselFilter": bool(w.diesel_filter), "airFilter": bool(w.air_filter),
+                    "hoursNow": w.hours_now or 0, "hoursDiff": w.hours_diff or 0,
+                    "l1": w.l1 or 0, "l2": w.l2 or 0, "l3": w.l3 or 0, "kwhNow": w.kwh_now or 0,
+                    "executor": w.executor or "", "driver": w.driver or "", "notes": w.notes or "",
+                    "spares": [],
+                }
+            q = select(Spare.work_id, Spare.name, Spare.qty).where(Spare.work_id.in_(part)).order_by(Spare.id)
+            for wid, name, qty in conn.execute(q):
+                out[wid]["spares"].append({"name": name or "", "qty": qty or 0})
+            q = (select(GridReading.work_id, GridReading.etype, GridReading.kwh_prev, GridReading.kwh_now,
+                        GridReading.kwh_diff, GridReading.kwhr, GridReading.hours)
+                 .where(GridReading.work_id.in_(part) & GridReading.payload.is_(None)))
+            for g in conn.execute(q):
+                out[g.work_id]["grid"] = {"etype": g.etype or "", "kwhPrev": g.kwh_prev or 0, "kwhNow": g.kwh_now or 0,
+                                          "kwhDiff": g.kwh_diff or 0, "kwhr": g.kwhr or 0, "hours": g.hours or 0}
+        return out
+
+    def _emergencies(self, conn, where) -> List[Tuple[str, Dict[str, Any]]]:
+        q = (select(Emergency.uid, Emergency.payload, Emergency.id, Emergency.date, Emergency.region, Site.name,
+                    Emergency.etype, Emergency.alarm, Emergency.source, Emergency.category, Emergency.notes)
+             .join(Site, Site.id == Emergency.site_id, isouter=True)
+             .where((Emergency.payload.is_not(None)) | (Emergency.uid == text("'db-' || emergencies.id")))
+             .order_by(Emergency.date, Emergency.id))
+        if where is not None:
+            q = q.where(where)
+        out = []
+        for uid, payload, eid, d, region, site, etype, alarm, source, category, notes in conn.execute(q):
+            if payload is not None:
+                out.append((uid, json.loads(payload)))
+            else:
+                out.append((uid, {"id": uid, "date": d.isoformat() if d else "", "region": region or "",
+                                  "site": site or "", "etype": etype or "", "alarm": alarm or "",
+                                  "source": source or "", "category": category or "", "notes": notes or ""}))
+        return out
+
+    def _grid(self, conn, where=None) -> List[Tuple[str, Dict[str, Any]]]:
+        q = (select(GridReading.uid, GridReading.payload)
+             .where(GridReading.payload.is_not(None))
+             .order_by(GridReading.id))
+        if where is not None:
+            q = q.where(where)
+        return [(uid, json.loads(payload)) for uid, payload in conn.execute(q)]
+
+class BulkReplace:
+    """
+    A full replacement of the tables (unless not `replace`: an upsert) filled batch
+    by batch. The batches are staged in a temp file, off the database: commit()
+    alone takes the write lock, then empties the tables and inserts them in one
+    transaction, so a slow upload never holds off /sync. `pragmas` tune the commit's
+    connection, which is then discarded rather than returned to the pool.
+    """
+    def __init__(self, backend: SqlBackend, replace: bool = True, pragmas: Sequence[str] = ()):
+        self.backend = backend
+        self.replace = replace
+        self.pragmas = tuple(pragmas)
+        self.rows = 0                   # rows inserted by commit()
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+
+    def add(self, kind: str, records: List[Tuple[str, Dict[str, Any]]], replaced: Iterable[str] = ()):
+        """Stage `records`; `replaced` are ids sent earlier in this load that the batch overrides."""
+        pickle.dump((kind, records, list(replaced)), self._spool, protocol=5)
+
+    def _staged(self) -> Iterable[Tuple[str, List[Tuple[str, Dict[str, Any]]], List[str]]]:
+        self._spool.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._spool)
+            except EOFError:
+                return
+
+    def commit(self) -> int:
+        """Write the staged batches and publish them as a new generation; other workers reload it whole."""
+        conn = self.backend.engine.connect()
+        try:
+            with conn.begin():
+                for pragma in self.pragmas:
+                    conn.exec_driver_sql(pragma)
+                gen = self.backend._bump(conn)      # takes the write lock first: generations follow commit order
+                if self.replace:
+                    for t in (Spare, GridReading, Emergency, Work):
+                        conn.execute(delete(t.__table__))
+                # upserts look for stored versions of every id, unless there are none to find
+                upsert = not self.replace and any(conn.execute(select(t.id).limit(1)).first()
+                                                  for t in (Work, Emergency, GridReading))
+                for kind, records, replaced in self._staged():
+                    if upsert:
+                        replaced += [rid for rid, _ in records]     # stored versions of these ids
+                    if replaced:
+                        self.backend._delete(conn, kind, replaced)
+                    if records:
+                        self.rows += self.backend._insert(conn, {kind: records})
+                self.backend._set(conn, "floor", gen)
+                if self.replace:
+                    self.backend._set(conn, "replaced", gen)
+                conn.execute(delete(StoreChange.__table__))
+            return gen
+        except BaseException:
+            self.backend._sites = {}    # may hold ids of rolled back sites
+            raise
+        finally:
+            if self.pragmas:
+                conn.invalidate()
+            conn.close()
+            self._spool.close()
+
+    def rollback(self):
+        """Drop the staged batches; nothing was written."""
+        self._spool.close()
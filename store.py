@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+store.py
+- In-memory store of the records posted by the app (works, emergencies, grid).
+- Records are partitioned by month ("YYYY-MM") and each partition is kept sorted
+  by (date, savedAt). Both are turned into integer keys once, when the record is
+  stored, so exports never parse or sort dates.
+- Every record has a stable id (client "id", or a content hash for old records),
+  so clients can send upserts/deletes since a version token instead of everything.
+- An optional backend (sqlstore.SqlBackend) receives every write before it is
+  published in memory and refills the store on startup. The backend is shared
+  by every worker process: each write bumps its generation counter and logs
+  the ids it touched, and refresh() replays other processes' writes, so all
+  workers serve the same data. Versions and tokens are then generations, the
+  same in every process.
+- Records are held in compact form (compact.CompactRecord: read-only Mappings
+  sharing key layouts and repeated strings); the backend gets them as posted.
+- Indexes (e.g. aggregates.Aggregates) are kept in step with every write:
+  rebuild(records) on full loads, update(kind, removed, added) on syncs;
+  update() may return further months whose exports changed. Indexes with
+  state()/restore(state) are saved in snapshots instead of being rebuilt.
+"""
+import hashlib, json, re, threading, uuid
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from compact import compact, json_default
+
+KINDS = ("works", "emergencies", "grid")
+
+Records = Dict[str, List[Tuple[str, Dict[str, Any]]]]   # kind -> [(id, record)]
+
+_DATE_RE = re.compile(r"\s*(\d{4})-(\d{1,2})-(\d{1,2})")
+_TIME_RE = re.compile(r"[T ](\d{1,2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?")
+
+def date_key(s: Any) -> int:
+    """'2025-09-15' -> 20250915; 0 when the value is not a date."""
+    m = _DATE_RE.match(s) if isinstance(s, str) else None
+    if not m:
+        return 0
+    y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    return y * 10000 + mo * 100 + d
+
+def ts_key(s: Any) -> int:
+    """ISO timestamp -> YYYYMMDDhhmmssmmm (date-only values get a zero time); 0 when not a date."""
+    dk = date_key(s)
+    if not dk:
+        return 0
+    t = _TIME_RE.search(s, 8)
+    if not t:
+        return dk * 1000000000
+    hh, mm = int(t.group(1)), int(t.group(2))
+    ss = int(t.group(3) or 0)
+    ms = int((t.group(4) or "0")[:3].ljust(3, "0"))
+    return ((dk * 100 + hh) * 100 + mm) * 100000 + ss * 1000 + ms
+
+def sort_key(rec: Dict[str, Any]) -> Tuple[int, int]:
+    return date_key(rec.get("date")), ts_key(rec.get("savedAt"))
+
+def month_of(rec: Dict[str, Any]) -> str:
+    d = rec.get("date")
+    return d[:7] if isinstance(d, str) else ""
+
+def client_id(rec: Dict[str, Any]) -> Optional[str]:
+    rid = rec.get("id")
+    if isinstance(rid, (str, int)) and not isinstance(rid, bool) and str(rid):
+        return str(rid)
+    return None
+
+def record_id(rec: Dict[str, Any]) -> str:
+    rid = client_id(rec)
+    if rid is not None:
+        return rid
+    raw = json.dumps(rec, sort_keys=True, ensure_ascii=False, default=json_default)
+    return "h-" + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+class _Partition:
+    """Records of one month, sorted by (date, savedAt). Treated as immutable once published."""
+    __slots__ = ("keys", "recs")
+
+    def __init__(self, keys: Optional[List[Tuple[int, int]]] = None, recs: Optional[List[Dict[str, Any]]] = None):
+        self.keys: List[Tuple[int, int]] = keys if keys is not None else []
+        self.recs: List[Dict[str, Any]] = recs if recs is not None else []
+
+    def copy(self) -> "_Partition":
+        return _Partition(list(self.keys), list(self.recs))
+
+    def insert(self, key: Tuple[int, int], rec: Dict[str, Any]):
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.recs.insert(i, rec)
+
+    def remove(self, key: Tuple[int, int], rec: Dict[str, Any]) -> bool:
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.recs[i] is rec:
+                del self.keys[i]
+                del self.recs[i]
+                return True
+            i += 1
+        return False
+
+class Store:
+    """
+    Month-partitioned records. Writers hold a lock and publish new partition objects
+    for the months they touch; readers get a partition list without locking and it
+    never changes under them.
+    """
+    def __init__(self, backend=None, indexes: Sequence[Any] = ()):
+        self.epoch = uuid.uuid4().hex[:8]   # memory only: new on restart (unless a snapshot restores it)
+        self.version = 0
+        self._base = 0                      # version of the last full load into memory
+        self._replaced = 0                  # generation of the last full replacement (/import, /clear): older tokens are stale
+        self._mver: Dict[str, int] = {}     # month -> version of the last write touching it
+        self.backend = backend
+        self.indexes = list(indexes)
+        self._lock = threading.RLock()
+        self._parts: Dict[str, Dict[str, _Partition]] = {k: {} for k in KINDS}
+        self._ids: Dict[str, Dict[str, Tuple[str, Tuple[int, int], Dict[str, Any]]]] = {k: {} for k in KINDS}
+
+    def clear(self):
+        self._publish({k: [] for k in KINDS}, persist=True)
+
+    def hydrate(self):
+        """Refill memory from the backend (startup)."""
+        self.epoch = self.backend.epoch()
+        gen = self.backend.generation()
+        # writes that land after `gen` is read are replayed again by refresh(): upserts and deletes are idempotent
+        self._publish(self.backend.load(), persist=False, version=gen, replaced=self.backend.replaced())
+
+    def refresh(self) -> bool:
+        """Catch up with writes other processes made to the shared backend; True when memory changed."""
+        if self.backend is None or self.backend.generation() == self.version:
+            return False
+        with self._lock:
+            gen = self.backend.generation()
+            if gen == self.version:
+                return False
+            batches = self.backend.changes(self.version)
+            if batches is None:             # replaced, or the log no longer reaches back this far
+                self._publish(self.backend.load(), persist=False, version=gen, replaced=self.backend.replaced())
+            else:
+                for g, upserts, deletes in batches:
+                    self._apply(upserts, deletes, g)
+            return True
+
+    # -------- versions ----------
+    def token(self) -> str:
+        return f"{self.epoch}.{self.version}"
+
+    def token_valid(self, token: Any) -> bool:
+        """
+        True when `token` was issued by this store since its last full load (the client's
+        base state is still here); an older token predates an /import or /clear that
+        replaced everything, and its client must upload everything again.
+        """
+        if not isinstance(token, str) or "." not in token:
+            return False
+        epoch, _, ver = token.partition(".")
+        return epoch == self.epoch and ver.isdigit() and self._replaced <= int(ver) <= self.version
+
+    def month_version(self, m: str) -> str:
+        """Changes only when a write touches month `m` (or the whole store is replaced)."""
+        return f"{self.epoch}.{self._mver.get(m, self._base)}"
+
+    # -------- writes ----------
+    def load(self, payload: Dict[str, Any]) -> Dict[str, int]:
+        """Replace the whole store with `payload` ({"works": [...], "emergencies": [...], "grid": [...]})."""
+        loader = self.loader()
+        try:
+            for kind in KINDS:
+                loader.add(kind, payload.get(kind) or [])
+        except Exception:
+            loader.abort()
+            raise
+        return loader.commit()
+
+    def loader(self) -> "Loader":
+        """Full replacement built batch by batch; nothing is visible until commit()."""
+        return Loader(self)
+
+    def _publish(self, records: Records, persist: bool, version: Optional[int] = None,
+                 replaced: Optional[int] = None):
+        """
+        Swap in `records` as the whole store. `replaced` is given when they are a reload
+        of the backend rather than a replacement: the generation the backend was last
+        replaced at, which a reload (restart, or a worker that fell behind) must not move.
+        """
+        parts: Dict[str, Dict[str, _Partition]] = {}
+        ids: Dict[str, Dict[str, Tuple[str, Tuple[int, int], Dict[str, Any]]]] = {}
+        for kind in KINDS:
+            by_id = {rid: (month_of(rec), sort_key(rec), compact(rec)) for rid, rec in (records.get(kind) or [])}
+            by_month: Dict[str, _Partition] = {}
+            for m, key, rec in sorted(by_id.values(), key=lambda x: x[1]):
+                p = by_month.get(m)
+                if p is None:
+                    p = by_month[m] = _Partition()
+                p.keys.append(key)
+                p.recs.append(rec)
+            parts[kind] = by_month
+            ids[kind] = by_id
+        with self._lock:
+            if persist and self.backend is not None:
+                version = self.backend.replace(records)
+            for ix in self.indexes:
+                ix.rebuild({k: [rec for _, _, rec in ids[k].values()] for k in KINDS})
+            # swap in one step so concurrent exports see either the old or the new data
+            self._parts, self._ids = parts, ids
+            self.version = self.version + 1 if version is None else version
+            self._base, self._mver = self.version, {}
+            self._replaced = self.version if replaced is None else replaced
+
+    def apply(self, changes: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+        """
+        Apply {"works": {"upsert": [rec, ...], "delete": [id, ...]}, "emergencies": {...}, "grid": {...}}.
+        Cost is proportional to the changes plus the size of the months they touch.
+        """
+        upserts: Records = {}
+        deletes: Dict[str, List[str]] = {}
+        for kind in KINDS:
+            ch = changes.get(kind) or {}
+            upserts[kind] = [(record_id(r), r) for r in (ch.get("upsert") or []) if isinstance(r, dict)]
+            deletes[kind] = [str(x) for x in (ch.get("delete") or []) if isinstance(x, (str, int))]
+        if not any(upserts[k] or deletes[k] for k in KINDS):
+            return {}
+        with self._lock:
+            if self.backend is None:
+                return self._apply(upserts, deletes, self.version + 1)
+            self.refresh()
+            # persist first: if the database write fails nothing is published
+            gen = self.backend.apply(upserts, deletes)
+            if gen == self.version + 1:
+                return self._apply(upserts, deletes, gen)
+            # another process wrote in between: replay the log, this write included
+            applied = {kind: {"upserted": len(upserts[kind]),
+                              "deleted": len({rid for rid in deletes[kind] if rid in self._ids[kind]})}
+                       for kind in KINDS if upserts[kind] or deletes[kind]}
+            self.refresh()
+            return applied
+
+    def _apply(self, upserts: Records, deletes: Dict[str, List[str]], version: int) -> Dict[str, Dict[str, int]]:
+        """Publish upserts/deletes (already persisted) in memory as `version`."""
+        applied: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for kind in KINDS:
+                if not upserts[kind] and not deletes[kind]:
+                    continue
+                staged: Dict[str, _Partition] = {}
+                removed: List[Dict[str, Any]] = []
+                added: List[Dict[str, Any]] = []
+                n_up = n_del = 0
+                for rid in deletes[kind]:
+                    old = self._drop(kind, rid, staged)
+                    if old is not None:
+                        removed.append(old)
+                        n_del += 1
+                for rid, rec in upserts[kind]:
+                    old = self._drop(kind, rid, staged)
+                    if old is not None:
+                        removed.append(old)
+                    rec = compact(rec)
+                    added.append(rec)
+                    m, key = month_of(rec), sort_key(rec)
+                    self._staged(kind, m, staged).insert(key, rec)
+                    self._ids[kind][rid] = (m, key, rec)
+                    n_up += 1
+                for m, p in staged.items():
+                    self._mver[m] = version
+                    if p.recs:
+                        self._parts[kind][m] = p
+                    else:
+                        self._parts[kind].pop(m, None)
+                for ix in self.indexes:
+                    # an index may report other months whose derived values changed (timeline deltas)
+                    for m in ix.update(kind, removed, added) or ():
+                        self._mver[m] = version
+                applied[kind] = {"upserted": n_up, "deleted": n_del}
+            self.version = version
+        return applied
+
+    def _staged(self, kind: str, m: str, staged: Dict[str, _Partition]) -> _Partition:
+        p = staged.get(m)
+        if p is None:
+            cur = self._parts[kind].get(m)
+            p = staged[m] = cur.copy() if cur is not None else _Partition()
+        return p
+
+    def _drop(self, kind: str, rid: str, staged: Dict[str, _Partition]) -> Optional[Dict[str, Any]]:
+        """Remove record `rid`; returns the removed record, or None when it was not stored."""
+        hit = self._ids[kind].pop(rid, None)
+        if hit is None:
+            return None
+        m, key, rec = hit
+        return rec if self._staged(kind, m, staged).remove(key, rec) else None
+
+    # -------- reads ----------
+    def month(self, kind: str, m: str) -> List[Dict[str, Any]]:
+        """Records of month `m` in (date, savedAt) order. The list is shared: do not modify it."""
+        p = self._parts[kind].get(m)
+        return p.recs if p is not None else []
+
+    def months(self, kind: str) -> List[str]:
+        return sorted(self._parts[kind])
+
+    def records(self, kind: str) -> Iterator[Dict[str, Any]]:
+        for m in self.months(kind):
+            yield from self.month(kind, m)
+
+    def verify_indexes(self, repair: bool = False) -> Dict[str, List[str]]:
+        """Recompute every index from the stored records; {index name: keys that differed}."""
+        with self._lock:
+            recs = {k: list(self.records(k)) for k in KINDS}
+            return {ix.name: ix.verify(recs, repair) for ix in self.indexes}
+
+    def counts(self) -> Dict[str, int]:
+        return {k: len(v) for k, v in self._ids.items()}
+
+    # -------- snapshots ----------
+    def state(self) -> Dict[str, Any]:
+        """
+        Everything needed to restore the store and its indexes (snapshot.py). Published
+        partitions and index entries are never changed, so shallow copies taken under the
+        lock stay consistent while they are serialized outside it.
+        """
+        with self._lock:
+            return {
+                "epoch": self.epoch, "version": self.version, "base": self._base, "mver": dict(self._mver),
+                "replaced": self._replaced,
+                "parts": {k: dict(v) for k, v in self._parts.items()},
+                "ids": {k: dict(v) for k, v in self._ids.items()},
+                "indexes": {ix.name: ix.state() for ix in self.indexes if hasattr(ix, "state")},
+            }
+
+    def restore(self, state: Dict[str, Any], indexes: bool = True):
+        """Swap in a state() taken earlier; indexes without a saved state (or all, unless `indexes`) are rebuilt."""
+        with self._lock:
+            saved = state["indexes"] if indexes else {}
+            recs = None
+            for ix in self.indexes:
+                if ix.name in saved and hasattr(ix, "restore"):
+                    ix.restore(saved[ix.name])
+                else:
+                    if recs is None:
+                        recs = {k: [rec for _, _, rec in state["ids"][k].values()] for k in KINDS}
+                    ix.rebuild(recs)
+            self._parts, self._ids = state["parts"], state["ids"]
+            self.epoch, self.version = state["epoch"], state["version"]
+            self._base, self._mver = state["base"], state["mver"]
+            self._replaced = state["replaced"]
+
+class Loader:
+    """
+    Collects a full replacement of the store in batches (streaming /import), so
+    the upload never has to exist as one parsed payload. The backend stages the
+    batches and writes them in one transaction on commit(), which also swaps in
+    memory; the database stays open to other writers while the upload runs.
+    """
+    def __init__(self, store: Store):
+        self.store = store
+        self.by_id: Dict[str, Dict[str, Dict[str, Any]]] = {k: {} for k in KINDS}
+        self.rejected = 0
+        self.bulk = store.backend.bulk() if store.backend is not None else None
+
+    def add(self, kind: str, recs: List[Any]):
+        by_id = self.by_id[kind]
+        batch: Dict[str, Dict[str, Any]] = {}
+        replaced: List[str] = []
+        for rec in recs:
+            if not isinstance(rec, dict):
+                self.rejected += 1
+                continue
+            rid = record_id(rec)
+            if rid in by_id and client_id(rec) is None:
+                # identical legacy records: keep them all, each under its own id
+                n = 2
+                while f"{rid}-{n}" in by_id:
+                    n += 1
+                rid = f"{rid}-{n}"
+            if rid in by_id:                # a repeated client id: the last copy wins
+                del by_id[rid]
+                if batch.pop(rid, None) is None:
+                    replaced.append(rid)
+            by_id[rid] = compact(rec)
+            batch[rid] = rec
+        if self.bulk is not None:
+            self.bulk.add(kind, list(batch.items()), replaced)
+
+    def commit(self) -> Dict[str, int]:
+        gen = self.bulk.commit() if self.bulk is not None else None
+        self.store._publish({k: list(v.items()) for k, v in self.by_id.items()}, persist=False, version=gen)
+        self.store.refresh()        # writes that committed right after the replacement
+        return self.store.counts()
+
+    def abort(self):
+        if self.bulk is not None:
+            self.bulk.rollback()
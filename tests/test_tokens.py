@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Sync tokens against the shared SQLite backend: a token stays valid across
+restarts, workers and changelog trimming, and only a full replacement
+(/import, /clear) makes older ones stale.
+    python -m unittest discover tests
+"""
+import os, sys, tempfile, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ["LOCATIONS_DB"] = os.path.join(tempfile.mkdtemp(), "tokens.db")     # before db.py builds its engine
+sys.path.insert(0, ROOT)
+
+import sqlstore
+from bench.datagen import generate
+from sqlstore import SqlBackend
+from store import KINDS, Store
+
+def _worker() -> Store:
+    store = Store(SqlBackend())
+    store.hydrate()
+    return store
+
+def _edit(store: Store, work: dict, n: int) -> str:
+    store.apply({"works": {"upsert": [dict(work, summary=f"edit {n}")]}})
+    return store.token()
+
+class TokenTest(unittest.TestCase):
+    def setUp(self):
+        # each test starts from a full /import of its own
+        self.payload = generate(40, seed=1, months=1).payload()
+        self.store = _worker()
+        self.store.load({k: self.payload.get(k) or [] for k in KINDS})
+        self.imported = self.store.token()
+
+    def test_survives_restart(self):
+        synced = _edit(self.store, self.payload["works"][0], 1)
+        restarted = _worker()
+        for token in (self.imported, synced):
+            self.assertTrue(restarted.token_valid(token), token)
+            self.assertTrue(self.store.token_valid(token), token)
+
+    def test_full_replacement_makes_older_tokens_stale(self):
+        synced = _edit(self.store, self.payload["works"][0], 1)
+        other = _worker()
+        other.load({k: self.payload.get(k) or [] for k in KINDS})
+        self.store.refresh()
+        for store in (self.store, other, _worker()):
+            self.assertFalse(store.token_valid(self.imported))
+            self.assertFalse(store.token_valid(synced))
+            self.assertTrue(store.token_valid(other.token()))
+
+    def test_survives_changelog_trim(self):
+        keep, sqlstore.CHANGELOG_KEEP = sqlstore.CHANGELOG_KEEP, 2
+        try:
+            for n in range(5):
+                _edit(self.store, self.payload["works"][0], n)
+        finally:
+            sqlstore.CHANGELOG_KEEP = keep
+        self.assertTrue(_worker().token_valid(self.imported))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+textnorm.py
+- Text normalization used to match Arabic labels in templates and records.
+- norm(): drop tatweel and all whitespace, Arabic-Indic digits -> ASCII.
+- fold(): norm() plus the spelling variants people mix up when typing names
+  (hamza forms of alef, ta marbuta / ha, alef maqsura / ya, diacritics,
+  punctuation), for fuzzy lookups such as the site registry.
+- Translation tables are built once and results are memoized and interned:
+  the same few hundred strings are normalized over and over.
+"""
+import sys
+from functools import lru_cache
+from typing import Any
+
+_NORM = str.maketrans({
+    "ـ": None,
+    **{chr(0x0660 + i): str(i) for i in range(10)},     # ٠١٢٣٤٥٦٧٨٩
+    **{chr(0x06F0 + i): str(i) for i in range(10)},     # ۰۱۲۳۴۵۶۷۸۹ (Persian forms)
+})
+
+_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي",
+    **{chr(c): None for c in range(0x064B, 0x0660)},   # harakat, shadda, sukun...
+    "ٰ": None,                                     # superscript alef
+    **{ch: None for ch in "-_.,،/\\()[]'\"`"},
+})
+
+@lru_cache(maxsize=65536)
+def _norm(s: str) -> str:
+    return sys.intern("".join(s.translate(_NORM).split()))
+
+@lru_cache(maxsize=65536)
+def _fold(s: str) -> str:
+    return sys.intern(_norm(s).translate(_FOLD).lower())
+
+def norm(s: Any) -> str:
+    if not isinstance(s, str):
+        return ""
+    return _norm(s)
+
+def fold(s: Any) -> str:
+    if not isinstance(s, str):
+        return ""
+    return _fold(s)
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+timeline.py
+- Meter readings per site across all months, sorted by (date, savedAt):
+    hours[(region, site)]        generator hours (works with hoursNow > 0)
+    grid[(region, site, etype)]  grid kWh (grid records with kwhNow)
+  Keys are registry ids, so spelling variants of a site are one series.
+- The previous reading of any visit is a bisect in its series, so the delta
+  does not restart at the first visit of every month and no export rescans
+  history. With no earlier reading on the server, the client's own values
+  (hoursDiff / kwhPrev / kwhDiff) are kept.
+- MeterTimeline is a store index. It also keeps the hour deltas summed per
+  month and region (the "hours" KPI of the spares report). A write can change
+  the delta of a visit in a later month; update() returns those months so the
+  store invalidates their exports.
+- Readings are kept as integer millionths (aggregates.SCALE), like the counters.
+"""
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from aggregates import SCALE, _bump, _micro, region_of
+from registry import REGISTRY
+from store import month_of, record_id, sort_key
+from textnorm import fold
+
+Key = Tuple[Tuple[int, int], str]          # (sort_key, record id)
+
+class _Item:
+    __slots__ = ("value", "month", "region", "own", "delta")
+
+    def __init__(self, value: int, month: str, region: str, own: int, delta: int = 0):
+        self.value = value      # reading, millionths
+        self.month = month
+        self.region = region
+        self.own = own          # delta the client recorded, used when there is no earlier reading
+        self.delta = delta      # delta counted in the month totals (hours only)
+
+class _Series:
+    """Readings of one meter in time order. Replaced, never changed, once published."""
+    __slots__ = ("keys", "items")
+
+    def __init__(self, keys: Optional[List[Key]] = None, items: Optional[List[_Item]] = None):
+        self.keys: List[Key] = keys if keys is not None else []
+        self.items: List[_Item] = items if items is not None else []
+
+    def copy(self) -> "_Series":
+        return _Series(list(self.keys), list(self.items))
+
+    def before(self, key: Key) -> Optional[_Item]:
+        """Last reading strictly before `key`."""
+        i = bisect_left(self.keys, key)
+        return self.items[i - 1] if i else None
+
+    def find(self, key: Key) -> int:
+        i = bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def delta(self, i: int) -> int:
+        it = self.items[i]
+        return max(0, it.value - self.items[i - 1].value) if i else it.own
+
+def _hours_key(rec: Dict[str, Any]) -> Tuple[int, int]:
+    return REGISTRY.region_id(rec.get("region")), REGISTRY.site_id(rec.get("site"))
+
+def _grid_key(rec: Dict[str, Any], g: Dict[str, Any]) -> Tuple[int, int, str]:
+    return REGISTRY.region_id(rec.get("region")), REGISTRY.site_id(g.get("site") or rec.get("site")), fold(g.get("etype"))
+
+def _hours_item(rec: Dict[str, Any]) -> Optional[_Item]:
+    v = _micro(rec.get("hoursNow", 0))
+    if v <= 0:
+        return None
+    return _Item(v, month_of(rec), region_of(rec), max(0, _micro(rec.get("hoursDiff", 0))))
+
+def _grid_item(rec: Dict[str, Any]) -> Optional[_Item]:
+    if not rec.get("etype") or rec.get("kwhNow") in (None, ""):
+        return None
+    return _Item(_micro(rec.get("kwhNow")), month_of(rec), "", 0)
+
+def _key(rec: Dict[str, Any]) -> Key:
+    return sort_key(rec), record_id(rec)
+
+def _month_span(lo: str, hi: str) -> List[str]:
+    """Calendar months lo..hi inclusive ("YYYY-MM")."""
+    try:
+        y, m = int(lo[:4]), int(lo[5:7])
+        y2, m2 = int(hi[:4]), int(hi[5:7])
+    except ValueError:
+        return [lo]
+    out = []
+    while (y, m) <= (y2, m2):
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+class MeterTimeline:
+    name = "timeline"
+
+    def __init__(self):
+        self._hours: Dict[Tuple[int, int], _Series] = {}
+        self._grid: Dict[Tuple[int, int, str], _Series] = {}
+        self._totals: Dict[str, Dict[str, int]] = {}     # month -> region -> hour deltas (millionths)
+        self._months: Dict[str, int] = {}                # month -> works in it
+
+    # -------- store index ----------
+    def rebuild(self, recs: Dict[str, Iterable[Dict[str, Any]]]):
+        self._hours, self._grid, self._totals, self._months = self._build(recs)
+
+    def state(self) -> Tuple[Any, ...]:
+        """Series are keyed by registry ids: only valid with the registry state saved alongside."""
+        return dict(self._hours), dict(self._grid), self._totals, self._months
+
+    def restore(self, state: Tuple[Any, ...]):
+        self._hours, self._grid, self._totals, self._months = state
+
+    @staticmethod
+    def _build(recs: Dict[str, Iterable[Dict[str, Any]]]):
+        hours: Dict[Tuple[int, int], List[Tuple[Key, _Item]]] = {}
+        grid: Dict[Tuple[int, int, str], List[Tuple[Key, _Item]]] = {}
+        months: Dict[str, int] = {}
+        for rec in recs.get("works") or ():
+            m = month_of(rec)
+            months[m] = months.get(m, 0) + 1
+            it = _hours_item(rec)
+            if it is not None:
+                hours.setdefault(_hours_key(rec), []).append((_key(rec), it))
+        for rec in recs.get("grid") or ():
+            it = _grid_item(rec)
+            if it is not None:
+                grid.setdefault(_grid_key(rec, rec), []).append((_key(rec), it))
+
+        def series(pairs: List[Tuple[Key, _Item]]) -> _Series:
+            pairs.sort(key=lambda p: p[0])
+            return _Series([k for k, _ in pairs], [it for _, it in pairs])
+
+        totals: Dict[str, Dict[str, int]] = {}
+        hs = {k: series(v) for k, v in hours.items()}
+        for s in hs.values():
+            for i, it in enumerate(s.items):
+                it.delta = s.delta(i)
+                _bump(totals, it.month, it.region, it.delta)
+        return hs, {k: series(v) for k, v in grid.items()}, totals, months
+
+    def update(self, kind: str, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]) -> Set[str]:
+        """Apply a sync; returns the months whose readings or deltas changed."""
+        # a record upserted twice in one sync is both added and removed: cancel those out
+        both = {id(r) for r in removed} & {id(r) for r in added}
+        if both:
+            removed = [r for r in removed if id(r) not in both]
+            added = [r for r in added if id(r) not in both]
+        if kind == "works":
+            months = dict(self._months)
+            for sign, recs in ((-1, removed), (1, added)):
+                for rec in recs:
+                    m = month_of(rec)
+                    n = months.get(m, 0) + sign
+                    if n:
+                        months[m] = n
+                    else:
+                        months.pop(m, None)
+            self._months = months
+            return self._update_hours(removed, added)
+        if kind == "grid":
+            return self._update_grid(removed, added)
+        return set()
+
+    def _update_hours(self, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]) -> Set[str]:
+        staged: Dict[Tuple[int, int], _Series] = {}
+        dirty: Dict[Tuple[int, int], Set[Key]] = {}
+        totals = {m: dict(v) for m, v in self._totals.items()}
+        touched: Set[str] = set()
+
+        def stage(k):
+            s = staged.get(k)
+            if s is None:
+                cur = self._hours.get(k)
+                s = staged[k] = cur.copy() if cur is not None else _Series()
+            return s
+
+        for rec in removed:
+            if _micro(rec.get("hoursNow", 0)) <= 0:
+                continue
+            k = _hours_key(rec)
+            s = stage(k)
+            i = s.find(_key(rec))
+            if i < 0:
+                continue
+            it = s.items[i]
+            _bump(totals, it.month, it.region, -it.delta)
+            touched.add(it.month)
+            del s.keys[i], s.items[i]
+            if i < len(s.keys):
+                dirty.setdefault(k, set()).add(s.keys[i])
+        for rec in added:
+            it = _hours_item(rec)
+            if it is None:
+                continue
+            k, key = _hours_key(rec), _key(rec)
+            s = stage(k)
+            i = bisect_right(s.keys, key)
+            s.keys.insert(i, key)
+            s.items.insert(i, it)
+            marks = dirty.setdefault(k, set())
+            marks.add(key)
+            if i + 1 < len(s.keys):
+                marks.add(s.keys[i + 1])
+
+        for k, keys in dirty.items():
+            s = staged[k]
+            for key in keys:
+                i = s.find(key)
+                if i < 0:
+                    continue
+                it = s.items[i]
+                d = s.delta(i)
+                if d != it.delta:       # new readings come in counted as 0
+                    _bump(totals, it.month, it.region, d - it.delta)
+                    s.items[i] = _Item(it.value, it.month, it.region, it.own, d)
+                    touched.add(it.month)
+
+        for k, s in staged.items():
+            if s.keys:
+                self._hours[k] = s
+            else:
+                self._hours.pop(k, None)
+        self._totals = totals
+        return touched
+
+    def _update_grid(self, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]) -> Set[str]:
+        staged: Dict[Tuple[int, int, str], _Series] = {}
+        spans: List[Tuple[str, Tuple[int, int, str], Key]] = []
+
+        def stage(k):
+            s = staged.get(k)
+            if s is None:
+                cur = self._grid.get(k)
+                s = staged[k] = cur.copy() if cur is not None else _Series()
+            return s
+
+        for sign, recs in ((-1, removed), (1, added)):
+            for rec in recs:
+                it = _grid_item(rec)
+                if it is None:
+                    continue
+                k, key = _grid_key(rec, rec), _key(rec)
+                s = stage(k)
+                if sign < 0:
+                    i = s.find(key)
+                    if i < 0:
+                        continue
+                    del s.keys[i], s.items[i]
+                else:
+                    i = bisect_right(s.keys, key)
+                    s.keys.insert(i, key)
+                    s.items.insert(i, it)
+                spans.append((it.month, k, key))
+
+        for k, s in staged.items():
+            if s.keys:
+                self._grid[k] = s
+            else:
+                self._grid.pop(k, None)
+        # visits after a changed reading see a different previous reading, up to the next reading
+        last = max(self._months) if self._months else ""
+        touched: Set[str] = set()
+        for m, k, key in spans:
+            s = self._grid.get(k) or _Series()
+            i = bisect_right(s.keys, key)
+            hi = s.items[i].month if i < len(s.items) else max(last, m)
+            touched.update(_month_span(m, hi))
+        return touched
+
+    def verify(self, recs: Dict[str, Iterable[Dict[str, Any]]], repair: bool = False) -> List[str]:
+        """Months whose hour totals differ, plus "hours"/"grid" when a series differs."""
+        hours, grid, totals, months = self._build(recs)
+        bad = sorted(m for m in set(totals) | set(self._totals) if totals.get(m) != self._totals.get(m))
+
+        def same(a: Dict[Any, _Series], b: Dict[Any, _Series]) -> bool:
+            return a.keys() == b.keys() and all(
+                a[k].keys == b[k].keys and [(x.value, x.delta) for x in a[k].items] == [(x.value, x.delta) for x in b[k].items]
+                for k in a)
+        if not same(hours, self._hours):
+            bad.append("hours")
+        if not same(grid, self._grid):
+            bad.append("grid")
+        if months != self._months:
+            bad.append("months")
+        if repair and bad:
+            self._hours, self._grid, self._totals, self._months = hours, grid, totals, months
+        return bad
+
+    # -------- reads ----------
+    def hours(self, m: str) -> Dict[str, int]:
+        """Region -> hour deltas of month `m` (millionths)."""
+        return self._totals.get(m) or {}
+
+    def last(self, region: Any, site: Any, etype: Any = None) -> Dict[str, Optional[float]]:
+        """Latest generator hours and (for `etype`) grid kWh of a site; None when there is none."""
+        rec = {"region": region, "site": site}
+        hs = self._hours.get(_hours_key(rec))
+        gs = self._grid.get(_grid_key(rec, {"etype": etype})) if etype else None
+        return {"hours": hs.items[-1].value / SCALE if hs and hs.items else None,
+                "kwh": gs.items[-1].value / SCALE if gs and gs.items else None}
+
+    def annotate(self, works: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        `works` with hoursDiff and grid kwhPrev/kwhDiff taken from the timeline.
+        Records are not modified; changed ones are shallow copies.
+        """
+        out = []
+        for w in works:
+            fix: Dict[str, Any] = {}
+            now = _micro(w.get("hoursNow", 0))
+            if now > 0:
+                s = self._hours.get(_hours_key(w))
+                prev = s.before(_key(w)) if s is not None else None
+                if prev is not None:
+                    fix["hoursDiff"] = max(0, now - prev.value) / SCALE
+            g = w.get("grid")
+            if isinstance(g, Mapping) and g.get("etype") and g.get("kwhNow") not in (None, ""):
+                s = self._grid.get(_grid_key(w, g))
+                # grid records are saved just after their work: take readings strictly before its time
+                prev = s.before((sort_key(w), "")) if s is not None else None
+                if prev is not None:
+                    gnow = _micro(g.get("kwhNow"))
+                    fix["grid"] = {**g, "kwhPrev": prev.value / SCALE, "kwhDiff": max(0, gnow - prev.value) / SCALE}
+            out.append({**w, **fix} if fix else w)
+        return out
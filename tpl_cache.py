@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+tpl_cache.py
+- Compiles the layout of templates/{detail,summary,spares}.xlsx once per file version.
+- A layout holds what the exports need to locate cells: header row, column map,
+  label rows (KPIs / spare items) and the merged ranges of the sheet.
+- Layouts are cached per path; a change of mtime/size triggers a content hash check
+  and the template is recompiled only when the hash differs.
+- POOL keeps the parsed template workbooks warm so each export gets a clone
+  instead of a fresh load_workbook().
+"""
+import hashlib, io, os, pickle, threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+try:
+    from openpyxl import load_workbook
+except Exception:
+    load_workbook = None
+
+from catalog import REGIONS, SPARE_ITEMS
+from textnorm import norm
+
+class LayoutError(Exception):
+    """Raised when a template does not have the expected header/label cells."""
+
+# -------- Template vocabulary ----------
+DETAIL_HEADERS: Dict[str, List[str]] = {
+    "index":["م"], "day":["اليوم"], "date":["التاريخ","تاريخ"], "region":["المنطقة","المنطقه"],
+    "site":["الموقع"], "owner":["تبعية الموقع","تبعيةالموقع","التبعية"], "job":["نوع العمل","نوعالعمل"],
+    "summary":["العمل المنجز","العملالمنجز(ملخصفقط)","العمل المنجز (ملخص فقط)","ملخص العمل"],
+    "oil":["الزيت (لتر)","الزيت(لتر)","كمية الزيت","كميةالزيت"],
+    "f_oil":["فلتر الزيت","فلترالزيت"], "f_diesel":["فلتر الديزل","فلترالديزل"], "f_air":["فلتر الهواء","فلترالهواء"],
+    "h_now":["عداد الساعات","عدادالساعات","ساعات المولد","ساعاتالمولد"],
+    "h_diff":["فارق القراءة","فارقالقراءة","فارق القراءة (تغيير الزيت)","فارقالقراءة(تغييرالزيت)","فرق الساعات","فرقالساعات"],
+    "l1":["L1","L1(A)"], "l2":["L2","L2(A)"], "l3":["L3","L3(A)"], "kwh":["KWh","KWH","قراءةKWh","KWh(حالي)"],
+    "spare":["اسم القطعة","اسم القطعه","الصنف"], "qty":["الكمية","الكميه"],
+    "exec":["المنفذ للعمل","المنفذ"], "driver":["السائق"], "notes":["ملاحظات","الملاحظات"],
+    # طوارئ
+    "e_alarm":["الإنذار","الانذار"], "e_source":["مصدر البلاغ","مصدرالبلاغ"],
+    "e_cat":["تصنيف المشكلة","تصنيفالمشكلة"], "e_type":["النوع","نوع الطارئ"],
+    # عمومي/تجاري
+    "g_prev":["القراءة السابقة","القراءةالسابقة","KWh السابقة","KWhالسابقة"],
+    "g_now":["الحالية","القراءة الحالية","القراءةالحالية","KWh الحالية","KWhالحالية"],
+    "g_diff":["الاستهلاك (KWh)","الاستهلاكKWh","فرقKWh","فرقالKWh"],
+    "g_kwhr":["kWhr","KWhr","kWhr(اختياري)"], "g_hours":["عداد ساعات الكهرباء","عدادساعاتالكهرباء","ساعات الكهرباء","ساعاتالكهرباء"],
+}
+
+# KPI rows of spares.xlsx (broad synonyms)
+SPARES_KPIS: Dict[str, List[str]] = {
+    "hours":    ["مجموع ساعات عمل المولدات", "ساعات عمل المولدات", "ساعاتالمولد"],
+    "oil":      ["كميات الزيوت المستهلكة", "الزيت المستهلك", "الزيوت المستهلكة"],
+    "f_oil":    ["عدد فلاتر الزيت", "فلاتر الزيت", "اجمالي فلاتر الزيت", "إجمالي فلاتر الزيت"],
+    "f_diesel": ["عدد فلاتر الديزل", "فلاتر الديزل", "اجمالي فلاتر الديزل", "إجمالي فلاتر الديزل"],
+    "f_air":    ["عدد فلاتر الهواء", "فلاتر الهواء", "اجمالي فلاتر الهواء", "إجمالي فلاتر الهواء"],
+}
+
+# -------- Layout ----------
+class MergedIndex:
+    """
+    Lookup structure over the merged ranges of a sheet, built once per template.
+    - anchor(r, c): top-left cell of the range when (r, c) is a MergedCell, else None (O(1));
+    - first_clear_row(cols, start): first row >= start where none of `cols` is a
+      MergedCell (O(log n) over the blocked row intervals of those columns).
+    """
+    def __init__(self, ranges: Iterable[Tuple[int, int, int, int]]):
+        self._anchor: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        blocked: Dict[int, List[Tuple[int, int]]] = {}
+        for (r0, c0, r1, c1) in ranges:
+            for c in range(c0, c1 + 1):
+                top = r0 + 1 if c == c0 else r0      # the anchor itself is a normal cell
+                if top <= r1:
+                    blocked.setdefault(c, []).append((top, r1))
+                for r in range(top, r1 + 1):
+                    self._anchor[(r, c)] = (r0, c0)
+        self._blocked = blocked
+        self._spans: Dict[frozenset, Tuple[List[int], List[int]]] = {}
+
+    def anchor(self, r: int, c: int) -> Optional[Tuple[int, int]]:
+        return self._anchor.get((r, c))
+
+    def _union(self, cols: frozenset) -> Tuple[List[int], List[int]]:
+        spans = self._spans.get(cols)
+        if spans is None:
+            ivs = sorted(iv for c in cols for iv in self._blocked.get(c, ()))
+            starts: List[int] = []
+            ends: List[int] = []
+            for a, b in ivs:
+                if ends and a <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], b)
+                else:
+                    starts.append(a)
+                    ends.append(b)
+            spans = self._spans[cols] = (starts, ends)
+        return spans
+
+    def first_clear_row(self, cols: Iterable[int], start_row: int) -> int:
+        r = max(1, start_row)
+        starts, ends = self._union(frozenset(cols))
+        i = bisect_right(starts, r) - 1
+        if i >= 0 and r <= ends[i]:
+            r = ends[i] + 1       # touching spans are coalesced, so this row is clear
+        return r
+
+@dataclass(frozen=True)
+class TemplateLayout:
+    kind: str
+    digest: str
+    header_row: int
+    first_row: int                      # first fully-unmerged row under the header
+    cols: Mapping[str, int]             # logical column -> column number
+    regions: Mapping[str, int]          # region name -> column number
+    rows: Mapping[str, int]             # KPI key / item label -> row number
+    merged: Tuple[Tuple[int, int, int, int], ...]   # (min_row, min_col, max_row, max_col)
+    merged_index: MergedIndex
+    # detail: normalized (date, region, site) texts of template rows under the header
+    # that are not blank, so emergencies can merge into them without reading the sheet
+    body: Mapping[int, Tuple[str, str, str]]
+
+class _Grid:
+    """Normalized cell texts of the sheet, read once per compile."""
+    def __init__(self, ws, max_rows: int):
+        self.max_row = ws.max_row
+        self.max_col = ws.max_column
+        self.rows: List[List[str]] = [
+            [norm(v) for v in row]
+            for row in ws.iter_rows(min_row=1, max_row=min(max_rows, ws.max_row),
+                                    max_col=ws.max_column, values_only=True)
+        ]
+
+    def get(self, r: int, c: int) -> str:
+        if 1 <= r <= len(self.rows) and 1 <= c <= self.max_col:
+            return self.rows[r - 1][c - 1]
+        return ""
+
+def _find_header_cols(g: _Grid, header_texts: dict, search_rows: int = 240) -> dict:
+    res = {}
+    wanted = {k: [norm(v) for v in vs] for k, vs in header_texts.items()}
+    for r in range(1, min(search_rows, g.max_row) + 1):
+        for c in range(1, g.max_col + 1):
+            v = g.get(r, c)
+            if not v:
+                continue
+            for key, variants in wanted.items():
+                if key in res:
+                    continue
+                if any(x and x in v for x in variants):
+                    res[key] = c
+        if len(res) == len(header_texts):
+            break
+    return res
+
+def _find_label_row(g: _Grid, variants: Iterable[str], search_rows: int = 800) -> Optional[int]:
+    vv = [norm(x) for x in variants]
+    for r in range(1, min(search_rows, g.max_row) + 1):
+        for c in range(1, g.max_col + 1):
+            val = g.get(r, c)
+            if any(v and v in val for v in vv):
+                return r
+    return None
+
+def _merged_ranges(ws) -> Tuple[Tuple[int, int, int, int], ...]:
+    return tuple((m.min_row, m.min_col, m.max_row, m.max_col) for m in ws.merged_cells.ranges)
+
+def _layout(kind, digest, header_row, first_row, cols=None, regions=None, rows=None, merged=(),
+            index: Optional[MergedIndex] = None, body=None) -> TemplateLayout:
+    return TemplateLayout(
+        kind=kind, digest=digest, header_row=header_row, first_row=first_row,
+        cols=MappingProxyType(dict(cols or {})), regions=MappingProxyType(dict(regions or {})),
+        rows=MappingProxyType(dict(rows or {})), merged=merged,
+        merged_index=index or MergedIndex(merged), body=MappingProxyType(dict(body or {})),
+    )
+
+# -------- Compilers ----------
+def _compile_detail(ws, digest: str) -> TemplateLayout:
+    g = _Grid(ws, 400)
+    cols = _find_header_cols(g, DETAIL_HEADERS, search_rows=400)
+    if "date" not in cols or "site" not in cols:
+        # fallback: guess the header row that contains both labels
+        cand_rows = {}
+        for r in range(1, min(g.max_row, 60) + 1):
+            row_vals = [g.get(r, c) for c in range(1, g.max_col + 1)]
+            if any(norm("التاريخ") in v for v in row_vals) and any(norm("الموقع") in v for v in row_vals):
+                cand_rows[r] = sum(1 for v in row_vals if v)
+        if cand_rows:
+            hdr_row_guess = max(cand_rows, key=cand_rows.get)
+            cols = {}
+            for c in range(1, g.max_col + 1):
+                v = g.get(hdr_row_guess, c)
+                for key, variants in DETAIL_HEADERS.items():
+                    if key in cols: continue
+                    if any(norm(x) in v for x in variants if x):
+                        cols[key] = c
+        if "date" not in cols or "site" not in cols:
+            raise LayoutError("تعذر تحديد أعمدة (التاريخ/الموقع) في detail.xlsx — راجع صف العناوين.")
+
+    # header row is where the date label sits
+    hdr_row = 1
+    for rr in range(1, min(g.max_row, 240) + 1):
+        if g.get(rr, cols["date"]).find(norm("التاريخ")) != -1:
+            hdr_row = rr
+            break
+
+    merged = _merged_ranges(ws)
+    index = MergedIndex(merged)
+    first_row = index.first_clear_row(cols.values(), hdr_row + 1)
+
+    key_cols = [cols.get(k, 1) for k in ("date", "region", "site")]
+    body = {}
+    for r, row in enumerate(ws.iter_rows(min_row=hdr_row + 1, max_col=max(key_cols), values_only=True),
+                            start=hdr_row + 1):
+        dt, rg, st = (norm(row[c - 1]) if c <= len(row) else "" for c in key_cols)
+        if dt or rg or st:
+            body[r] = (dt[:10], rg, st)
+    return _layout("detail", digest, hdr_row, first_row, cols=cols, merged=merged, index=index, body=body)
+
+def _compile_summary(ws, digest: str) -> TemplateLayout:
+    g = _Grid(ws, 240)
+    wanted = [norm(h) for h in ["المهام", "الكل", *REGIONS]]
+    scores = {}
+    for r in range(1, min(240, g.max_row) + 1):
+        hits = sum(1 for c in range(1, g.max_col + 1) if g.get(r, c) in wanted)
+        if hits:
+            scores[r] = hits
+    if not scores:
+        raise LayoutError("تعذر تحديد صف العناوين في summary.xlsx.")
+    hdr_row = max(scores, key=scores.get)
+
+    col_task = None
+    col_all = None
+    region_cols: Dict[str, int] = {}
+    for c in range(1, g.max_col + 1):
+        hv = g.get(hdr_row, c)
+        if hv == norm("م"):
+            continue
+        if hv == norm("المهام"):
+            col_task = c
+        if hv == norm("الكل"):
+            col_all = c
+        for rn in REGIONS:
+            if hv == norm(rn):
+                region_cols[rn] = c
+
+    if not region_cols:
+        raise LayoutError("تعذر تحديد أعمدة المناطق.")
+    if not col_task:
+        col_task = min(region_cols.values()) - 1
+    if not col_all:
+        col_all = max(region_cols.values()) + 1
+
+    return _layout("summary", digest, hdr_row, hdr_row + 1,
+                   cols={"task": col_task, "all": col_all}, regions=region_cols,
+                   merged=_merged_ranges(ws))
+
+def _compile_spares(ws, digest: str) -> TemplateLayout:
+    g = _Grid(ws, 800)
+    stmt_col = _find_header_cols(g, {"stmt": ["البيان", "البند", "الوصف"]}, search_rows=220).get("stmt")
+    if not stmt_col:
+        raise LayoutError("تعذر العثور على عمود 'البيان' في spares.xlsx")
+
+    # header row (where "البيان" appears)
+    hdr_row = None
+    for rr in range(1, 240):
+        if g.get(rr, stmt_col) in [norm("البيان"), norm("البند"), norm("الوصف")]:
+            hdr_row = rr
+            break
+    if hdr_row is None:
+        hdr_row = 5
+
+    col_all = None
+    col_unit = None
+    col_by_region: Dict[str, int] = {}
+    for c in range(1, g.max_col + 1):
+        hv = g.get(hdr_row, c)
+        if hv == norm("م"):
+            continue
+        if hv == norm("الكل"):
+            col_all = c
+        if hv == norm("الوحدة"):
+            col_unit = c
+        for rn in REGIONS:
+            if hv == norm(rn):
+                col_by_region[rn] = c
+
+    if not col_by_region:
+        raise LayoutError("تعذر تحديد أعمدة المناطق في spares.xlsx")
+    if not col_all:
+        if not col_unit:
+            raise LayoutError("لم يُعثر على 'الكل' ولا 'الوحدة' لتحديد عمود الإجمالي.")
+        col_all = col_unit - 1  # إجمالي قبل "الوحدة" عند غياب "الكل"
+
+    rows: Dict[str, int] = {}
+    for key, variants in SPARES_KPIS.items():
+        r = _find_label_row(g, variants, search_rows=800)
+        if r:
+            rows[key] = r
+    for label in SPARE_ITEMS:
+        r = _find_label_row(g, [label], search_rows=800)
+        if r:
+            rows[label] = r
+
+    cols = {"stmt": stmt_col, "all": col_all}
+    if col_unit:
+        cols["unit"] = col_unit
+    return _layout("spares", digest, hdr_row, hdr_row + 1, cols=cols, regions=col_by_region,
+                   rows=rows, merged=_merged_ranges(ws))
+
+_COMPILERS: Dict[str, Callable[..., TemplateLayout]] = {
+    "detail": _compile_detail,
+    "summary": _compile_summary,
+    "spares": _compile_spares,
+}
+
+# -------- Cache ----------
+_LAYOUTS: Dict[Tuple[str, str], Tuple[Tuple[int, int], TemplateLayout]] = {}
+_LOCK = threading.Lock()
+
+def _file_sig(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def get_layout(kind: str, path: str) -> TemplateLayout:
+    """Compiled layout of the template at `path`; recompiled only when the file content changes."""
+    key = (kind, os.path.abspath(path))
+    sig = _file_sig(path)
+    hit = _LAYOUTS.get(key)
+    if hit and hit[0] == sig:
+        return hit[1]
+    with _LOCK:
+        hit = _LAYOUTS.get(key)
+        if hit and hit[0] == sig:
+            return hit[1]
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if hit and hit[1].digest == digest:
+            layout = hit[1]      # touched but unchanged
+        else:
+            wb = load_workbook(io.BytesIO(data))
+            layout = _COMPILERS[kind](wb.active, digest)
+        _LAYOUTS[key] = (sig, layout)
+        return layout
+
+# -------- Workbook pool ----------
+class _PoolEntry:
+    __slots__ = ("sig", "digest", "snapshot", "ready")
+
+    def __init__(self, sig, digest, snapshot):
+        self.sig = sig
+        self.digest = digest
+        self.snapshot = snapshot     # pickled parsed workbook
+        self.ready: List = []        # restored clones waiting for a request
+
+class WorkbookPool:
+    """
+    Parsed template workbooks kept warm in memory.
+    - each template is parsed once per file version and kept as a pickled snapshot;
+    - checkout() hands out a private clone (pre-restored when available, else restored
+      from the snapshot) so requests never unzip/parse the xlsx again;
+    - up to `size` clones per template are restored ahead of time on a background thread.
+    """
+    def __init__(self, size: int = 2):
+        self.size = max(0, size)
+        self._entries: Dict[Tuple[str, str], _PoolEntry] = {}
+        self._lock = threading.Lock()
+        self._refill = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tpl-pool")
+        self.hits = 0        # served without parsing the xlsx
+        self.misses = 0      # template had to be parsed from disk
+        self.restores = 0    # hits that restored the snapshot on the request path
+
+    def _load(self, key, path: str, sig, old: Optional[_PoolEntry]):
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if old is not None and old.digest == digest:
+            old.sig = sig
+            return old, None
+        wb = load_workbook(io.BytesIO(data))
+        entry = _PoolEntry(sig, digest, pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL))
+        return entry, wb
+
+    def warm(self, kind: str, path: str):
+        self.checkout(kind, path, count=False)
+
+    def checkout(self, kind: str, path: str, count: bool = True):
+        key = (kind, os.path.abspath(path))
+        sig = _file_sig(path)
+        wb = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.sig != sig:
+                entry, wb = self._load(key, path, sig, entry)
+                self._entries[key] = entry
+                if wb is not None and count:
+                    self.misses += 1
+            if wb is None and entry.ready:
+                wb = entry.ready.pop()
+                if count:
+                    self.hits += 1
+            snapshot = entry.snapshot
+        if wb is None:
+            wb = pickle.loads(snapshot)
+            if count:
+                self.hits += 1
+                self.restores += 1
+        if self.size:
+            self._refill.submit(self._fill, key, entry)
+        return wb
+
+    def _fill(self, key, entry: _PoolEntry):
+        while True:
+            with self._lock:
+                if self._entries.get(key) is not entry or len(entry.ready) >= self.size:
+                    return
+            clone = pickle.loads(entry.snapshot)
+            with self._lock:
+                if self._entries.get(key) is not entry or len(entry.ready) >= self.size:
+                    return
+                entry.ready.append(clone)
+
+    def stats(self) -> dict:
+        with self._lock:
+            templates = {k[0]: {"digest": e.digest, "ready": len(e.ready), "snapshot_bytes": len(e.snapshot)}
+                         for k, e in self._entries.items()}
+        return {"size": self.size, "hits": self.hits, "misses": self.misses,
+                "restores": self.restores, "templates": templates}
+
+POOL = WorkbookPool(size=int(os.environ.get("TEMPLATE_POOL_SIZE", "2")))